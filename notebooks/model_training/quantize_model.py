@@ -0,0 +1,186 @@
+"""INT8 quantization of the YOLOv11n classifier with an accuracy/latency gate.
+
+Exports v0.pt to FP32 ONNX, quantizes it to INT8 with ONNX Runtime (static, calibrated
+on a sample of the training images, or dynamic), then scores both models on the val
+split of the dataset in metal_casting.yaml. The INT8 model is only published to the
+model bucket when its top-1 accuracy is within --max-accuracy-drop of FP32. A report
+with per-image CPU latency and model memory footprint is written either way.
+
+    python quantize_model.py --weights v0.pt --data metal_casting.yaml --version v0-int8 --publish
+
+The inference listener picks the published model up with MODEL_VERSION=v0-int8.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import numpy as np
+import onnx
+import onnxruntime as ort
+import psutil
+import yaml
+from PIL import Image
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from ultralytics import YOLO
+
+image_extensions = (".jpg", ".jpeg", ".png")
+
+def list_images(split_dir, class_to_index):
+    """Returns (path, class index) for every image under split_dir/<class name>/."""
+    samples = []
+    for class_name in sorted(os.listdir(split_dir)):
+        class_dir = os.path.join(split_dir, class_name)
+        if not os.path.isdir(class_dir) or class_name not in class_to_index:
+            continue
+        for file_name in sorted(os.listdir(class_dir)):
+            if file_name.lower().endswith(image_extensions):
+                samples.append((os.path.join(class_dir, file_name), class_to_index[class_name]))
+    return samples
+
+def preprocess(image_path, imgsz):
+    """Mirrors ultralytics classify_transforms: resize short side, center crop, RGB, scale to 0-1, NCHW."""
+    image = Image.open(image_path).convert("RGB")
+    scale = imgsz / min(image.size)
+    image = image.resize((max(imgsz, round(image.width * scale)), max(imgsz, round(image.height * scale))), Image.BILINEAR)
+    left, top = (image.width - imgsz) // 2, (image.height - imgsz) // 2
+    image = image.crop((left, top, left + imgsz, top + imgsz))
+    return (np.asarray(image, dtype=np.float32) / 255.0).transpose(2, 0, 1)[None]
+
+class ImageCalibrationReader(CalibrationDataReader):
+    def __init__(self, samples, input_name, imgsz):
+        self._inputs = iter({input_name: preprocess(path, imgsz)} for path, _ in samples)
+
+    def get_next(self):
+        return next(self._inputs, None)
+
+def create_session(model_path, threads):
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+def evaluate(model_path, samples, imgsz, threads):
+    """Returns top-1 accuracy, per-image latencies (s) and the RSS growth from loading the model (bytes)."""
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    session = create_session(model_path, threads)
+    input_name = session.get_inputs()[0].name
+    rss_after_load = process.memory_info().rss
+
+    correct = 0
+    latencies = []
+    for path, label in samples:
+        batch = preprocess(path, imgsz)
+        start = time.perf_counter()
+        probs = session.run(None, {input_name: batch})[0][0]
+        latencies.append(time.perf_counter() - start)
+        correct += int(np.argmax(probs) == label)
+
+    return correct / len(samples), latencies, rss_after_load - rss_before
+
+def summarize(model_path, accuracy, latencies, rss_bytes):
+    latencies = sorted(latencies)
+    return {
+        "model": os.path.basename(model_path),
+        "accuracy": round(accuracy, 4),
+        "latency_ms_mean": round(statistics.mean(latencies) * 1000, 2),
+        "latency_ms_p50": round(statistics.median(latencies) * 1000, 2),
+        "latency_ms_p99": round(latencies[int(round(0.99 * (len(latencies) - 1)))] * 1000, 2),
+        "file_size_mb": round(os.path.getsize(model_path) / 2**20, 2),
+        "load_rss_mb": round(rss_bytes / 2**20, 2),
+    }
+
+def publish(model_path, report_path, bucket_name, version):
+    from google.cloud import storage
+
+    bucket = storage.Client().bucket(bucket_name)
+    bucket.blob(f"{version}.onnx").upload_from_filename(model_path)
+    bucket.blob(f"{version}.report.json").upload_from_filename(report_path)
+    print(f"Published gs://{bucket_name}/{version}.onnx")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--weights", default="v0.pt", help="FP32 YOLO classifier weights")
+    parser.add_argument("--data", default="metal_casting.yaml", help="dataset config with path/train/val")
+    parser.add_argument("--version", default="v0-int8", help="model version to publish as <version>.onnx")
+    parser.add_argument("--mode", choices=["static", "dynamic"], default="static", help="INT8 quantization mode")
+    parser.add_argument("--calibration-images", type=int, default=200, help="training images used for calibration")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01, help="max allowed FP32 - INT8 top-1 accuracy")
+    parser.add_argument("--threads", type=int, default=2, help="CPU threads, matching the listener's --cpu=2")
+    parser.add_argument("--bucket", default="metal_casting_model", help="model bucket to publish to")
+    parser.add_argument("--publish", action="store_true", help="upload the INT8 model if it passes the gate")
+    args = parser.parse_args()
+
+    with open(args.data) as f:
+        dataset_config = yaml.safe_load(f)
+    dataset_path = dataset_config["path"]
+
+    model = YOLO(args.weights)
+    imgsz = model.model.args["imgsz"]
+    imgsz = imgsz[0] if isinstance(imgsz, (list, tuple)) else imgsz
+    class_to_index = {name: index for index, name in model.names.items()}
+
+    # Dynamic batch so the listener's micro-batcher can run the INT8 model too
+    fp32_path = model.export(format="onnx", dynamic=True, simplify=True)
+    stem = os.path.splitext(fp32_path)[0]
+    int8_path = f"{stem}-int8-{args.mode}.onnx"
+
+    if args.mode == "static":
+        prepared_path = f"{stem}-prepared.onnx"
+        quant_pre_process(fp32_path, prepared_path)
+        train_samples = list_images(os.path.join(dataset_path, dataset_config["train"]), class_to_index)
+        calibration = random.Random(0).sample(train_samples, min(args.calibration_images, len(train_samples)))
+        input_name = onnx.load(prepared_path).graph.input[0].name
+        quantize_static(
+            prepared_path,
+            int8_path,
+            ImageCalibrationReader(calibration, input_name, imgsz),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+    else:
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QUInt8)
+
+    # Keep the ultralytics metadata (names, imgsz, task) so YOLO() can load the INT8 model
+    fp32_model, int8_model = onnx.load(fp32_path), onnx.load(int8_path)
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, int8_path)
+
+    val_samples = list_images(os.path.join(dataset_path, dataset_config["val"]), class_to_index)
+    fp32_report = summarize(fp32_path, *evaluate(fp32_path, val_samples, imgsz, args.threads))
+    int8_report = summarize(int8_path, *evaluate(int8_path, val_samples, imgsz, args.threads))
+    accuracy_drop = fp32_report["accuracy"] - int8_report["accuracy"]
+    passed = accuracy_drop <= args.max_accuracy_drop
+
+    report = {
+        "version": args.version,
+        "mode": args.mode,
+        "val_images": len(val_samples),
+        "threads": args.threads,
+        "fp32": fp32_report,
+        "int8": int8_report,
+        "accuracy_drop": round(accuracy_drop, 4),
+        "max_accuracy_drop": args.max_accuracy_drop,
+        "passed": passed,
+    }
+    report_path = f"{stem}-int8-{args.mode}.report.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if not passed:
+        print(f"INT8 accuracy dropped by {accuracy_drop:.4f} (> {args.max_accuracy_drop}), not publishing.")
+        sys.exit(1)
+
+    if args.publish:
+        publish(int8_path, report_path, args.bucket, args.version)
+
+if __name__ == "__main__":
+    main()
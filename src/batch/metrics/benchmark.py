@@ -0,0 +1,197 @@
+"""Local checks for the weekly metrics job.
+
+The sql benchmark times the server-side weekly aggregation query (AGGREGATION_MODE=sql)
+on a random multi-week fixture in DuckDB against the pandas path; test_weekly_sql.py
+checks that they agree. It needs duckdb, which is not deployed with the function:
+
+    pip install duckdb
+    python benchmark.py sql --rows 50000 --weeks 6
+
+The upsert benchmark counts BigQuery jobs and wall time for writing the metric rows of
+a backfill, per-row COUNT-then-UPDATE/INSERT vs one MERGE per table, on a fake client
+that sleeps a fixed latency per job:
+
+    python benchmark.py upsert --weeks 52 --job-ms 800
+
+The sketch benchmark measures the throughput of merging a year of hourly sketches, as
+objects and from their serialized form, as the rollups and dashboards do; test_sketch.py
+checks their accuracy:
+
+    python benchmark.py sketch --sketches 8760
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import main as metrics_job
+from sketch import QuantileSketch
+
+def make_results(rows, weeks, seed):
+    """Random inference_results rows spread over weeks, starting mid-week, with some NULL speeds."""
+    rng = np.random.default_rng(seed)
+    start = datetime(2025, 3, 5, 13, 30)
+    offsets = rng.uniform(0, weeks * 7 * 86400, rows)
+    speed = rng.lognormal(3.0, 0.4, rows)
+    speed[rng.random(rows) < 0.01] = np.nan
+    return pd.DataFrame({
+        "res_insert_datetime": [start + timedelta(seconds=float(s)) for s in offsets],
+        "pred_class": rng.choice(["OK", "Defect"], rows, p=[0.6, 0.4]),
+        "pred_confidence": rng.beta(8, 2, rows),
+        "pred_speed": speed,
+    })
+
+def pandas_metrics(df, agg_start, agg_end):
+    """The statistics aggregate_weekly_metrics() computes for one week."""
+    week = df[(df["res_insert_datetime"] >= agg_start) & (df["res_insert_datetime"] < agg_end)]
+    if week.empty:
+        return None
+    vc = week["pred_class"].value_counts().to_dict()
+    speed, conf = week["pred_speed"], week["pred_confidence"]
+    return metrics_job.build_weekly_metrics(
+        agg_start, agg_end,
+        (speed.min(), speed.median(), speed.mean(), speed.max()),
+        (conf.min(), conf.median(), conf.mean(), conf.max()),
+        vc.get("OK", 0), vc.get("Defect", 0),
+        QuantileSketch().update(speed.dropna()), QuantileSketch().update(conf.dropna()),
+    )
+
+def bench_sql(args):
+    import duckdb
+
+    df = make_results(args.rows, args.weeks, args.seed)
+    all_weeks = list(metrics_job.get_week_ranges(df["res_insert_datetime"].min(), df["res_insert_datetime"].max()))
+    weeks = all_weeks[::2] if args.skip_alternate else all_weeks  # Pending weeks need not be contiguous
+
+    con = duckdb.connect()
+    con.register("inference_results", df)
+    query = metrics_job.weekly_metrics_sql("inference_results", dialect="duckdb")
+    params = {
+        "range_start": min(start for start, _ in weeks),
+        "range_end": max(end for _, end in weeks),
+        "week_starts": [start for start, _ in weeks],
+    }
+
+    start = time.perf_counter()
+    con.execute(query, params).df()
+    sql_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for agg_start, agg_end in weeks:
+        pandas_metrics(df, agg_start, agg_end)
+    pandas_seconds = time.perf_counter() - start
+
+    print(f"sql: {sql_seconds * 1000:.1f} ms for {len(weeks)} weeks in one query  "
+          f"pandas: {pandas_seconds * 1000:.1f} ms")
+
+class FakeJob:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def result(self):
+        return self._rows
+
+class FakeBigQueryClient:
+    """Records query/insert_rows_json calls and sleeps job_seconds for each one."""
+
+    def __init__(self, job_seconds, existing_weeks=()):
+        self.job_seconds = job_seconds
+        self.existing_weeks = set(existing_weeks)
+        self.calls = []
+
+    def _record(self, kind, detail):
+        time.sleep(self.job_seconds)
+        self.calls.append((kind, detail))
+
+    def query(self, query, job_config=None):
+        statement = query.split()[0]
+        self._record("query", statement)
+        if statement == "SELECT" and "COUNT(*)" in query:
+            count = sum(f"aggregation_start = '{week}'" in query for week in self.existing_weeks)
+            return FakeJob([type("Row", (), {"count": count})()])
+        return FakeJob([])
+
+    def insert_rows_json(self, table, rows):
+        self._record("insert_rows_json", len(rows))
+        return []
+
+def legacy_upsert_metrics(table_id, metric, bq_client):
+    """The previous per-row upsert: a COUNT query, then an UPDATE or a streaming insert."""
+    table_ref = f"{metrics_job.project_id}.{metrics_job.dataset_id}.{table_id}"
+    where = f"aggregation_start = '{metric['aggregation_start']}' AND aggregation_end = '{metric['aggregation_end']}'"
+    result = list(bq_client.query(f"SELECT COUNT(*) as count FROM `{table_ref}` WHERE {where}").result())[0]
+    if result.count > 0:
+        assignments = ', '.join(
+            f"{k} = '{v}'" if isinstance(v, str) else f"{k} = {v}"
+            for k, v in metric.items() if k not in ['id', 'aggregation_start', 'aggregation_end']
+        )
+        bq_client.query(f"UPDATE `{table_ref}` SET {assignments} WHERE {where}").result()
+    else:
+        bq_client.insert_rows_json(table_ref, [metric])
+
+def bench_upsert(args):
+    weeks = list(metrics_job.get_week_ranges(datetime(2025, 1, 5), datetime(2025, 1, 5) + timedelta(weeks=args.weeks)))
+    computed = {table_id: [] for table_id in metrics_job.metric_columns}
+    for agg_start, agg_end in weeks:
+        rows = metrics_job.build_weekly_metrics(agg_start, agg_end, (1.0, 2.0, 2.5, 9.0), (0.5, 0.9, 0.85, 1.0), 70, 30)
+        for table_id, row in zip(metrics_job.metric_columns, rows):
+            computed[table_id].append(row)
+
+    # Half of the weeks already exist, so the legacy path does both UPDATEs and inserts
+    existing = [f"{agg_start:%Y-%m-%d %H:%M:%S}" for agg_start, _ in weeks[::2]]
+
+    for label, upsert in (
+        ("per-row", lambda client: [
+            legacy_upsert_metrics(table_id, row, client) for table_id, rows in computed.items() for row in rows
+        ]),
+        ("merge", lambda client: [
+            metrics_job.upsert_metrics(table_id, rows, client) for table_id, rows in computed.items()
+        ]),
+    ):
+        client = FakeBigQueryClient(args.job_ms / 1000, existing)
+        start = time.perf_counter()
+        upsert(client)
+        seconds = time.perf_counter() - start
+        kinds = {}
+        for kind, detail in client.calls:
+            key = detail if kind == "query" else kind
+            kinds[key] = kinds.get(key, 0) + 1
+        print(f"{label:<8} weeks={len(weeks):<4} jobs={len(client.calls):<5} {seconds:7.2f} s  {kinds}")
+
+def bench_sketch(args):
+    rng = np.random.default_rng(args.seed)
+    sketches = [QuantileSketch().update(rng.lognormal(3.0, 0.4, args.values_per_sketch)) for _ in range(args.sketches)]
+    serialized = [sketch.to_json() for sketch in sketches]
+    for label, inputs in (("objects", sketches), ("json", serialized)):
+        start = time.perf_counter()
+        QuantileSketch.merge_all(inputs)
+        seconds = time.perf_counter() - start
+        print(f"merge_all {label:<8} {len(inputs)} sketches in {seconds * 1000:7.1f} ms  ({len(inputs) / seconds:,.0f} sketches/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sql = subparsers.add_parser("sql", help="SQL aggregation vs pandas latency on a DuckDB fixture")
+    sql.add_argument("--rows", type=int, default=50000, help="fixture inference_results rows")
+    sql.add_argument("--weeks", type=int, default=6, help="weeks the fixture spans")
+    sql.add_argument("--seed", type=int, default=0, help="fixture random seed")
+    sql.add_argument("--skip-alternate", action="store_true", help="aggregate every other week only")
+    sql.set_defaults(func=bench_sql)
+
+    upsert = subparsers.add_parser("upsert", help="jobs and latency of per-row vs MERGE metric upserts")
+    upsert.add_argument("--weeks", type=int, default=52, help="weeks of metric rows to write")
+    upsert.add_argument("--job-ms", type=float, default=800, help="simulated latency per BigQuery job")
+    upsert.set_defaults(func=bench_upsert)
+
+    sketch = subparsers.add_parser("sketch", help="quantile sketch merge throughput")
+    sketch.add_argument("--sketches", type=int, default=8760, help="sketches merged in the throughput run (a year of hours)")
+    sketch.add_argument("--values-per-sketch", type=int, default=200, help="values in each of those sketches")
+    sketch.add_argument("--seed", type=int, default=0, help="random seed")
+    sketch.set_defaults(func=bench_sketch)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# Cloud Functions imports the function's modules flat from its directory; the tests do the same
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
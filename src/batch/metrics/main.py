@@ -1,9 +1,14 @@
 from google.cloud import bigquery
 from datetime import datetime, timedelta, timezone
+import os
+import time
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from cloudevents.http import CloudEvent
 import functions_framework
 import pandas as pd
+from clients import client_stats, get_bigquery_client
+from sketch import QuantileSketch
 
 # Config
 project_id = "cast-defect-detection"
@@ -12,33 +17,124 @@ res_table_id = "inference_results"
 inf_metric_table_id = "inference_metrics"
 conf_metric_table_id = "confidencescore_metrics"
 pred_class_table_id = "prediction_class_metrics"
+state_table_id = "metrics_state"
+rollup_table_id = "metric_rollups"
+
+# incremental: fold only rows newer than each week's watermark into metrics_state (default)
+# full: re-read the whole week into pandas on every run
+# sql: aggregate all pending weeks server-side in one GROUP BY job
+aggregation_mode = os.environ.get("AGGREGATION_MODE", "incremental")
+
+# Rows newer than now minus this lag are left for the next run, so late streaming inserts are not skipped
+watermark_lag = timedelta(minutes=int(os.environ.get("WATERMARK_LAG_MINUTES", "5")))
+
+# Weeks computed concurrently when backfilling, written to BigQuery every backfill_flush_weeks weeks
+backfill_workers = int(os.environ.get("BACKFILL_WORKERS", "4"))
+backfill_flush_weeks = int(os.environ.get("BACKFILL_FLUSH_WEEKS", "8"))
+
+# No new week is started after this many seconds, so a run finishes within the function timeout;
+# weeks left over are still missing and get picked up by the next run
+backfill_time_budget = float(os.environ.get("BACKFILL_TIME_BUDGET_S", "420"))
+
+# Weeks whose metric rows were written before this UTC datetime (e.g. 2025-04-01T00:00:00) are recomputed
+force_update_since = os.environ.get("FORCE_UPDATE_SINCE")
+force_update_since = datetime.fromisoformat(force_update_since) if force_update_since else None
+
+state_column_types = {
+    "aggregation_start": "DATETIME", "aggregation_end": "DATETIME", "watermark": "DATETIME",
+    "row_count": "INT64", "pass_count": "INT64", "fail_count": "INT64",
+    "speed_sum": "FLOAT64", "speed_min": "FLOAT64", "speed_max": "FLOAT64", "speed_sketch": "STRING",
+    "conf_sum": "FLOAT64", "conf_min": "FLOAT64", "conf_max": "FLOAT64", "conf_sketch": "STRING",
+}
+state_columns = list(state_column_types)
+
+# Rollup granularities materialized into metric_rollups. Hourly rows are always written:
+# the end of the latest hourly row is where the next run continues from
+rollup_granularities = ["hour"] + [
+    g for g in os.environ.get("ROLLUP_GRANULARITIES", "day,week,month").split(",") if g and g != "hour"
+]
+
+rollup_column_types = {
+    "granularity": "STRING", "aggregation_start": "DATETIME", "aggregation_end": "DATETIME",
+    "row_count": "INT64", "pass_count": "INT64", "fail_count": "INT64",
+    "speed_sum": "FLOAT64", "speed_min": "FLOAT64", "speed_max": "FLOAT64",
+    "speed_mean": "FLOAT64", "speed_med": "FLOAT64", "speed_sketch": "STRING",
+    "conf_sum": "FLOAT64", "conf_min": "FLOAT64", "conf_max": "FLOAT64",
+    "conf_mean": "FLOAT64", "conf_med": "FLOAT64", "conf_sketch": "STRING",
+}
+
+# Engine-specific SQL for the weekly aggregation query, so it can be checked against a local DuckDB
+weekly_sql_dialects = {
+    "bigquery": {
+        "week_start": "DATETIME_TRUNC({col}, WEEK(SUNDAY))",
+        "median": "PERCENTILE_CONT({col}, 0.5)",
+        "param": "@{name}",
+        "in_array": "IN UNNEST({param})",
+        "bucket_struct": "STRUCT(bucket, n)",
+    },
+    "duckdb": {
+        "week_start": "DATE_TRUNC('week', {col} + INTERVAL 1 DAY) - INTERVAL 1 DAY",
+        "median": "QUANTILE_CONT({col}, 0.5)",
+        "param": "${name}",
+        "in_array": "IN (SELECT UNNEST({param}))",
+        "bucket_struct": "STRUCT_PACK(bucket, n)",
+    },
+}
+
+# Column types of the metric tables, used to build the MERGE parameters
+common_metric_columns = {
+    "id": "STRING", "insert_datetime": "DATETIME", "aggregation_start": "DATETIME", "aggregation_end": "DATETIME",
+}
+metric_columns = {
+    inf_metric_table_id: {
+        "inference_time_min": "FLOAT64", "inference_time_med": "FLOAT64",
+        "inference_time_mean": "FLOAT64", "inference_time_max": "FLOAT64", "inference_time_sketch": "STRING",
+    },
+    conf_metric_table_id: {
+        "confidence_score_min": "FLOAT64", "confidence_score_med": "FLOAT64",
+        "confidence_score_mean": "FLOAT64", "confidence_score_max": "FLOAT64", "confidence_score_sketch": "STRING",
+    },
+    pred_class_table_id: {"pred_class_pass_freq": "INT64", "pred_class_fail_freq": "INT64"},
+}
 
 UTC = timezone.utc
 
-def upsert_metrics(table_id, metric, bq_client):
-    table_ref = f"{project_id}.{dataset_id}.{table_id}"
-
-    # Check if record exists
-    check_query = f"""
-        SELECT COUNT(*) as count
-        FROM `{table_ref}`
-        WHERE aggregation_start = '{metric["aggregation_start"]}' AND aggregation_end = '{metric["aggregation_end"]}'
-    """
-    result = list(bq_client.query(check_query).result())[0]
-
-    if result.count > 0:
-        print(f"Updating existing row in {table_id} for week {metric['aggregation_start']} to {metric['aggregation_end']}")
-        update_query = f"""
-            UPDATE `{table_ref}`
-            SET
-              {', '.join(f"{k} = '{v}'" if isinstance(v, str) else f"{k} = {v}" for k, v in metric.items() if k not in ['id', 'aggregation_start', 'aggregation_end'])}
-            WHERE aggregation_start = '{metric["aggregation_start"]}' AND aggregation_end = '{metric["aggregation_end"]}'
-        """
-        bq_client.query(update_query).result()
+def rows_parameter(name, column_types, rows):
+    """Returns rows (dicts) as an ARRAY<STRUCT> query parameter with the given column types."""
+    return bigquery.ArrayQueryParameter(name, "STRUCT", [
+        bigquery.StructQueryParameter(None, *(
+            bigquery.ScalarQueryParameter(col, col_type, row[col]) for col, col_type in column_types.items()
+        ))
+        for row in rows
+    ])
+
+def upsert_metrics(table_id, metrics, bq_client):
+    """Upserts metric rows for any number of weeks into table_id with a single MERGE job.
+
+    Rows are passed as an ARRAY<STRUCT> query parameter and matched on the aggregation
+    range. Inserted rows are written by DML rather than the streaming API, so a later run
+    can update them straight away.
+    """
+    if not metrics:
+        return
 
-    else:
-        print(f"Inserting new row into {table_id} for week {metric['aggregation_start']} to {metric['aggregation_end']}")
-        bq_client.insert_rows_json(table_ref, [metric])
+    table_ref = f"{project_id}.{dataset_id}.{table_id}"
+    column_types = {**common_metric_columns, **metric_columns[table_id]}
+    update_columns = [col for col in column_types if col not in ("id", "aggregation_start", "aggregation_end")]
+
+    merge_query = f"""
+        MERGE `{table_ref}` T
+        USING (SELECT * FROM UNNEST(@rows)) S
+        ON T.aggregation_start = S.aggregation_start AND T.aggregation_end = S.aggregation_end
+        WHEN MATCHED THEN
+          UPDATE SET {', '.join(f"{col} = S.{col}" for col in update_columns)}
+        WHEN NOT MATCHED THEN
+          INSERT ({', '.join(column_types)})
+          VALUES ({', '.join(f"S.{col}" for col in column_types)})
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[rows_parameter("rows", column_types, metrics)])
+    bq_client.query(merge_query, job_config=job_config).result()
+    print(f"Merged {len(metrics)} rows into {table_id}")
 
 def get_week_start(date):
     offset = (date.weekday() + 1) % 7  # Sunday = 0
@@ -51,6 +147,47 @@ def get_week_ranges(start, end):
         yield (current, current + timedelta(days=7))
         current += timedelta(days=7)
 
+def build_weekly_metrics(agg_start, agg_end, speed_stats, conf_stats, pass_count, fail_count,
+                         speed_sketch=None, conf_sketch=None):
+    """Builds the three metric rows for a week from (min, median, mean, max) stats, class counts
+    and, when available, the quantile sketches of inference time and confidence."""
+    insert_time = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
+
+    common_fields = {
+        "insert_datetime": insert_time,
+        "aggregation_start": agg_start.strftime("%Y-%m-%d %H:%M:%S"),
+        "aggregation_end": agg_end.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    inf_metrics = {
+        "id": str(uuid.uuid4()),
+        "inference_time_min": float(speed_stats[0]),
+        "inference_time_med": float(speed_stats[1]),
+        "inference_time_mean": float(speed_stats[2]),
+        "inference_time_max": float(speed_stats[3]),
+        "inference_time_sketch": speed_sketch.to_json() if speed_sketch else None,
+        **common_fields
+    }
+
+    conf_metrics = {
+        "id": str(uuid.uuid4()),
+        "confidence_score_min": float(conf_stats[0]),
+        "confidence_score_med": float(conf_stats[1]),
+        "confidence_score_mean": float(conf_stats[2]),
+        "confidence_score_max": float(conf_stats[3]),
+        "confidence_score_sketch": conf_sketch.to_json() if conf_sketch else None,
+        **common_fields
+    }
+
+    class_metrics = {
+        "id": str(uuid.uuid4()),
+        "pred_class_pass_freq": int(pass_count),
+        "pred_class_fail_freq": int(fail_count),
+        **common_fields
+    }
+
+    return inf_metrics, conf_metrics, class_metrics
+
 def aggregate_weekly_metrics(bq_client, agg_start, agg_end):
     agg_start_str = agg_start.strftime("%Y-%m-%d %H:%M:%S")
     agg_end_str = agg_end.strftime("%Y-%m-%d %H:%M:%S")
@@ -70,45 +207,515 @@ def aggregate_weekly_metrics(bq_client, agg_start, agg_end):
         return None, None, None
 
     vc = df["pred_class"].value_counts().to_dict()
-    insert_time = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
+    speed = df["pred_speed"]
+    conf = df["pred_confidence"]
+
+    return build_weekly_metrics(
+        agg_start, agg_end,
+        (speed.min(), speed.median(), speed.mean(), speed.max()),
+        (conf.min(), conf.median(), conf.mean(), conf.max()),
+        vc.get("OK", 0), vc.get("Defect", 0),
+        QuantileSketch().update(speed.dropna()), QuantileSketch().update(conf.dropna()),
+    )
+
+def sketch_bins_sql(source, column, bucket_struct="STRUCT(bucket, n)"):
+    """Returns a query of (aggregation_start, bins): the sketch bucket counts of column per aggregation_start in source."""
+    return f"""
+          SELECT aggregation_start, ARRAY_AGG({bucket_struct}) AS bins
+          FROM (
+            SELECT aggregation_start, {QuantileSketch().bucket_sql(column)} AS bucket, COUNT(*) AS n
+            FROM {source}
+            WHERE {column} IS NOT NULL
+            GROUP BY aggregation_start, bucket
+          )
+          GROUP BY aggregation_start
+        """
 
-    common_fields = {
-        "insert_datetime": insert_time,
-        "aggregation_start": agg_start.strftime("%Y-%m-%d %H:%M:%S"),
-        "aggregation_end": agg_end.strftime("%Y-%m-%d %H:%M:%S"),
-    }
+def sketch_from_bins(bins):
+    """Builds a sketch from the bucket counts returned by sketch_bins_sql()."""
+    sketch = QuantileSketch()
+    for b in bins if bins is not None else []:
+        sketch.add_bucket(b["bucket"], b["n"])
+    return sketch
 
-    inf_metrics = {
-        "id": str(uuid.uuid4()),
-        "inference_time_min": df["pred_speed"].min(),
-        "inference_time_med": df["pred_speed"].median(),
-        "inference_time_mean": df["pred_speed"].mean(),
-        "inference_time_max": df["pred_speed"].max(),
-        **common_fields
-    }
+def weekly_metrics_sql(table_ref, dialect="bigquery"):
+    """Returns a query computing one row of weekly statistics per pending week.
 
-    conf_metrics = {
-        "id": str(uuid.uuid4()),
-        "confidence_score_min": df["pred_confidence"].min(),
-        "confidence_score_med": df["pred_confidence"].median(),
-        "confidence_score_mean": df["pred_confidence"].mean(),
-        "confidence_score_max": df["pred_confidence"].max(),
-        **common_fields
-    }
+    Parameters: range_start and range_end (DATETIME) bound the scan, week_starts (ARRAY of
+    DATETIME) selects the weeks. Medians are exact (PERCENTILE_CONT) so they match pandas;
+    the sketches come back as bucket counts.
+    """
+    sql = weekly_sql_dialects[dialect]
+    param = lambda name: sql["param"].format(name=name)
+    median = lambda col: sql["median"].format(col=col) + " OVER (PARTITION BY aggregation_start)"
+
+    return f"""
+        WITH pending AS (
+          SELECT * FROM (
+            SELECT {sql["week_start"].format(col="res_insert_datetime")} AS aggregation_start,
+                   pred_class, pred_confidence, pred_speed
+            FROM {table_ref}
+            WHERE res_insert_datetime >= {param("range_start")}
+              AND res_insert_datetime < {param("range_end")}
+          )
+          WHERE aggregation_start {sql["in_array"].format(param=param("week_starts"))}
+        ),
+        medians AS (
+          SELECT DISTINCT aggregation_start,
+                 {median("pred_speed")} AS speed_med,
+                 {median("pred_confidence")} AS conf_med
+          FROM pending
+        ),
+        stats AS (
+          SELECT aggregation_start,
+                 MIN(pred_speed) AS speed_min, ANY_VALUE(speed_med) AS speed_med,
+                 AVG(pred_speed) AS speed_mean, MAX(pred_speed) AS speed_max,
+                 MIN(pred_confidence) AS conf_min, ANY_VALUE(conf_med) AS conf_med,
+                 AVG(pred_confidence) AS conf_mean, MAX(pred_confidence) AS conf_max,
+                 COUNTIF(pred_class = 'OK') AS pass_count,
+                 COUNTIF(pred_class = 'Defect') AS fail_count
+          FROM pending JOIN medians USING (aggregation_start)
+          GROUP BY aggregation_start
+        ),
+        speed_bins AS ({sketch_bins_sql("pending", "pred_speed", sql["bucket_struct"])}),
+        conf_bins AS ({sketch_bins_sql("pending", "pred_confidence", sql["bucket_struct"])})
+        SELECT stats.*, speed_bins.bins AS speed_bins, conf_bins.bins AS conf_bins
+        FROM stats
+        LEFT JOIN speed_bins USING (aggregation_start)
+        LEFT JOIN conf_bins USING (aggregation_start)
+        ORDER BY aggregation_start
+    """
 
-    class_metrics = {
-        "id": str(uuid.uuid4()),
-        "pred_class_pass_freq": vc.get("OK", 0),
-        "pred_class_fail_freq": vc.get("Defect", 0),
-        **common_fields
+def metrics_from_sql_row(row):
+    """Builds the three metric rows for a week from a weekly_metrics_sql() result row."""
+    agg_start = row["aggregation_start"]
+    return build_weekly_metrics(
+        agg_start, agg_start + timedelta(days=7),
+        (row["speed_min"], row["speed_med"], row["speed_mean"], row["speed_max"]),
+        (row["conf_min"], row["conf_med"], row["conf_mean"], row["conf_max"]),
+        row["pass_count"], row["fail_count"],
+        sketch_from_bins(row["speed_bins"]), sketch_from_bins(row["conf_bins"]),
+    )
+
+def aggregate_weeks_sql(bq_client, weeks):
+    """Aggregates all weeks in BigQuery with a single query; returns {(agg_start, agg_end): metric rows}.
+
+    Only one row per week comes back, so memory no longer grows with the number of inspections.
+    """
+    if not weeks:
+        return {}
+
+    query = weekly_metrics_sql(f"`{project_id}.{dataset_id}.{res_table_id}`")
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("range_start", "DATETIME", min(start for start, _ in weeks)),
+        bigquery.ScalarQueryParameter("range_end", "DATETIME", max(end for _, end in weeks)),
+        bigquery.ArrayQueryParameter("week_starts", "DATETIME", [start for start, _ in weeks]),
+    ])
+    rows = bq_client.query(query, job_config=job_config).result()
+
+    metrics = {}
+    for row in rows:
+        row = dict(row.items())
+        metrics[(row["aggregation_start"], row["aggregation_start"] + timedelta(days=7))] = metrics_from_sql_row(row)
+    print(f"Aggregated {len(metrics)} of {len(weeks)} weeks in BigQuery")
+    return metrics
+
+def new_week_state(agg_start, agg_end):
+    """Returns empty partial aggregates for a week, with the watermark at the week start."""
+    return {
+        "aggregation_start": agg_start,
+        "aggregation_end": agg_end,
+        "watermark": agg_start,
+        "row_count": 0,
+        "pass_count": 0,
+        "fail_count": 0,
+        "speed_sum": 0.0,
+        "speed_min": None,
+        "speed_max": None,
+        "speed_sketch": QuantileSketch(),
+        "conf_sum": 0.0,
+        "conf_min": None,
+        "conf_max": None,
+        "conf_sketch": QuantileSketch(),
     }
 
-    return inf_metrics, conf_metrics, class_metrics
+def load_week_state(bq_client, agg_start, agg_end):
+    """Loads the persisted partial aggregates for a week, or empty ones if there are none yet."""
+    query = f"""
+        SELECT {', '.join(state_columns)}
+        FROM `{project_id}.{dataset_id}.{state_table_id}`
+        WHERE aggregation_start = @agg_start AND aggregation_end = @agg_end
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("agg_start", "DATETIME", agg_start),
+        bigquery.ScalarQueryParameter("agg_end", "DATETIME", agg_end),
+    ])
+    rows = list(bq_client.query(query, job_config=job_config).result())
+    if not rows:
+        return new_week_state(agg_start, agg_end)
+
+    state = dict(rows[0].items())
+    state["speed_sketch"] = QuantileSketch.from_json(state["speed_sketch"])
+    state["conf_sketch"] = QuantileSketch.from_json(state["conf_sketch"])
+    return state
+
+def load_state_watermarks(bq_client, start_datetime):
+    """Returns the watermark of every week with persisted partial aggregates, keyed on (agg_start, agg_end)."""
+    query = f"""
+        SELECT aggregation_start, aggregation_end, watermark
+        FROM `{project_id}.{dataset_id}.{state_table_id}`
+        WHERE aggregation_start >= @start_datetime
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("start_datetime", "DATETIME", start_datetime),
+    ])
+    rows = bq_client.query(query, job_config=job_config).result()
+    return {(row.aggregation_start, row.aggregation_end): row.watermark for row in rows}
+
+def save_week_states(bq_client, states):
+    """Upserts the partial aggregates of any number of weeks into the state table with one MERGE."""
+    if not states:
+        return
+
+    rows = [
+        {**state, "speed_sketch": state["speed_sketch"].to_json(), "conf_sketch": state["conf_sketch"].to_json()}
+        for state in states
+    ]
+    update_columns = [col for col in state_columns if col not in ("aggregation_start", "aggregation_end")]
+
+    merge_query = f"""
+        MERGE `{project_id}.{dataset_id}.{state_table_id}` T
+        USING (SELECT * FROM UNNEST(@states)) S
+        ON T.aggregation_start = S.aggregation_start AND T.aggregation_end = S.aggregation_end
+        WHEN MATCHED THEN
+          UPDATE SET {', '.join(f"{col} = S.{col}" for col in update_columns)}, update_datetime = CURRENT_DATETIME()
+        WHEN NOT MATCHED THEN
+          INSERT ({', '.join(state_columns)}, update_datetime)
+          VALUES ({', '.join(f"S.{col}" for col in state_columns)}, CURRENT_DATETIME())
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[rows_parameter("states", state_column_types, rows)])
+    bq_client.query(merge_query, job_config=job_config).result()
+
+def fold_rows(state, df):
+    """Merges newly fetched result rows into a week's partial aggregates."""
+    vc = df["pred_class"].value_counts().to_dict()
+    state["row_count"] += len(df)
+    state["pass_count"] += int(vc.get("OK", 0))
+    state["fail_count"] += int(vc.get("Defect", 0))
+
+    for prefix, column in (("speed", "pred_speed"), ("conf", "pred_confidence")):
+        values = df[column].dropna()
+        if values.empty:
+            continue
+        state[f"{prefix}_sum"] += float(values.sum())
+        state[f"{prefix}_min"] = min(v for v in (state[f"{prefix}_min"], float(values.min())) if v is not None)
+        state[f"{prefix}_max"] = max(v for v in (state[f"{prefix}_max"], float(values.max())) if v is not None)
+        state[f"{prefix}_sketch"].update(values)
+    return state
+
+def metrics_from_state(state):
+    """Builds the three metric rows from a week's partial aggregates."""
+    speed_sketch, conf_sketch = state["speed_sketch"], state["conf_sketch"]
+    if not speed_sketch.count or not conf_sketch.count:
+        return None, None, None
+
+    return build_weekly_metrics(
+        state["aggregation_start"], state["aggregation_end"],
+        (state["speed_min"], speed_sketch.quantile(0.5), state["speed_sum"] / speed_sketch.count, state["speed_max"]),
+        (state["conf_min"], conf_sketch.quantile(0.5), state["conf_sum"] / conf_sketch.count, state["conf_max"]),
+        state["pass_count"], state["fail_count"],
+        speed_sketch, conf_sketch,
+    )
+
+def advance_week_state(bq_client, agg_start, agg_end, now_utc, rebuild=False):
+    """Folds only the rows added since the week's watermark into its partial aggregates.
+
+    The cost of a run is proportional to the rows inserted since the previous run rather
+    than to the week so far. rebuild=True discards the state and starts from the week start.
+    Returns (state, changed); the caller saves changed states with save_week_states().
+    """
+    state = new_week_state(agg_start, agg_end) if rebuild else load_week_state(bq_client, agg_start, agg_end)
+    upper = min(agg_end, now_utc - watermark_lag)
+
+    if upper <= state["watermark"]:
+        return state, False
+
+    result_query = f"""
+        SELECT pred_class, pred_confidence, pred_speed
+        FROM `{project_id}.{dataset_id}.{res_table_id}`
+        WHERE res_insert_datetime >= @from_datetime
+          AND res_insert_datetime < @to_datetime
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("from_datetime", "DATETIME", state["watermark"]),
+        bigquery.ScalarQueryParameter("to_datetime", "DATETIME", upper),
+    ])
+    df = bq_client.query(result_query, job_config=job_config).result().to_dataframe()
+    print(f"Fetched {len(df)} new rows from {state['watermark']} to {upper} (UTC)")
+
+    if not df.empty:
+        fold_rows(state, df)
+    state["watermark"] = upper
+    return state, True
+
+def compute_week(bq_client, agg_start, agg_end, now_utc, rebuild=False):
+    """Computes a week's metric rows with the configured aggregation mode.
+
+    Returns (metric rows, state to save), the state being None unless it changed in incremental mode.
+    """
+    if aggregation_mode != "incremental":
+        return aggregate_weekly_metrics(bq_client, agg_start, agg_end), None
+
+    state, changed = advance_week_state(bq_client, agg_start, agg_end, now_utc, rebuild)
+    if not state["row_count"]:
+        print(f"⚠️ No data found between {agg_start} and {agg_end}. Skipping this week.")
+        return (None, None, None), state if changed else None
+    return metrics_from_state(state), state if changed else None
+
+def write_weeks(bq_client, weekly_metrics, states=()):
+    """Upserts the metric rows of all weeks with one MERGE per table, then saves changed week states.
+
+    States go last: if a MERGE fails, the weeks keep their previous watermark and are
+    folded again by the next run, which gives the same result as the state not saved.
+    """
+    computed = {table_id: [] for table_id in metric_columns}
+    for week_metrics in weekly_metrics:
+        for table_id, metric in zip(metric_columns, week_metrics):
+            if metric:
+                computed[table_id].append(metric)
+
+    for table_id, metrics in computed.items():
+        if metrics:
+            upsert_metrics(table_id, metrics, bq_client)
+            print(f"✅ {len(metrics)} weeks of {table_id} inserted or updated.")
+
+    save_week_states(bq_client, list(states))
+
+def backfill_weeks(bq_client, weeks, now_utc, rebuild_weeks, deadline):
+    """Computes weeks on backfill_workers threads and writes them every backfill_flush_weeks weeks.
+
+    Stops starting new weeks once time.monotonic() passes deadline. Written weeks are no
+    longer missing, so the next run resumes with the rest. Returns the number of weeks left.
+    """
+    remaining = list(weeks)
+    in_flight = {}
+    done = 0
+    weekly_metrics, states = [], []
+
+    with ThreadPoolExecutor(max_workers=backfill_workers, thread_name_prefix="backfill") as pool:
+        while remaining or in_flight:
+            while remaining and len(in_flight) < backfill_workers and time.monotonic() < deadline:
+                agg_start, agg_end = remaining.pop(0)
+                future = pool.submit(
+                    compute_week, bq_client, agg_start, agg_end, now_utc, (agg_start, agg_end) in rebuild_weeks
+                )
+                in_flight[future] = (agg_start, agg_end)
+            if not in_flight:
+                break
+
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                agg_start, agg_end = in_flight.pop(future)
+                week_metrics, state = future.result()
+                weekly_metrics.append(week_metrics)
+                if state:
+                    states.append(state)
+                done += 1
+                print(f"[{done}/{len(weeks)}] Computed week {agg_start} to {agg_end}")
+
+            if len(weekly_metrics) >= backfill_flush_weeks or not (remaining or in_flight):
+                write_weeks(bq_client, weekly_metrics, states)
+                weekly_metrics, states = [], []
+
+    write_weeks(bq_client, weekly_metrics, states)
+    if remaining:
+        print(f"⏱️ Time budget of {backfill_time_budget}s used up, {len(remaining)} weeks left for the next run.")
+    return len(remaining)
+
+def get_period(granularity, date):
+    """Returns the (start, end) of the hour, day, week (Sunday-anchored) or month containing date."""
+    if granularity == "hour":
+        start = date.replace(minute=0, second=0, microsecond=0)
+        return start, start + timedelta(hours=1)
+    if granularity == "day":
+        start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        return start, start + timedelta(days=1)
+    if granularity == "week":
+        start = get_week_start(date)
+        return start, start + timedelta(days=7)
+    if granularity == "month":
+        start = date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    raise ValueError(f"Error: Unknown rollup granularity '{granularity}'.")
+
+def merge_partials(target, source):
+    """Merges the counts, sums, min/max and sketches of source into target (rollup or week state dicts)."""
+    for col in ("row_count", "pass_count", "fail_count", "speed_sum", "conf_sum"):
+        target[col] += source[col]
+    for prefix in ("speed", "conf"):
+        target[f"{prefix}_min"] = min((v for v in (target[f"{prefix}_min"], source[f"{prefix}_min"]) if v is not None), default=None)
+        target[f"{prefix}_max"] = max((v for v in (target[f"{prefix}_max"], source[f"{prefix}_max"]) if v is not None), default=None)
+        target[f"{prefix}_sketch"].merge(source[f"{prefix}_sketch"])
+    return target
+
+def new_rollup(granularity, agg_start, agg_end):
+    rollup = new_week_state(agg_start, agg_end)
+    del rollup["watermark"]
+    rollup["granularity"] = granularity
+    return rollup
+
+def hourly_rollup_sql():
+    """Returns a query with one row of partial aggregates per hour in [@from_datetime, @to_datetime).
+
+    The quantile sketches are bucketed in BigQuery, so only bucket counts per hour come back
+    rather than the result rows themselves.
+    """
+    return f"""
+        WITH results AS (
+          SELECT DATETIME_TRUNC(res_insert_datetime, HOUR) AS aggregation_start,
+                 pred_class, pred_confidence, pred_speed
+          FROM `{project_id}.{dataset_id}.{res_table_id}`
+          WHERE res_insert_datetime >= @from_datetime
+            AND res_insert_datetime < @to_datetime
+        ),
+        stats AS (
+          SELECT aggregation_start,
+                 COUNT(*) AS row_count,
+                 COUNTIF(pred_class = 'OK') AS pass_count,
+                 COUNTIF(pred_class = 'Defect') AS fail_count,
+                 IFNULL(SUM(pred_speed), 0) AS speed_sum, MIN(pred_speed) AS speed_min, MAX(pred_speed) AS speed_max,
+                 IFNULL(SUM(pred_confidence), 0) AS conf_sum, MIN(pred_confidence) AS conf_min, MAX(pred_confidence) AS conf_max
+          FROM results
+          GROUP BY aggregation_start
+        ),
+        speed_bins AS ({sketch_bins_sql("results", "pred_speed")}),
+        conf_bins AS ({sketch_bins_sql("results", "pred_confidence")})
+        SELECT stats.*, speed_bins.bins AS speed_bins, conf_bins.bins AS conf_bins
+        FROM stats
+        LEFT JOIN speed_bins USING (aggregation_start)
+        LEFT JOIN conf_bins USING (aggregation_start)
+        ORDER BY aggregation_start
+    """
+
+def rollup_from_row(row):
+    """Builds an hourly rollup from a hourly_rollup_sql() result row."""
+    rollup = new_rollup("hour", *get_period("hour", row["aggregation_start"]))
+    for col in ("row_count", "pass_count", "fail_count", "speed_sum", "speed_min", "speed_max",
+                "conf_sum", "conf_min", "conf_max"):
+        rollup[col] = row[col]
+    rollup["speed_sketch"] = sketch_from_bins(row["speed_bins"])
+    rollup["conf_sketch"] = sketch_from_bins(row["conf_bins"])
+    return rollup
+
+def load_rollup_watermark(bq_client):
+    """Returns the end of the latest hourly rollup, or None if there is none yet."""
+    query = f"""
+        SELECT MAX(aggregation_end) AS watermark
+        FROM `{project_id}.{dataset_id}.{rollup_table_id}`
+        WHERE granularity = 'hour'
+    """
+    return list(bq_client.query(query).result())[0].watermark
+
+def load_rollups(bq_client, granularities, since):
+    """Loads the rollups of granularities starting at or after since, keyed by (granularity, aggregation_start)."""
+    query = f"""
+        SELECT {', '.join(col for col in rollup_column_types if not col.endswith(("_mean", "_med")))}
+        FROM `{project_id}.{dataset_id}.{rollup_table_id}`
+        WHERE granularity IN UNNEST(@granularities) AND aggregation_start >= @since
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("granularities", "STRING", granularities),
+        bigquery.ScalarQueryParameter("since", "DATETIME", since),
+    ])
+    rollups = {}
+    for row in bq_client.query(query, job_config=job_config).result():
+        rollup = dict(row.items())
+        rollup["speed_sketch"] = QuantileSketch.from_json(rollup["speed_sketch"])
+        rollup["conf_sketch"] = QuantileSketch.from_json(rollup["conf_sketch"])
+        rollups[(rollup["granularity"], rollup["aggregation_start"])] = rollup
+    return rollups
+
+def save_rollups(bq_client, rollups):
+    """Upserts rollups of any granularity into the rollup table with one MERGE."""
+    if not rollups:
+        return
+
+    rows = []
+    for rollup in rollups:
+        row = {**rollup, "speed_sketch": rollup["speed_sketch"].to_json(), "conf_sketch": rollup["conf_sketch"].to_json()}
+        for prefix in ("speed", "conf"):
+            sketch = rollup[f"{prefix}_sketch"]
+            row[f"{prefix}_mean"] = rollup[f"{prefix}_sum"] / sketch.count if sketch.count else None
+            row[f"{prefix}_med"] = sketch.quantile(0.5)
+        rows.append(row)
+
+    columns = list(rollup_column_types)
+    update_columns = [col for col in columns if col not in ("granularity", "aggregation_start")]
+    merge_query = f"""
+        MERGE `{project_id}.{dataset_id}.{rollup_table_id}` T
+        USING (SELECT * FROM UNNEST(@rollups)) S
+        ON T.granularity = S.granularity AND T.aggregation_start = S.aggregation_start
+        WHEN MATCHED THEN
+          UPDATE SET {', '.join(f"{col} = S.{col}" for col in update_columns)}, update_datetime = CURRENT_DATETIME()
+        WHEN NOT MATCHED THEN
+          INSERT ({', '.join(columns)}, update_datetime)
+          VALUES ({', '.join(f"S.{col}" for col in columns)}, CURRENT_DATETIME())
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[rows_parameter("rollups", rollup_column_types, rows)])
+    bq_client.query(merge_query, job_config=job_config).result()
+
+def update_rollups(bq_client, min_datetime, now_utc):
+    """Rolls the complete hours since the last run up into every configured granularity.
+
+    New hours are aggregated server-side into mergeable partials (counts, sums, min/max and
+    quantile sketches), then merged into the day, week and month rows that contain them.
+    Each month of hours is written with its coarser rows in one MERGE, so the hourly
+    watermark never gets ahead of the rollups built from it.
+    """
+    watermark = load_rollup_watermark(bq_client) or get_period("hour", min_datetime)[0]
+    upper = get_period("hour", now_utc - watermark_lag)[0]
+    if upper <= watermark:
+        print(f"Rollups are up to date until {watermark}")
+        return
+
+    coarse_granularities = rollup_granularities[1:]
+    since = min((get_period(g, watermark)[0] for g in coarse_granularities), default=watermark)
+    coarse = load_rollups(bq_client, coarse_granularities, since)
+
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("from_datetime", "DATETIME", watermark),
+        bigquery.ScalarQueryParameter("to_datetime", "DATETIME", upper),
+    ])
+    rows = bq_client.query(hourly_rollup_sql(), job_config=job_config).result()
+
+    hours, changed, month = [], {}, None
+    for row in rows:
+        hour = rollup_from_row(dict(row.items()))
+        hour_month = get_period("month", hour["aggregation_start"])[0]
+        if hours and hour_month != month:
+            save_rollups(bq_client, hours + list(changed.values()))
+            print(f"Rolled up {len(hours)} hours of {month:%Y-%m} into {len(changed)} {'/'.join(coarse_granularities)} rows")
+            hours, changed = [], {}
+        month = hour_month
+        hours.append(hour)
+
+        for granularity in coarse_granularities:
+            agg_start, agg_end = get_period(granularity, hour["aggregation_start"])
+            key = (granularity, agg_start)
+            if key not in coarse:
+                coarse[key] = new_rollup(granularity, agg_start, agg_end)
+            changed[key] = merge_partials(coarse[key], hour)
+
+    if hours:
+        save_rollups(bq_client, hours + list(changed.values()))
+        print(f"Rolled up {len(hours)} hours of {month:%Y-%m} into {len(changed)} {'/'.join(coarse_granularities)} rows")
+    else:
+        print(f"No new results between {watermark} and {upper} to roll up")
 
 def get_existing_agg_ranges(bq_client, start_datetime):
     """
     Query all tables for aggregation ranges starting from a specific datetime.
-    Returns a dictionary of sets containing (agg_start, agg_end) tuples for each table.
+    Returns a dictionary per table mapping (agg_start, agg_end) to the row's latest insert_datetime.
     """
     tables = {
         "inference": inf_metric_table_id,
@@ -121,9 +728,10 @@ def get_existing_agg_ranges(bq_client, start_datetime):
 
     for table_name, table_id in tables.items():
         query = f"""
-            SELECT DISTINCT aggregation_start, aggregation_end
+            SELECT aggregation_start, aggregation_end, MAX(insert_datetime) AS insert_datetime
             FROM `{project_id}.{dataset_id}.{table_id}`
             WHERE aggregation_start >= '{start_dt}'
+            GROUP BY aggregation_start, aggregation_end
             ORDER BY aggregation_start
         """
         
@@ -131,7 +739,7 @@ def get_existing_agg_ranges(bq_client, start_datetime):
         
         print(f"Fetched agg range from {start_dt} from {table_name} table")
 
-        existing_ranges[table_name] = set((row.aggregation_start, row.aggregation_end) for row in result)
+        existing_ranges[table_name] = {(row.aggregation_start, row.aggregation_end): row.insert_datetime for row in result}
     
     return existing_ranges        # Check if the week range already exists in any of the tables
 
@@ -152,10 +760,64 @@ def is_agg_week_missing(week_start, week_end, existing_ranges):
     print(f"Week {week_start} to {week_end} exists in all tables")
     return False # Week exists from all tables
 
+def is_agg_week_stale(week_start, week_end, existing_ranges, since):
+    """
+    Check if a week's rows in any of the aggregated tables were written before since.
+    Weeks that are recomputed get a new insert_datetime, so a forced update can resume across runs.
+    """
+    if since is None:
+        return False
+
+    target = (week_start, week_end)
+    return any(
+        target in ranges and (ranges[target] is None or ranges[target] < since)
+        for ranges in existing_ranges.values()
+    )
+
+def is_agg_week_unsealed(week_start, week_end, existing_ranges, state_watermarks):
+    """
+    Check if a week's metrics may be missing rows from before its end.
+    A week with partial aggregates is unsealed until its watermark reaches the week end,
+    which covers the rows between the last run of the week (less watermark_lag) and the
+    week boundary. A week without them (written in full or sql mode) is unsealed if it
+    was last written before week_end + watermark_lag.
+    """
+    target = (week_start, week_end)
+    if target in state_watermarks:
+        return state_watermarks[target] < week_end
+    return any(
+        ranges.get(target) is not None and ranges[target] < week_end + watermark_lag
+        for ranges in existing_ranges.values()
+    )
+
+def get_pending_weeks(min_datetime, now_utc, existing_ranges, state_watermarks):
+    """
+    Plan the weeks between min_datetime and now_utc that need computing: missing, stale,
+    current or unsealed ones. Returns (pending weeks, stale weeks to rebuild).
+    """
+    pending_weeks = []
+    stale_weeks = set()
+    for agg_start, agg_end in get_week_ranges(min_datetime, now_utc):  # Iterate over weeks between min_datetime and now_utc
+
+        is_missing = is_agg_week_missing(agg_start, agg_end, existing_ranges) # Check if the week range already exists in any of the tables
+        is_stale = is_agg_week_stale(agg_start, agg_end, existing_ranges, force_update_since) # Check if the week was written before FORCE_UPDATE_SINCE
+        is_current_week = now_utc >= agg_start and agg_end > now_utc # Check if the week is current week
+        is_unsealed = is_agg_week_unsealed(agg_start, agg_end, existing_ranges, state_watermarks) # Check if rows up to the week end may not be folded in yet
+        if not is_missing and not is_stale and not is_current_week and not is_unsealed:
+            print(f"Skipping week {agg_start} to {agg_end} processing. Flag is_missing: {is_missing}, is_stale: {is_stale}, current_week: {is_current_week}, unsealed: {is_unsealed}")
+            continue
+
+        print(f"Processing week: {agg_start} to {agg_end} for all metrics. Flag is_missing: {is_missing}, is_stale: {is_stale}, current_week: {is_current_week}, unsealed: {is_unsealed}")
+        pending_weeks.append((agg_start, agg_end))
+        if is_stale:
+            stale_weeks.add((agg_start, agg_end))
+    return pending_weeks, stale_weeks
+
 @functions_framework.cloud_event
 def subscribe(cloud_event: CloudEvent) -> None:
     print(f"Triggered by event ID: {cloud_event['id']}")
-    bq_client = bigquery.Client(project=project_id)
+    started = time.monotonic()
+    bq_client = get_bigquery_client()
 
     try:
         oldest_query = f"""
@@ -174,35 +836,26 @@ def subscribe(cloud_event: CloudEvent) -> None:
         now_utc = datetime.now(UTC).replace(tzinfo=None)
 
         existing_ranges = get_existing_agg_ranges(bq_client, get_week_start(min_datetime)) # Get existing aggregation ranges from all tables
+        state_watermarks = load_state_watermarks(bq_client, get_week_start(min_datetime)) if aggregation_mode == "incremental" else {}
 
-        force_update = False # Set to True to force update all weeks
+        pending_weeks, stale_weeks = get_pending_weeks(min_datetime, now_utc, existing_ranges, state_watermarks)
 
-        for agg_start, agg_end in get_week_ranges(min_datetime, now_utc):  # Iterate over weeks between min_datetime and now_utc
+        print(f"Planned {len(pending_weeks)} weeks ({len(stale_weeks)} forced) with {aggregation_mode} aggregation")
 
-            is_missing = is_agg_week_missing(agg_start, agg_end, existing_ranges) # Check if the week range already exists in any of the tables
-            is_current_week = now_utc >= agg_start and agg_end > now_utc # Check if the week is current week
-            if not is_missing and not force_update and not is_current_week: 
-                print(f"Skipping week {agg_start} to {agg_end} processing. Flag is_missing: {is_missing}, force_update: {force_update}, current_week: {is_current_week}")
-                continue
+        if aggregation_mode == "sql":
+            sql_metrics = aggregate_weeks_sql(bq_client, pending_weeks)
+            for agg_start, agg_end in pending_weeks:
+                if (agg_start, agg_end) not in sql_metrics:
+                    print(f"⚠️ No data found between {agg_start} and {agg_end}. Skipping this week.")
+            write_weeks(bq_client, sql_metrics.values())
+        else:
+            backfill_weeks(bq_client, pending_weeks, now_utc, stale_weeks, started + backfill_time_budget)
 
-            print(f"Processing week: {agg_start} to {agg_end} for all metrics. Flag is_missing: {is_missing}, force_update: {force_update}, current_week: {is_current_week}")
-
-            inf_metrics, conf_metrics, class_metrics = aggregate_weekly_metrics(
-                bq_client, agg_start, agg_end
-            )
-
-            if inf_metrics:
-                upsert_metrics(inf_metric_table_id, inf_metrics, bq_client)
-                print("✅ Inference metrics inserted or updated.")
-            
-            if conf_metrics:
-                 upsert_metrics(conf_metric_table_id, conf_metrics, bq_client)
-                 print("✅ Confidence metrics inserted or updated.")
-            
-            if class_metrics:
-                upsert_metrics(pred_class_table_id, class_metrics, bq_client)
-                print("✅ Prediction class metrics inserted or updated.")
+        update_rollups(bq_client, min_datetime, now_utc)
 
     except Exception as e:
         print(f" Error during metrics processing: {e}")
         raise
+
+    finally:
+        print(f"Client stats: {client_stats()}")
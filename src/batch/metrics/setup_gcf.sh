@@ -6,4 +6,5 @@ gcloud functions deploy batch_metric_analytic \
     --source=. \
     --entry-point=subscribe \
     --trigger-topic=metric-calc-topic \
-    --memory=1Gi
\ No newline at end of file
+    --memory=1Gi \
+    --timeout=540s
\ No newline at end of file
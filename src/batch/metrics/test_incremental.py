@@ -0,0 +1,130 @@
+"""Incremental aggregation across scheduled runs, on a fake BigQuery client.
+
+    pip install pytest
+    python -m pytest test_incremental.py
+"""
+import copy
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+import main as metrics_job
+
+week_start = datetime(2025, 3, 2)  # A Sunday
+week_end = week_start + timedelta(days=7)
+
+class FakeResult:
+    def __init__(self, df):
+        self.df = df
+
+    def result(self):
+        return self
+
+    def to_dataframe(self):
+        return self.df
+
+class FakeBigQueryClient:
+    """Answers the inference_results reads of advance_week_state() from a DataFrame."""
+
+    def __init__(self, results):
+        self.results = results
+
+    def query(self, query, job_config=None):
+        params = {p.name: p.value for p in job_config.query_parameters}
+        inserted = self.results["res_insert_datetime"]
+        rows = self.results[(inserted >= params["from_datetime"]) & (inserted < params["to_datetime"])]
+        return FakeResult(rows.drop(columns="res_insert_datetime").reset_index(drop=True))
+
+def make_results(rows, seed=0):
+    """Rows spread over the week and the first day after it, dense around the week boundary."""
+    rng = np.random.default_rng(seed)
+    offsets = np.concatenate([rng.uniform(0, 8 * 86400, rows), rng.uniform(-600, 600, rows // 10)])
+    return pd.DataFrame({
+        "res_insert_datetime": [week_end + timedelta(seconds=float(s) - 7 * 86400) for s in offsets],
+        "pred_class": rng.choice(["OK", "Defect"], len(offsets)),
+        "pred_confidence": rng.beta(8, 2, len(offsets)),
+        "pred_speed": rng.lognormal(3.0, 0.4, len(offsets)),
+    })
+
+def run_schedule(results, runs, monkeypatch, failing_runs=()):
+    """Plans, computes and writes weeks at each run time like subscribe() does, keeping states and metric rows in memory.
+
+    The metric MERGE of the runs in failing_runs raises. Returns (states, pred_class rows) by week.
+    """
+    saved_states = {}
+    metric_rows = {}
+    written = {}
+    monkeypatch.setattr(metrics_job, "load_week_state", lambda _, agg_start, agg_end: copy.deepcopy(
+        saved_states.get((agg_start, agg_end)) or metrics_job.new_week_state(agg_start, agg_end)
+    ))
+    monkeypatch.setattr(metrics_job, "save_week_states", lambda _, states: saved_states.update(
+        {(state["aggregation_start"], state["aggregation_end"]): copy.deepcopy(state) for state in states}
+    ))
+    bq_client = FakeBigQueryClient(results)
+    min_datetime = results["res_insert_datetime"].min()
+
+    for now_utc in runs:
+        def upsert_metrics(table_id, metrics, _):
+            if now_utc in failing_runs:
+                raise TimeoutError("Error: MERGE job timed out")
+            for metric in metrics:
+                week = (datetime.fromisoformat(metric["aggregation_start"]), datetime.fromisoformat(metric["aggregation_end"]))
+                written[week] = now_utc
+                if table_id == metrics_job.pred_class_table_id:
+                    metric_rows[week] = metric
+        monkeypatch.setattr(metrics_job, "upsert_metrics", upsert_metrics)
+
+        existing_ranges = {"inference": dict(written)}
+        state_watermarks = {week: state["watermark"] for week, state in saved_states.items()}
+        pending_weeks, _ = metrics_job.get_pending_weeks(min_datetime, now_utc, existing_ranges, state_watermarks)
+        for week in pending_weeks:
+            metrics, state = metrics_job.compute_week(bq_client, *week, now_utc)
+            try:
+                metrics_job.write_weeks(bq_client, [metrics], [state] if state else [])
+            except TimeoutError:
+                pass  # The run fails; the next one retries
+    return saved_states, metric_rows
+
+def exact_count(results):
+    inserted = results["res_insert_datetime"]
+    return int(((inserted >= week_start) & (inserted < week_end)).sum())
+
+@pytest.mark.parametrize("last_run_before_end", [timedelta(minutes=1), timedelta(minutes=3), timedelta(hours=2)])
+def test_closed_week_counts_every_row(last_run_before_end, monkeypatch):
+    results = make_results(5000)
+    runs = [week_end - timedelta(days=3), week_end - last_run_before_end, week_end + timedelta(hours=1), week_end + timedelta(hours=2)]
+
+    saved_states, metric_rows = run_schedule(results, runs, monkeypatch)
+
+    state = saved_states[(week_start, week_end)]
+    assert state["watermark"] == week_end
+    assert state["row_count"] == exact_count(results)
+    metrics = metric_rows[(week_start, week_end)]
+    assert metrics["pred_class_pass_freq"] + metrics["pred_class_fail_freq"] == exact_count(results)
+
+def test_week_is_retried_after_failed_metric_merge(monkeypatch):
+    results = make_results(5000)
+    runs = [week_end - timedelta(days=3), week_end + timedelta(hours=1), week_end + timedelta(hours=2)]
+
+    saved_states, metric_rows = run_schedule(results, runs, monkeypatch, failing_runs={runs[1]})
+
+    metrics = metric_rows[(week_start, week_end)]
+    assert metrics["pred_class_pass_freq"] + metrics["pred_class_fail_freq"] == exact_count(results)
+    assert saved_states[(week_start, week_end)]["row_count"] == exact_count(results)
+
+def test_sealed_week_is_not_pending_again(monkeypatch):
+    results = make_results(1000)
+    runs = [week_end - timedelta(minutes=1), week_end + timedelta(hours=1)]
+    saved_states, _ = run_schedule(results, runs, monkeypatch)
+
+    state_watermarks = {week: state["watermark"] for week, state in saved_states.items()}
+    existing_ranges = {"inference": {week: runs[-1] for week in saved_states}}
+    pending_weeks, _ = metrics_job.get_pending_weeks(week_start, week_end + timedelta(days=1), existing_ranges, state_watermarks)
+    assert (week_start, week_end) not in pending_weeks
+
+def test_week_written_before_its_end_without_state_is_unsealed():
+    existing_ranges = {"inference": {(week_start, week_end): week_end - timedelta(minutes=2)}}
+    assert metrics_job.is_agg_week_unsealed(week_start, week_end, existing_ranges, {})
+
+    existing_ranges = {"inference": {(week_start, week_end): week_end + timedelta(hours=1)}}
+    assert not metrics_job.is_agg_week_unsealed(week_start, week_end, existing_ranges, {})
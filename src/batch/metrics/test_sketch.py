@@ -0,0 +1,60 @@
+"""QuantileSketch accuracy, merging and serialization, and the dashboards' copy of it.
+
+    pip install pytest
+    python -m pytest test_sketch.py
+"""
+import os
+import numpy as np
+import pytest
+from sketch import QuantileSketch
+
+quantiles = (0.5, 0.9, 0.99)
+
+def distributions(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "confidence": rng.beta(8, 2, n),
+        "latency": rng.lognormal(3.0, 0.4, n),
+        "bimodal": np.concatenate([rng.normal(20, 2, n // 2), rng.normal(80, 10, n - n // 2)]).clip(0.1),
+        "heavy-tail": rng.pareto(1.5, n) + 1,
+    }
+
+@pytest.mark.parametrize("name", list(distributions(1)))
+def test_merged_partials_within_relative_accuracy(name):
+    values = distributions(50000)[name]
+    # Merged from serialized partials, like hourly rollups merged into a month
+    parts = [QuantileSketch().update(part).to_json() for part in np.array_split(values, 24)]
+    sketch = QuantileSketch.merge_all(parts)
+
+    assert sketch.count == len(values)
+    for q, estimate in zip(quantiles, sketch.quantiles(quantiles)):
+        exact = float(np.quantile(values, q, method="lower"))  # The rank the sketch estimates
+        assert abs(estimate - exact) / exact <= sketch.relative_accuracy, q
+
+def test_merge_equals_single_sketch():
+    values = distributions(10000)["latency"]
+    whole = QuantileSketch().update(values)
+    merged = QuantileSketch().update(values[:3000]).merge(QuantileSketch().update(values[3000:]))
+    assert merged.to_json() == whole.to_json()
+
+def test_json_round_trip_keeps_zero_bucket():
+    sketch = QuantileSketch().update([0.0, 0.0, 1.5, 2.5, 40.0])
+    restored = QuantileSketch.from_json(sketch.to_json())
+    assert (restored.count, restored.zero_count) == (5, 2)
+    assert restored.quantiles(quantiles) == sketch.quantiles(quantiles)
+
+def test_empty_sketch():
+    assert QuantileSketch.from_json(None).quantile(0.5) is None
+    assert QuantileSketch.merge_all([None, ""]).count == 0
+
+def test_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+def test_front_end_copy_is_identical():
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, "sketch.py"), "rb") as f:
+        batch_copy = f.read()
+    with open(os.path.join(here, "..", "..", "front_end", "sketch.py"), "rb") as f:
+        front_end_copy = f.read()
+    assert batch_copy == front_end_copy, "src/front_end/sketch.py differs from src/batch/metrics/sketch.py"
@@ -0,0 +1,63 @@
+"""Server-side weekly aggregation (AGGREGATION_MODE=sql) against the pandas path, on DuckDB.
+
+    pip install pytest duckdb
+    python -m pytest test_weekly_sql.py
+"""
+import math
+from datetime import timedelta
+import pandas as pd
+import pytest
+import main as metrics_job
+from benchmark import make_results, pandas_metrics
+
+duckdb = pytest.importorskip("duckdb")
+
+def compare(expected, actual, tolerance):
+    """Returns the names of metric fields that differ, ignoring id and insert_datetime."""
+    mismatched = []
+    for expected_row, actual_row in zip(expected, actual):
+        for key, value in expected_row.items():
+            if key in ("id", "insert_datetime"):
+                continue
+            other = actual_row[key]
+            if isinstance(value, float) and not math.isclose(value, other, rel_tol=tolerance, abs_tol=tolerance):
+                mismatched.append(key)
+            elif not isinstance(value, float) and value != other:
+                mismatched.append(key)
+    return mismatched
+
+def sql_metrics(df, weeks):
+    """Weekly metric rows from weekly_metrics_sql() run on df, keyed on aggregation_start."""
+    con = duckdb.connect()
+    con.register("inference_results", df)
+    query = metrics_job.weekly_metrics_sql("inference_results", dialect="duckdb")
+    params = {
+        "range_start": min(start for start, _ in weeks),
+        "range_end": max(end for _, end in weeks),
+        "week_starts": [start for start, _ in weeks],
+    }
+    metrics = {}
+    for row in con.execute(query, params).df().to_dict("records"):
+        row["aggregation_start"] = pd.Timestamp(row["aggregation_start"]).to_pydatetime()
+        metrics[row["aggregation_start"]] = metrics_job.metrics_from_sql_row(row)
+    return metrics
+
+@pytest.mark.parametrize("skip_alternate", [False, True])  # Pending weeks need not be contiguous
+def test_sql_matches_pandas(skip_alternate):
+    df = make_results(20000, 6, seed=0)
+    all_weeks = list(metrics_job.get_week_ranges(df["res_insert_datetime"].min(), df["res_insert_datetime"].max()))
+    weeks = all_weeks[::2] if skip_alternate else all_weeks
+
+    actual = sql_metrics(df, weeks)
+
+    assert set(actual) == {start for start, end in weeks if pandas_metrics(df, start, end) is not None}
+    for agg_start, agg_end in weeks:
+        expected = pandas_metrics(df, agg_start, agg_end)
+        if expected is not None:
+            assert compare(expected, actual[agg_start], 1e-9) == [], agg_start
+
+def test_empty_week_has_no_row():
+    df = make_results(1000, 1, seed=1)
+    week_start = metrics_job.get_week_start(df["res_insert_datetime"].max()) + timedelta(weeks=2)
+    weeks = [(week_start, week_start + timedelta(weeks=1))]
+    assert sql_metrics(df, weeks) == {}
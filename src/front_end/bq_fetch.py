@@ -0,0 +1,52 @@
+"""Shared BigQuery clients and DataFrame fetch layer for the dashboards.
+
+Query results are read through the BigQuery Storage Read API as Arrow record
+batches, instead of paged REST JSON, and converted to pandas from Arrow. DATETIME
+and TIMESTAMP columns arrive as datetime64 columns, so pages need no
+pd.to_datetime. Results small enough to arrive with the query response skip the
+Storage API and are read from that response.
+"""
+import google.auth
+import streamlit as st
+from google.cloud import bigquery
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:  # Falls back to REST downloads
+    bigquery_storage = None
+
+@st.cache_resource
+def get_clients():
+    """The BigQuery and BigQuery Storage clients, shared by every session and page."""
+    credentials, project_id = google.auth.default()
+    bq_client = bigquery.Client(credentials=credentials, project=project_id)
+    storage_client = bigquery_storage.BigQueryReadClient(credentials=credentials) if bigquery_storage else None
+    return bq_client, storage_client
+
+def get_bigquery_client():
+    return get_clients()[0]
+
+def fetch_arrow(query, job_config=None, bq_client=None):
+    """Runs query and returns its result as a pyarrow Table."""
+    default_client, storage_client = get_clients()
+    job = (bq_client or default_client).query(query, job_config=job_config)
+    return job.result().to_arrow(bqstorage_client=storage_client, create_bqstorage_client=False)
+
+def fetch_dataframe(query, job_config=None, bq_client=None):
+    """Runs query and returns its result as a DataFrame, converted from Arrow.
+
+    Arrow buffers are released column by column as they are converted, so the
+    result is not held twice in memory.
+    """
+    table = fetch_arrow(query, job_config, bq_client)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def iter_dataframes(query, job_config=None, bq_client=None):
+    """Runs query and yields its result one Arrow record batch at a time, as DataFrames.
+
+    For ranges too large to hold at once: only the batches in flight are in memory.
+    """
+    default_client, storage_client = get_clients()
+    rows = (bq_client or default_client).query(query, job_config=job_config).result()
+    for batch in rows.to_arrow_iterable(bqstorage_client=storage_client):
+        yield batch.to_pandas()
@@ -0,0 +1,83 @@
+"""Per-result comment index for the event list.
+
+The comments of a grid page are loaded in one query and kept per result_id, so
+selecting rows and counting comments need no further queries. Submitted comments
+are added to the index directly, and comments still queued in the comment writer
+are merged into every load. Entries expire after COMMENT_CACHE_TTL_S, to pick up
+comments written by other app instances.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+import streamlit as st
+from bq_fetch import fetch_dataframe
+from comment_writer import get_comment_writer
+from queries import comments_query
+
+comment_cache_ttl_s = float(os.environ.get("COMMENT_CACHE_TTL_S", "300"))
+comment_cache_results = int(os.environ.get("COMMENT_CACHE_RESULTS", "20000"))
+
+class CommentIndex:
+    def __init__(self, ttl_s, max_results, bq_client=None, pending_comments=None):
+        self.ttl_s = ttl_s
+        self.max_results = max_results
+        self.bq_client = bq_client
+        self.pending_comments = pending_comments  # result_ids -> unwritten (result_id, comment_text, comment_datetime)
+        self._comments = OrderedDict()  # result_id -> (loaded at, [(comment_text, comment_datetime)] newest first)
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    def _is_fresh(self, result_id, now):
+        entry = self._comments.get(result_id)
+        return entry is not None and now - entry[0] < self.ttl_s
+
+    def load(self, result_ids):
+        """Loads the comments of the result_ids not in the index, in one query."""
+        now = time.monotonic()
+        with self._lock:
+            missing = sorted({result_id for result_id in result_ids if not self._is_fresh(result_id, now)})
+        if not missing:
+            return
+
+        self.queries += 1
+        rows = fetch_dataframe(*comments_query(missing), self.bq_client)
+        loaded = {result_id: [] for result_id in missing}
+        for result_id, text, created in zip(rows["result_id"], rows["comment_text"], rows["comment_datetime"]):
+            loaded[result_id].append((text, created))
+        if self.pending_comments:
+            for result_id, text, created in self.pending_comments(missing):
+                if (text, created) not in loaded[result_id]:
+                    loaded[result_id].append((text, created))
+                    loaded[result_id].sort(key=lambda comment: comment[1], reverse=True)
+
+        with self._lock:
+            for result_id, comments in loaded.items():
+                self._comments[result_id] = (now, comments)
+                self._comments.move_to_end(result_id)
+            while len(self._comments) > self.max_results:
+                self._comments.popitem(last=False)
+
+    def get(self, result_id):
+        """Comments on result_id as (comment_text, comment_datetime), newest first."""
+        self.load([result_id])
+        with self._lock:
+            return list(self._comments.get(result_id, (0, []))[1])
+
+    def counts(self, result_ids):
+        """Comment count of each of result_ids."""
+        self.load(result_ids)
+        with self._lock:
+            return [len(self._comments.get(result_id, (0, []))[1]) for result_id in result_ids]
+
+    def add(self, result_id, comment_text, comment_datetime):
+        """Adds a comment written by this app without reloading the result's comments."""
+        with self._lock:
+            if result_id in self._comments:
+                loaded_at, comments = self._comments[result_id]
+                self._comments[result_id] = (loaded_at, [(comment_text, comment_datetime), *comments])
+
+@st.cache_resource
+def get_comment_index():
+    """The process-wide comment index, shared by every session."""
+    return CommentIndex(comment_cache_ttl_s, comment_cache_results, pending_comments=get_comment_writer().pending_comments)
@@ -0,0 +1,203 @@
+"""Background writer for dashboard comments.
+
+submit() appends the comment to an on-disk journal and queues it, without waiting
+on BigQuery. A writer thread streams the queue to the comments table in batches
+with insert_rows_json, so reviewers never wait on a DML job and concurrent
+submissions share one insert. Comments BigQuery rejects are moved to a
+dead-letter file instead of holding up the ones behind them.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+import streamlit as st
+from bq_fetch import get_bigquery_client
+
+comments_table_id = "cast-defect-detection.cast_defect_detection.comments"
+journal_path = os.environ.get("COMMENT_JOURNAL_PATH", "comment_journal.jsonl")
+dead_letter_path = os.environ.get("COMMENT_DEAD_LETTER_PATH", "comment_dead_letter.jsonl")
+
+# insert_rows_json row error reasons worth retrying; "stopped" marks valid rows of a request another row failed
+transient_reasons = {"stopped", "backendError", "internalError", "timeout", "rateLimitExceeded"}
+
+class InsertError(Exception):
+    """Raised by a write whose rows BigQuery reported errors for."""
+
+    def __init__(self, message, rejected, retry):
+        super().__init__(message)
+        self.rejected = rejected  # [(entry, errors)] rejected for the row itself
+        self.retry = retry  # Entries failed for a transient reason or for another row
+
+class CommentWriter:
+    """Streams queued comments to BigQuery in bulk, journaling them until they are written.
+
+    A batch is flushed once max_batch_rows comments are waiting or max_wait_ms after its
+    first comment arrived. A batch that fails to send, or whose rows fail for a transient
+    reason, is retried with exponential backoff, capped at max_backoff_s, until it succeeds;
+    its error is kept in last_error for the UI. Rows rejected for themselves (a schema or
+    type error, oversized text) are appended to dead_letter_path with their errors, counted
+    in rejected and described in last_rejection, and the rest of the batch is retried. Each
+    comment keeps its insert id across retries and restarts, so BigQuery can drop the
+    duplicates of a retried partial write. At most max_queued comments wait at once.
+    """
+
+    def __init__(self, bq_client, table_id, journal_path, dead_letter_path, max_batch_rows=100, max_wait_ms=500,
+                 max_queued=1000, backoff_s=0.5, max_backoff_s=60):
+        self.bq_client = bq_client
+        self.table_id = table_id
+        self.journal_path = journal_path
+        self.dead_letter_path = dead_letter_path
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.max_queued = max_queued
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.last_error = None
+        self.last_rejection = None
+        self.rejected = 0
+        self._in_flight = []
+        self._cond = threading.Condition()
+
+        # (insert_id, row, enqueued_at); comments journaled by an earlier process are written first
+        self._queue = [(insert_id, row, 0) for insert_id, row in self._read_journal()]
+        if self._queue:
+            print(f"Replaying {len(self._queue)} journaled comments")
+        self._thread = threading.Thread(target=self._run, name="comment-writer", daemon=True)
+        self._thread.start()
+
+    def _read_journal(self):
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return [(entry["insert_id"], entry["row"]) for entry in entries]
+
+    def _append_journal(self, insert_id, row):
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps({"insert_id": insert_id, "row": row}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append_dead_letters(self, rejected):
+        with open(self.dead_letter_path, "a") as f:
+            for (insert_id, row, _), errors in rejected:
+                f.write(json.dumps({"insert_id": insert_id, "row": row, "errors": errors}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_journal(self):
+        """Replaces the journal with the comments not written yet; called with _cond held."""
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for insert_id, row, _ in self._in_flight + self._queue:
+                f.write(json.dumps({"insert_id": insert_id, "row": row}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def submit(self, result_id, comment_text, comment_datetime):
+        """Journals and queues a comment, raising if the queue is full. Returns its insert id."""
+        insert_id = str(uuid.uuid4())
+        row = {
+            "result_id": result_id,
+            "comment_text": comment_text,
+            "comment_datetime": comment_datetime.strftime("%Y-%m-%d %H:%M:%S.%f"),
+        }
+        with self._cond:
+            if len(self._queue) + len(self._in_flight) >= self.max_queued:
+                raise RuntimeError(f"Error: {self.max_queued} comments are already waiting to be written.")
+            self._append_journal(insert_id, row)
+            self._queue.append((insert_id, row, time.monotonic()))
+            self._cond.notify_all()
+        return insert_id
+
+    def pending(self):
+        """Number of comments not written yet."""
+        with self._cond:
+            return len(self._queue) + len(self._in_flight)
+
+    def pending_comments(self, result_ids):
+        """(result_id, comment_text, comment_datetime) of the unwritten comments on result_ids."""
+        result_ids = set(result_ids)
+        with self._cond:
+            rows = [row for _, row, _ in self._in_flight + self._queue if row["result_id"] in result_ids]
+        return [(row["result_id"], row["comment_text"], datetime.fromisoformat(row["comment_datetime"])) for row in rows]
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    if len(self._queue) >= self.max_batch_rows:
+                        break
+                    remaining = self._queue[0][2] + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            self._in_flight = self._queue[:self.max_batch_rows]
+            del self._queue[:self.max_batch_rows]
+            return self._in_flight
+
+    def _write(self, batch):
+        errors = self.bq_client.insert_rows_json(
+            self.table_id, [row for _, row, _ in batch], row_ids=[insert_id for insert_id, _, _ in batch]
+        )
+        if errors:
+            row_errors = {error["index"]: error["errors"] for error in errors}
+            rejected, retry = [], []
+            for index, entry in enumerate(batch):
+                reasons = {error.get("reason") for error in row_errors.get(index, [])}
+                if reasons - transient_reasons:
+                    rejected.append((entry, row_errors[index]))
+                else:
+                    retry.append(entry)
+            raise InsertError(f"Error inserting comments into {self.table_id}: {errors}", rejected, retry)
+
+    def _reject(self, rejected):
+        """Moves rows BigQuery rejected out of the batch and into the dead-letter file."""
+        self._append_dead_letters(rejected)
+        message = f"Error: {len(rejected)} comment(s) rejected by {self.table_id}, kept in {self.dead_letter_path}: {rejected[0][1]}"
+        print(message)
+        with self._cond:
+            rejected_ids = {entry[0] for entry, _ in rejected}
+            self._in_flight = [entry for entry in self._in_flight if entry[0] not in rejected_ids]
+            self.rejected += len(rejected)
+            self.last_rejection = message
+            self._rewrite_journal()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            attempt = 0
+            while batch:
+                try:
+                    self._write(batch)
+                    break
+                except InsertError as e:
+                    if e.rejected:
+                        self._reject(e.rejected)
+                        batch = e.retry  # Retried at once: most failed only alongside the rejected rows
+                        continue
+                    error = e
+                except Exception as e:
+                    error = e
+                delay = min(self.backoff_s * 2 ** attempt, self.max_backoff_s)
+                print(f"Error writing {len(batch)} comments (attempt {attempt + 1}), retrying in {delay}s: {error}")
+                with self._cond:
+                    self.last_error = str(error)
+                time.sleep(delay)
+                attempt += 1
+            with self._cond:
+                self._in_flight = []
+                self.last_error = None
+                self._rewrite_journal()
+            if batch:
+                print(f"Wrote {len(batch)} comments")
+
+@st.cache_resource
+def get_comment_writer():
+    """The process-wide comment writer, shared by every session."""
+    return CommentWriter(get_bigquery_client(), comments_table_id, journal_path, dead_letter_path)
@@ -2,95 +2,59 @@ import streamlit as st
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
 import pandas as pd
 from datetime import datetime, timezone, timedelta
-from google.cloud import bigquery
 import altair as alt
-import google.auth
 import plotly.express as px
+from bq_fetch import get_bigquery_client
+from queries import kpi_trend_query, outlier_insights_query, partition_bounds_query, range_end, result_labels, other_label
+from event_source import EventSource
+from query_cache import get_query_cache
+from image_service import full_image_url, get_image_service
+from comment_index import get_comment_index
+from comment_writer import get_comment_writer
 
 # ------------------------
-#  Load credentials
+#  Shared BigQuery client
 # ------------------------
-credentials, project_id = google.auth.default()
-bq_client = bigquery.Client(credentials=credentials, project=project_id)
+bq_client = get_bigquery_client()
+query_cache = get_query_cache()
+image_service = get_image_service()
+comment_index = get_comment_index()
+comment_writer = get_comment_writer()
+
+# Grid rows on each side of the selection whose images are prefetched
+image_prefetch_rows = 2
 
 # ------------------------
 #  Fetch BigQuery data
 # ------------------------
-@st.cache_data(ttl=600, show_spinner=False)
-def fetch_event_data():
-    query = """
-    SELECT 
-      res_id AS `Result ID`, 
-      res_insert_datetime AS `Date`,
-      CASE pred_class
-        WHEN 'OK' THEN 'Defect Free'
-        WHEN 'Defect' THEN 'Fault Detected'
-        ELSE 'Inspection Required'
-      END AS `Result Label`,
-      pred_confidence AS `Confidence Score`,
-      res_image_path AS `image_url`
-    FROM `cast-defect-detection.cast_defect_detection.inference_results`
-    ORDER BY `Date`
-    """
-    df = bq_client.query(query).to_dataframe()
-    df["Date"] = pd.to_datetime(df["Date"])
-    return df
+def fetch_date_bounds():
+    return query_cache.fetch(partition_bounds_query, "inference_results", {}).iloc[0]
+
+def fetch_kpi_trend(start_date, end_date, granularity):
+    params = {"start_date": start_date, "end_date": end_date, "granularity": granularity}
+    return query_cache.fetch(kpi_trend_query, "inference_results", params, range_end(end_date))
 
 # ------------------------
 #  Outlier Insights
 # ------------------------
-@st.cache_data(ttl=600, show_spinner=False)
-def fetch_outlier_insights():
-    query = """
-    WITH base AS (
-      SELECT 
-        res_id,
-        res_insert_datetime,
-        pred_confidence,
-        pred_Speed,
-        pred_class
-      FROM `cast-defect-detection.cast_defect_detection.inference_results`
-    ),
-    defects_per_day AS (
-      SELECT DATE(res_insert_datetime) AS defect_date, COUNT(*) AS defect_count
-      FROM base
-      WHERE pred_class = 'Defect'
-      GROUP BY defect_date
-      ORDER BY defect_count DESC
-      LIMIT 1
-    ),
-    lowest_confidence AS (
-      SELECT res_id, pred_confidence, res_insert_datetime
-      FROM base
-      ORDER BY pred_confidence ASC
-      LIMIT 1
-    ),
-    highest_inference_time AS (
-      SELECT res_id, pred_Speed, res_insert_datetime
-      FROM base
-      ORDER BY pred_Speed DESC
-      LIMIT 1
-    )
+def fetch_outlier_insights(start_date, end_date):
+    params = {"start_date": start_date, "end_date": end_date}
+    return query_cache.fetch(outlier_insights_query, "inference_results", params, range_end(end_date)).iloc[0]
+
+def display_image(result_id, image_url, neighbour_urls=()):
+    image_url = full_image_url(image_url)
 
-    SELECT 
-      (SELECT pred_confidence FROM lowest_confidence) AS lowest_confidence_score,
-      (SELECT res_insert_datetime FROM lowest_confidence) AS lowest_confidence_date,
-      (SELECT pred_Speed FROM highest_inference_time) AS highest_inference_time,
-      (SELECT res_insert_datetime FROM highest_inference_time) AS highest_inference_date,
-      (SELECT defect_date FROM defects_per_day) AS most_defect_day,
-      (SELECT defect_count FROM defects_per_day) AS most_defect_count
-    """
-    return bq_client.query(query).to_dataframe().iloc[0]
-
-@st.cache_data(ttl=600, show_spinner=False)
-def display_image(result_id, image_url):
-    if image_url and not image_url.startswith("http"):
-       image_url = f"https://storage.googleapis.com/metal_casting_images/{image_url.lstrip('/')}"
-    
     st.markdown("### 🖼️ Selected Image")
     if image_url:
         with st.spinner("Loading image..."):
-            st.image(image_url, caption=f"Result ID: {result_id}", width=400)
+            try:
+                image = image_service.get(image_url)
+            except Exception as e:
+                print(f"Error loading image {image_url}: {e}")
+                image = image_url  # Left for the browser to load
+            st.image(image, caption=f"Result ID: {result_id}", width=400)
+        st.markdown(f"[Open full resolution]({image_url})")
+        image_service.prefetch([full_image_url(url) for url in neighbour_urls])
     else:
         st.warning("⚠️ No image URL found for this record.")
 
@@ -99,24 +63,14 @@ def display_comments(result_id):
     st.markdown("### 💬 Existing Comments")
     try:
         with st.spinner("Loading comments..."):
-            comments_query = """
-            SELECT comment_text, comment_datetime
-            FROM `cast-defect-detection.cast_defect_detection.comments`
-            WHERE result_id = @result_id
-            ORDER BY comment_datetime DESC
-            """
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("result_id", "STRING", result_id)
-                ]
-            )
-            comments_df = bq_client.query(comments_query, job_config=job_config).to_dataframe()
-            if not comments_df.empty:
-                for _, row in comments_df.iterrows():
+            # Usually already loaded with the grid page
+            comments = comment_index.get(result_id)
+            if comments:
+                for comment_text, comment_datetime in comments:
                     st.markdown(f"""
                         <div style="padding: 8px 12px; border-left: 4px solid #007BFF; margin-bottom: 10px; background-color: #f9f9f9;">
-                            <strong>{(row['comment_datetime'] + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')}</strong><br>
-                            {row['comment_text']}
+                            <strong>{(comment_datetime + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')}</strong><br>
+                            {comment_text}
                         </div>
                     """, unsafe_allow_html=True)
             else:
@@ -129,6 +83,12 @@ def display_comments(result_id):
 def submit_comment(selected):
     st.markdown("### 💬 Add a Comment")
 
+    # Comments are written in the background; show when BigQuery writes are failing
+    if comment_writer.last_error:
+        st.warning(f"⚠️ {comment_writer.pending()} comment(s) not saved yet, retrying: {comment_writer.last_error}")
+    if comment_writer.last_rejection:
+        st.error(f"❌ {comment_writer.rejected} comment(s) could not be saved. {comment_writer.last_rejection}")
+
     # Submit comment
     with st.form("comment_form", clear_on_submit=True):
         comment = st.text_area("Your comment:", key="comment_box", height=100)
@@ -144,20 +104,9 @@ def submit_comment(selected):
                 st.session_state.button_disabled = False
             else:
                 try:
-                    timestamp = datetime.now(timezone.utc)
-                    insert_query = """
-                    INSERT INTO `cast-defect-detection.cast_defect_detection.comments`
-                    (result_id, comment_text, comment_datetime)
-                    VALUES (@result_id, @comment, @created_at)
-                    """
-                    insert_job = bigquery.QueryJobConfig(
-                        query_parameters=[
-                            bigquery.ScalarQueryParameter("result_id", "STRING", selected["Result ID"]),
-                            bigquery.ScalarQueryParameter("comment", "STRING", comment),
-                            bigquery.ScalarQueryParameter("created_at", "TIMESTAMP", timestamp),
-                        ]
-                    )
-                    bq_client.query(insert_query, job_config=insert_job).result()
+                    timestamp = datetime.now(timezone.utc).replace(tzinfo=None)
+                    comment_writer.submit(selected["Result ID"], comment, timestamp)
+                    comment_index.add(selected["Result ID"], comment, timestamp)
                     st.success("✅ Comment submitted successfully!")
                     st.session_state.button_disabled = False
                     st.rerun()
@@ -166,16 +115,49 @@ def submit_comment(selected):
                     st.text(str(e))
                     st.session_state.button_disabled = False
 
+# Grid sort orders: (sort column, descending)
+sort_options = {
+    "Date (oldest first)": ("res_insert_datetime", False),
+    "Date (newest first)": ("res_insert_datetime", True),
+    "Confidence (lowest first)": ("pred_confidence", False),
+    "Confidence (highest first)": ("pred_confidence", True),
+}
+
+def get_event_source(filters, sort_by, descending):
+    # Keep one source per session, so loaded pages survive reruns until a filter changes
+    key = (tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in filters.items())), sort_by, descending)
+    if st.session_state.get("event_source_key") != key:
+        st.session_state.event_source = EventSource(bq_client, filters, sort_by, descending)
+        st.session_state.event_source_key = key
+        st.session_state.event_page = 0
+    # New results drop the loaded pages and count, but keep the page the reviewer is on
+    st.session_state.event_source.refresh(query_cache.watermark("inference_results"))
+    return st.session_state.event_source
+
 @st.fragment
-def results_loading(filtered_events):
+def results_loading(source):
     st.markdown("###  Prediction Results List")
+    page_count = source.page_count()
+    page_index = min(st.session_state.get("event_page", 0), page_count - 1)
+    st.session_state.event_page = page_index
+
+    def turn_page(step):
+        st.session_state.event_page += step
+
+    prev_col, info_col, next_col = st.columns([1, 4, 1])
+    prev_col.button("◀ Previous", disabled=page_index == 0, on_click=turn_page, args=(-1,))
+    next_col.button("Next ▶", disabled=page_index >= page_count - 1, on_click=turn_page, args=(1,))
+    info_col.markdown(f"Page {page_index + 1} of {page_count} ({source.total_rows():,} results)")
+
+    page = source.page(page_index).fillna("")
+    page["Comments"] = comment_index.counts(page["Result ID"].tolist())
     with st.container():
-        gb = GridOptionsBuilder.from_dataframe(filtered_events)
+        gb = GridOptionsBuilder.from_dataframe(page)
         gb.configure_selection('single', use_checkbox=True)
         grid_options = gb.build()
 
     grid_response = AgGrid(
-        filtered_events,
+        page,
         gridOptions=grid_options,
         height=400,
         theme="material",
@@ -193,7 +175,13 @@ def results_loading(filtered_events):
         selected = selected_rows[0]
         result_id = selected["Result ID"]
 
-        display_image(result_id, selected["image_url"])
+        # Prefetch the images of the rows around the selection, where browsing goes next
+        position = page.index[page["Result ID"] == result_id]
+        position = position[0] if len(position) else 0
+        neighbours = page.iloc[max(position - image_prefetch_rows, 0):position + image_prefetch_rows + 1]
+        neighbour_urls = neighbours.loc[neighbours["Result ID"] != result_id, "image_url"]
+
+        display_image(result_id, selected["image_url"], neighbour_urls.tolist())
 
         display_comments(result_id)
 
@@ -204,31 +192,49 @@ def results_loading(filtered_events):
 # ------------------------
 st.title(" 🗒️Cast Defect Detection Dashboard")
 
-df_events = fetch_event_data()
-
-#  Date filtering
+#  Date filtering, pushed down to BigQuery as a partition filter
 st.sidebar.subheader("📅 Filter by Date")
-min_date = df_events["Date"].min().date()
-max_date = df_events["Date"].max().date()
+bounds = fetch_date_bounds()
+today = datetime.now(timezone.utc).date()
+min_date = bounds["min_date"] if pd.notna(bounds["min_date"]) else today
+max_date = max(bounds["max_date"], today) if pd.notna(bounds["max_date"]) else today  # Streamed rows may not be in a partition yet
 
 start_date = st.sidebar.date_input("Start Date", min_value=min_date, max_value=max_date, value=min_date)
 end_date = st.sidebar.date_input("End Date", min_value=min_date, max_value=max_date, value=max_date)
 
-mask = (df_events["Date"].dt.date >= start_date) & (df_events["Date"].dt.date <= end_date)
-filtered_events = df_events[mask].reset_index(drop=True).fillna("")
+#  Grid filters and sort, applied in BigQuery
+st.sidebar.subheader("🔎 Filter Results")
+label_choices = [*result_labels, other_label]
+labels = st.sidebar.multiselect("Result Label", label_choices, default=label_choices)
+min_confidence, max_confidence = st.sidebar.slider("Confidence Score", 0.0, 1.0, (0.0, 1.0), step=0.01)
+sort_label = st.sidebar.selectbox("Sort by", list(sort_options))
+
+event_filters = {
+    "start_date": start_date,
+    "end_date": end_date,
+    "labels": None if len(labels) == len(label_choices) else labels,
+    # The full range also keeps rows without a confidence score
+    "min_confidence": None if (min_confidence, max_confidence) == (0.0, 1.0) else min_confidence,
+    "max_confidence": None if (min_confidence, max_confidence) == (0.0, 1.0) else max_confidence,
+}
 
 #  Metrics + Outliers
 st.markdown("###  Metrics Overview")
 
+trend_granularities = {"Hourly": "hour", "Daily": "day", "Weekly": "week", "Monthly": "month"}
+trend_label = st.sidebar.radio("Trend granularity", list(trend_granularities), index=1)
+chart_data = fetch_kpi_trend(start_date, end_date, trend_granularities[trend_label])
+label_counts = chart_data.groupby("Result Label")["Count"].sum()
+
 try:
-    insights = fetch_outlier_insights()
+    insights = fetch_outlier_insights(start_date, end_date)
     col1, col2, col3, col4, col5, col6 = st.columns(6)
     with col1:
-        st.metric("Total Inspections", len(filtered_events))
+        st.metric("Total Inspections", int(chart_data["Count"].sum()))
     with col2:
-        st.metric("Defect Free", (filtered_events["Result Label"] == "Defect Free").sum())
+        st.metric("Defect Free", int(label_counts.get("Defect Free", 0)))
     with col3:
-        st.metric("Fault Detected", (filtered_events["Result Label"] == "Fault Detected").sum())
+        st.metric("Fault Detected", int(label_counts.get("Fault Detected", 0)))
     with col4:
         st.markdown(f"""
         <div style="padding: 10px; background-color: #fff4f4; border-left: 4px solid #dc3545; border-radius: 4px;">
@@ -262,12 +268,6 @@ except Exception as e:
 
 #  Trend Chart
 st.subheader(" Trend Over Time")
-chart_data = (
-    filtered_events.groupby([filtered_events["Date"].dt.date, "Result Label"])
-    .size()
-    .reset_index(name="Count")
-)
-
 fig_trend = px.line(
     chart_data,
     x="Date",
@@ -294,4 +294,4 @@ fig_trend.update_layout(
 
 st.plotly_chart(fig_trend, use_container_width=True)
 
-results_loading(filtered_events)
\ No newline at end of file
+results_loading(get_event_source(event_filters, *sort_options[sort_label]))
\ No newline at end of file
@@ -0,0 +1,102 @@
+"""Keyset-paginated event rows for the event list grid.
+
+Filters and sort order are applied in BigQuery and only the visible page plus a
+prefetch window is fetched. Each page starts after the (sort key, res_id) of the
+last row of the page before it, so reading page n never scans or skips n pages
+of rows the way an OFFSET would.
+
+Loaded pages and the row count are kept until refresh() is given a new
+inference_results watermark, so newly inserted results show up.
+"""
+import math
+from collections import OrderedDict
+from bq_fetch import fetch_dataframe
+from queries import event_count_query, event_page_query
+
+class EventSource:
+    def __init__(self, bq_client, filters, sort_by="res_insert_datetime", descending=False,
+                 page_size=100, prefetch_pages=2, max_cached_pages=20):
+        """filters are the event_filter keyword arguments: start_date, end_date, labels,
+        min_confidence, max_confidence."""
+        if max_cached_pages < prefetch_pages + 1:
+            raise ValueError(f"Error: max_cached_pages ({max_cached_pages}) must hold a page and its {prefetch_pages} prefetched pages.")
+        self.bq_client = bq_client
+        self.filters = filters
+        self.sort_by = sort_by
+        self.descending = descending
+        self.page_size = page_size
+        self.prefetch_pages = prefetch_pages
+        self.max_cached_pages = max_cached_pages
+        self._cursors = [None]  # _cursors[i]: key of the last row before page i
+        self._pages = OrderedDict()  # Page index -> DataFrame, least recently used first
+        self._last_page = None  # Set once a fetch comes back short
+        self._empty = None  # Zero-row frame with the grid columns
+        self._total_rows = None
+        self._watermark = None
+
+    def refresh(self, watermark):
+        """Drops the loaded pages, cursors and row count if watermark differs from the one they were loaded at."""
+        if watermark == self._watermark:
+            return
+        self._cursors = [None]
+        self._pages.clear()
+        self._last_page = None
+        self._total_rows = None
+        self._watermark = watermark
+
+    def _fetch_window(self, first):
+        """Fetch page first and the prefetch window after it, in one query."""
+        limit = self.page_size * (1 + self.prefetch_pages)
+        query, job_config = event_page_query(
+            **self.filters,
+            sort_by=self.sort_by,
+            descending=self.descending,
+            after=self._cursors[first],
+            limit=limit,
+        )
+        rows = fetch_dataframe(query, job_config, self.bq_client)
+
+        self._empty = rows.iloc[0:0].drop(columns="sort_key")
+
+        for offset in range(0, len(rows), self.page_size):
+            index = first + offset // self.page_size
+            page = rows.iloc[offset:offset + self.page_size]
+            if len(page) == self.page_size and index + 1 == len(self._cursors):
+                last = page.iloc[-1]
+                key = last["sort_key"]
+                self._cursors.append((key.to_pydatetime() if hasattr(key, "to_pydatetime") else float(key), last["Result ID"]))
+            self._store(index, page.drop(columns="sort_key").reset_index(drop=True))
+
+        if len(rows) < limit:
+            self._last_page = first + math.ceil(len(rows) / self.page_size) - 1  # -1 when there are no rows
+
+    def _store(self, index, page):
+        self._pages[index] = page
+        self._pages.move_to_end(index)
+        while len(self._pages) > self.max_cached_pages:
+            self._pages.popitem(last=False)
+
+    def page(self, index):
+        """Rows of page index (0-based); empty past the last page."""
+        while index not in self._pages:
+            if self._last_page is not None and index > self._last_page:
+                return self._empty
+            # Later pages are only reachable from the last cursor known so far
+            self._fetch_window(min(index, len(self._cursors) - 1))
+        self._pages.move_to_end(index)
+        rows = self._pages[index]  # Held here, as the prefetch below may evict it from the cache
+
+        # Keep the window ahead of the reader so the next pages are already loaded
+        ahead = index + self.prefetch_pages
+        if ahead not in self._pages and ahead < len(self._cursors) and (self._last_page is None or ahead <= self._last_page):
+            self._fetch_window(ahead)
+        return rows
+
+    def total_rows(self):
+        if self._total_rows is None:
+            query, job_config = event_count_query(**self.filters)
+            self._total_rows = int(fetch_dataframe(query, job_config, self.bq_client)["total_rows"].iloc[0])
+        return self._total_rows
+
+    def page_count(self):
+        return max(math.ceil(self.total_rows() / self.page_size), 1)
@@ -0,0 +1,102 @@
+"""Result images for the event list, served from an in-process LRU byte cache.
+
+Images are read as the WebP thumbnails the inference listener writes next to each
+result/ object, or as the full image when a result has no thumbnail. Selecting a
+grid row also prefetches the images of its neighbours in the background, so
+moving through the grid finds them already cached.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import streamlit as st
+
+image_base_url = "https://storage.googleapis.com/metal_casting_images"
+cache_max_mb = int(os.environ.get("IMAGE_CACHE_MAX_MB", "128"))
+prefetch_threads = int(os.environ.get("IMAGE_PREFETCH_THREADS", "4"))
+
+def full_image_url(image_path):
+    """Public URL of a result image, from either a URL or a bucket path."""
+    if image_path and not image_path.startswith("http"):
+        return f"{image_base_url}/{image_path.lstrip('/')}"
+    return image_path
+
+def thumbnail_url(image_url):
+    """URL of the thumbnail stored next to a result image, like the listener's thumbnail_blob_name."""
+    return f"{image_url}.thumb.webp"
+
+class ImageService:
+    def __init__(self, max_bytes, prefetch_threads=4):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()  # URL -> bytes, least recently used first
+        self._bytes = 0
+        self._pending = {}  # URL -> prefetch Future
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._pool = ThreadPoolExecutor(max_workers=prefetch_threads, thread_name_prefix="image-prefetch")
+        self.hits = self.misses = 0
+
+    def _download(self, image_url):
+        """Thumbnail bytes, or the full image when there is no thumbnail."""
+        response = self._session.get(thumbnail_url(image_url), timeout=10)
+        if response.status_code != 200:
+            response = self._session.get(image_url, timeout=10)
+            response.raise_for_status()
+        return response.content
+
+    def _put(self, image_url, data):
+        with self._lock:
+            if image_url in self._images:
+                return
+            self._images[image_url] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                self._bytes -= len(self._images.popitem(last=False)[1])
+
+    def get(self, image_url):
+        """Image bytes for image_url, downloaded on a cache miss.
+
+        An image still being prefetched is waited for and counts as a hit. A failed prefetch
+        is downloaded again, and a failed download raises without counting as a hit or miss.
+        """
+        with self._lock:
+            if image_url in self._images:
+                self._images.move_to_end(image_url)
+                self.hits += 1
+                return self._images[image_url]
+            pending = self._pending.get(image_url)
+        if pending:
+            try:
+                data = pending.result()
+                with self._lock:
+                    self.hits += 1
+                return data
+            except Exception:
+                pass  # Retried below
+        data = self._download(image_url)
+        self._put(image_url, data)
+        with self._lock:
+            self.misses += 1
+        return data
+
+    def _prefetch_one(self, image_url):
+        try:
+            data = self._download(image_url)
+            self._put(image_url, data)
+            return data
+        finally:
+            with self._lock:
+                self._pending.pop(image_url, None)
+
+    def prefetch(self, image_urls):
+        """Starts background downloads of the images not cached or already on their way."""
+        with self._lock:
+            for image_url in image_urls:
+                if image_url and image_url not in self._images and image_url not in self._pending:
+                    self._pending[image_url] = self._pool.submit(self._prefetch_one, image_url)
+
+@st.cache_resource
+def get_image_service():
+    """The process-wide image service, shared by every session."""
+    return ImageService(cache_max_mb * 2**20, prefetch_threads)
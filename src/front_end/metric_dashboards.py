@@ -1,75 +1,76 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from google.cloud import bigquery
 from datetime import datetime
-import google.auth
 import plotly.graph_objects as go
+from sketch import QuantileSketch
+from metrics_store import get_metrics_store, tab_fields
 
 st.title("📈 Prediction Metrics Dashboard")
 
-# --- Setup BigQuery client ---
-credentials, project_id = google.auth.default()
-bq_client = bigquery.Client(credentials=credentials, project=project_id)
-
 # --- Sidebar filters ---
 st.sidebar.header("Filter Options")
 start_date = st.sidebar.date_input("Start Date", datetime(2025, 2, 1))
 end_date = st.sidebar.date_input("End Date", datetime.today())
-agg_type = st.sidebar.radio("Aggregation Level", ["Weekly", "Monthly"])
-
-# --- Helper: Fetch BigQuery Data ---
-@st.cache_data(ttl=3600, show_spinner=False)  # Cache for 1 hour
-def fetch_bq_data(query: str) -> pd.DataFrame:
-    df = bq_client.query(query).to_dataframe()
-    df["aggregation_start"] = pd.to_datetime(df["aggregation_start"])
-    df["aggregation_end"] = pd.to_datetime(df["aggregation_end"])
-    df["aggregation_label"] = df["aggregation_start"].dt.strftime('%Y-%m-%d') + " → " + df["aggregation_end"].dt.strftime('%Y-%m-%d')
+agg_type = st.sidebar.radio("Aggregation Level", ["Hourly", "Daily", "Weekly", "Monthly"], index=2)
+
+# Rollup granularity materialized by the batch job, with the label/tick format of each level
+granularities = {
+    "Hourly": ("hour", "%Y-%m-%d %H:%M"),
+    "Daily": ("day", "%Y-%m-%d"),
+    "Weekly": ("week", "%Y-%m-%d"),
+    "Monthly": ("month", "%Y-%m"),
+}
+granularity, time_format = granularities[agg_type]
+
+# Rollups are read once at the selected granularity, for all tabs; no regrouping on the client
+rollups = get_metrics_store().get(granularity, start_date, end_date)
+
+# --- Helper: Tab Data ---
+def tab_metrics(tab: str) -> pd.DataFrame:
+    df = rollups[tab_fields(tab)].copy()
+    if agg_type == "Weekly":
+        df["aggregation_label"] = df["aggregation_start"].dt.strftime('%Y-%m-%d') + " → " + df["aggregation_end"].dt.strftime('%Y-%m-%d')
+    else:
+        df["aggregation_label"] = df["aggregation_start"].dt.strftime(time_format)
     return df
 
-# --- Helper: Monthly Aggregation ---
-def aggregate_monthly(df: pd.DataFrame) -> pd.DataFrame:
-    df["month"] = df["aggregation_start"].dt.to_period("M").dt.to_timestamp()
-    agg_funcs = {
-        "confidence_score_min": "min",
-        "confidence_score_med": "median",
-        "confidence_score_mean": "mean",
-        "confidence_score_max": "max",
-        "inference_time_min": "min",
-        "inference_time_med": "median",
-        "inference_time_mean": "mean",
-        "inference_time_max": "max",
-        "OK": "sum",
-        "Defect": "sum"
-    }
-    grouped = df.groupby("month").agg({k: v for k, v in agg_funcs.items() if k in df.columns}).reset_index()
-    grouped["aggregation_start"] = grouped["month"]
-    grouped["aggregation_end"] = grouped["month"] + pd.offsets.MonthEnd(0)
-    grouped["aggregation_label"] = grouped["aggregation_start"].dt.strftime('%Y-%m')
-    return grouped.drop(columns=["month"])
+# --- Helper: Time Axis ---
+def update_time_axis(fig, x):
+    if agg_type == "Monthly":
+        fig.update_xaxes(
+            tickformat=time_format,  # Show as "2025-03" format
+            dtick="M1"           # One tick per month
+        )
+    elif agg_type == "Weekly":
+        # Only show labels where data exists
+        fig.update_xaxes(
+            tickformat=time_format,
+            tickvals=x,  # Only show ticks where data exists
+        )
+    else:  # Hourly/Daily, too many points for a tick each
+        fig.update_xaxes(tickformat=time_format)
+
+# --- Helper: Range Percentiles ---
+percentiles = (0.5, 0.9, 0.99)
+
+def show_range_percentiles(sketches, label, value_format):
+    """Shows p50/p90/p99 over the whole selected range, merged from the per-period sketches."""
+    values = QuantileSketch.merge_all(sketches).quantiles(percentiles)
+    for column, q, value in zip(st.columns(len(percentiles)), percentiles, values):
+        column.metric(f"{label} p{round(q * 100)}", "–" if value is None else value_format.format(value))
 
 # --- Tabs ---
 tab1, tab2, tab3 = st.tabs(["Confidence Scores", "Inference Time", "Prediction Class"])
 
 # --- Tab 1: Confidence Scores ---
 with tab1:
-    query = f"""
-    SELECT 
-        aggregation_start,
-        aggregation_end,
-        confidence_score_min, 
-        confidence_score_med, 
-        confidence_score_mean, 
-        confidence_score_max
-    FROM `cast-defect-detection.cast_defect_detection.confidencescore_metrics`
-    WHERE aggregation_start >= '{start_date}' AND aggregation_start <= '{end_date}'
-    ORDER BY aggregation_start
-    """
-    df = fetch_bq_data(query)
+    df = tab_metrics("confidence")
+
+    ## --- Percentiles over the selected range ---
+    st.subheader("Confidence Score Percentiles (Selected Range)")
+    show_range_percentiles(df["conf_sketch"], "Confidence", "{:.4f}")
 
-    if agg_type == "Monthly":
-        df = aggregate_monthly(df)
-        
     ## --- Plot 1: Confidence Score Trend ---
     st.subheader(f"{agg_type} Prediction Confidence Score Trend")
     
@@ -98,18 +99,8 @@ with tab1:
         )
     )
 
-    # Update x-axis format for monthly view
-    if agg_type == "Monthly":
-        fig1.update_xaxes(
-            tickformat="%Y-%m",  # Show as "2025-03" format
-            dtick="M1"           # One tick per month
-        )
-    else:  # Weekly
-        # Only show labels where data exists
-        fig1.update_xaxes(
-            tickformat="%Y-%m-%d",
-            tickvals=df["aggregation_start"],  # Only show ticks where data exists
-        )
+    # Update x-axis format for the aggregation level
+    update_time_axis(fig1, df["aggregation_start"])
 
     # Custom hover template 
     fig1.update_traces(
@@ -166,18 +157,8 @@ with tab1:
         )
     )
 
-    # Update x-axis format for monthly view
-    if agg_type == "Monthly":
-        fig2.update_xaxes(
-            tickformat="%Y-%m",  # Show as "2025-03" format
-            dtick="M1"           # One tick per month
-        )
-    else:  # Weekly
-        # Only show labels where data exists
-        fig2.update_xaxes(
-            tickformat="%Y-%m-%d",
-            tickvals=df_fig2["aggregation_start"],  # Only show ticks where data exists
-        )
+    # Update x-axis format for the aggregation level
+    update_time_axis(fig2, df_fig2["aggregation_start"])
 
     # Custom hover template 
     fig2.update_traces(
@@ -293,22 +274,11 @@ with tab1:
 
 # --- Tab 2: Inference Time ---
 with tab2:
-    query = f"""
-    SELECT 
-        aggregation_start,
-        aggregation_end,
-        inference_time_min, 
-        inference_time_med, 
-        inference_time_mean, 
-        inference_time_max
-    FROM `cast-defect-detection.cast_defect_detection.inference_metrics`
-    WHERE aggregation_start >= '{start_date}' AND aggregation_start <= '{end_date}'
-    ORDER BY aggregation_start
-    """
-    df2 = fetch_bq_data(query)
+    df2 = tab_metrics("inference_time")
 
-    if agg_type == "Monthly":
-        df2 = aggregate_monthly(df2)
+    ## --- Percentiles over the selected range ---
+    st.subheader("Inference Time Percentiles (Selected Range)")
+    show_range_percentiles(df2["speed_sketch"], "Inference time", "{:.4f}")
 
     ## --- Plot 1: Inference Time Trend ---
     st.subheader(f"{agg_type} Inference Time Trend")
@@ -338,18 +308,8 @@ with tab2:
         )
     )
 
-    # Update x-axis format for monthly view
-    if agg_type == "Monthly":
-        fig4.update_xaxes(
-            tickformat="%Y-%m",  # Show as "2025-03" format
-            dtick="M1"           # One tick per month
-        )
-    else:  # Weekly
-        # Only show labels where data exists
-        fig4.update_xaxes(
-            tickformat="%Y-%m-%d",
-            tickvals=df2["aggregation_start"],  # Only show ticks where data exists
-        )
+    # Update x-axis format for the aggregation level
+    update_time_axis(fig4, df2["aggregation_start"])
 
     # Custom hover template 
     fig4.update_traces(
@@ -468,20 +428,7 @@ with tab2:
 
 # --- Tab 3: Prediction Classes ---
 with tab3:
-    query = f"""
-    SELECT 
-        aggregation_start,
-        aggregation_end,
-        pred_class_pass_freq AS OK, 
-        pred_class_fail_freq AS Defect
-    FROM `cast-defect-detection.cast_defect_detection.prediction_class_metrics`
-    WHERE aggregation_start >= '{start_date}' AND aggregation_start <= '{end_date}'
-    ORDER BY aggregation_start
-    """
-    df3 = fetch_bq_data(query)
-
-    if agg_type == "Monthly":
-        df3 = aggregate_monthly(df3)
+    df3 = tab_metrics("prediction_class")
 
     ## --- Plot 1: Prediction Class Trend ---
     st.subheader("Prediction Result Trend")
@@ -537,18 +484,8 @@ with tab3:
         ),
     )
     
-    # Update x-axis format for monthly view
-    if agg_type == "Monthly":
-        fig7.update_xaxes(
-            tickformat="%Y-%m",  # Show as "2025-03" format
-            dtick="M1"           # One tick per month
-        )
-    else:  # Weekly
-        # Only show labels where data exists
-        fig7.update_xaxes(
-            tickformat="%Y-%m-%d",
-            tickvals=df3_melted["aggregation_start"],  # Only show ticks where data exists
-        )
+    # Update x-axis format for the aggregation level
+    update_time_axis(fig7, df3_melted["aggregation_start"])
 
     # Custom hover template 
     fig7.update_traces(
@@ -0,0 +1,88 @@
+"""Range-aware store of metric_rollups rows for the metrics dashboard.
+
+For each granularity the store keeps the rows of the day interval loaded so far,
+with every tab's columns from one query. A request inside that interval is sliced
+from memory. A wider one fetches only the missing days at either edge; a gap
+between the request and the loaded interval is fetched with the edge.
+
+The batch job only appends complete hours from its rollup watermark onwards, and
+merges them into the periods containing them. When the watermark advances, only
+the periods from the one holding the previous watermark are dropped and
+refetched; any other change reloads the granularity.
+"""
+import threading
+from datetime import datetime, time, timedelta
+import pandas as pd
+import streamlit as st
+from bq_fetch import fetch_dataframe
+from queries import range_end, rollup_query, rollup_tab_columns
+from query_cache import get_query_cache
+
+def tab_fields(tab):
+    """Output column names of a dashboard tab."""
+    return ["aggregation_start", "aggregation_end", *(column.split(" AS ")[-1] for column in rollup_tab_columns[tab])]
+
+def period_start(granularity, ts):
+    """Start of the hour, day, week (Sunday-anchored) or month containing ts, like the batch job's get_period."""
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    day = datetime.combine(ts.date(), time.min)
+    if granularity == "week":
+        return day - timedelta(days=(day.weekday() + 1) % 7)
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+class MetricsStore:
+    def __init__(self, query_cache):
+        self.query_cache = query_cache  # For the metric_rollups watermark
+        self._loaded = {}  # granularity -> (first day, last day, rows, watermark)
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    def _fetch(self, granularity, start_date, end_date):
+        self.queries += 1
+        return fetch_dataframe(*rollup_query(granularity, start_date, end_date))
+
+    def _refresh(self, granularity, loaded, watermark):
+        """Drops the loaded rows the batch job may have rewritten since loaded was fetched."""
+        first, last, rows, loaded_watermark = loaded
+        old_end, new_end = loaded_watermark[0], watermark[0]
+        if old_end is None or new_end is None or new_end <= old_end:
+            return None
+        cut = period_start(granularity, old_end).date()
+        if cut <= first:
+            return None
+        rows = rows[rows["aggregation_start"] < datetime.combine(cut, time.min)]
+        return first, min(last, cut - timedelta(days=1)), rows, watermark
+
+    def get(self, granularity, start_date, end_date):
+        """Rollup rows at granularity starting between start_date and end_date, inclusive."""
+        watermark = self.query_cache.watermark("metric_rollups")
+        with self._lock:
+            loaded = self._loaded.get(granularity)
+            if loaded and loaded[3] != watermark:
+                loaded = self._refresh(granularity, loaded, watermark)
+
+            if loaded is None:
+                first, last, rows = start_date, end_date, self._fetch(granularity, start_date, end_date)
+            else:
+                first, last, rows, _ = loaded
+                parts = [rows]
+                if start_date < first:
+                    parts.append(self._fetch(granularity, start_date, first - timedelta(days=1)))
+                    first = start_date
+                if end_date > last:
+                    parts.append(self._fetch(granularity, last + timedelta(days=1), end_date))
+                    last = end_date
+                if len(parts) > 1:
+                    rows = pd.concat(parts, ignore_index=True).sort_values("aggregation_start", ignore_index=True)
+            self._loaded[granularity] = (first, last, rows, watermark)
+
+        in_range = (rows["aggregation_start"] >= datetime.combine(start_date, time.min)) & (rows["aggregation_start"] < range_end(end_date))
+        return rows[in_range].reset_index(drop=True)
+
+@st.cache_resource
+def get_metrics_store():
+    """The process-wide store, shared by every session."""
+    return MetricsStore(get_query_cache())
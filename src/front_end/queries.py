@@ -0,0 +1,253 @@
+"""Query builders for the inference_results dashboards.
+
+inference_results is day-partitioned on res_insert_datetime and clustered on
+pred_class, model_ver. Every builder binds the sidebar date range as a filter on the
+partitioning column, so BigQuery only reads the partitions in range. Each returns
+(query, job_config).
+"""
+from datetime import datetime, time, timedelta
+from google.cloud import bigquery
+
+project_id = "cast-defect-detection"
+dataset_id = "cast_defect_detection"
+results_table = f"`{project_id}.{dataset_id}.inference_results`"
+rollups_table = f"`{project_id}.{dataset_id}.metric_rollups`"
+comments_table = f"`{project_id}.{dataset_id}.comments`"
+
+# Partition filter on [start_date 00:00, end_date + 1 day 00:00)
+partition_filter = "res_insert_datetime >= @start_datetime AND res_insert_datetime < @end_datetime"
+
+# Grid label for each model class; any other class is shown as "Inspection Required"
+result_labels = {"Defect Free": "OK", "Fault Detected": "Defect"}
+other_label = "Inspection Required"
+
+result_label_sql = """CASE pred_class
+        WHEN 'OK' THEN 'Defect Free'
+        WHEN 'Defect' THEN 'Fault Detected'
+        ELSE 'Inspection Required'
+      END"""
+
+event_columns = f"""
+      res_id AS `Result ID`,
+      res_insert_datetime AS `Date`,
+      {result_label_sql} AS `Result Label`,
+      pred_confidence AS `Confidence Score`,
+      res_image_path AS `image_url`"""
+
+# DATETIME_TRUNC part for each trend granularity
+trend_granularities = {
+    "hour": "HOUR",
+    "day": "DAY",
+    "week": "WEEK(SUNDAY)",  # Same weeks as the metrics batch job
+    "month": "MONTH",
+}
+
+# Event list sort orders: SQL expression and parameter type of the keyset sort key
+event_sort_keys = {
+    "res_insert_datetime": ("res_insert_datetime", "DATETIME"),
+    "pred_confidence": ("IFNULL(pred_confidence, -1)", "FLOAT64"),
+}
+
+# metric_rollups columns read by each metrics dashboard tab
+rollup_tab_columns = {
+    "confidence": [
+        "conf_min AS confidence_score_min", "conf_med AS confidence_score_med",
+        "conf_mean AS confidence_score_mean", "conf_max AS confidence_score_max", "conf_sketch",
+    ],
+    "inference_time": [
+        "speed_min AS inference_time_min", "speed_med AS inference_time_med",
+        "speed_mean AS inference_time_mean", "speed_max AS inference_time_max", "speed_sketch",
+    ],
+    "prediction_class": ["pass_count AS OK", "fail_count AS Defect"],
+}
+
+def range_end(end_date):
+    """Exclusive DATETIME end of a range ending on end_date."""
+    return datetime.combine(end_date + timedelta(days=1), time.min)
+
+def date_range_params(start_date, end_date):
+    """DATETIME parameters covering start_date to end_date inclusive."""
+    return [
+        bigquery.ScalarQueryParameter("start_datetime", "DATETIME", datetime.combine(start_date, time.min)),
+        bigquery.ScalarQueryParameter("end_datetime", "DATETIME", range_end(end_date)),
+    ]
+
+def results_watermark_query():
+    """Latest res_insert_datetime and the row count of the last two days, reading only those partitions."""
+    query = f"""
+    SELECT MAX(res_insert_datetime) AS watermark, COUNT(*) AS recent_rows
+    FROM {results_table}
+    WHERE res_insert_datetime >= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL 2 DAY)
+    """
+    return query, bigquery.QueryJobConfig()
+
+def rollups_watermark_query():
+    """Latest hour rollup end and the rows counted in all hours; both change whenever the batch job writes rollups."""
+    query = f"""
+    SELECT MAX(aggregation_end) AS watermark, SUM(row_count) AS rolled_up_rows
+    FROM {rollups_table}
+    WHERE granularity = 'hour'
+    """
+    return query, bigquery.QueryJobConfig()
+
+def rollup_query(granularity, start_date, end_date):
+    """metric_rollups rows at granularity starting in the date range, with the columns of every dashboard tab."""
+    columns = [column for tab_columns in rollup_tab_columns.values() for column in tab_columns]
+    query = f"""
+    SELECT
+      aggregation_start,
+      aggregation_end,
+      {', '.join(columns)}
+    FROM {rollups_table}
+    WHERE granularity = @granularity
+      AND aggregation_start >= @start_datetime AND aggregation_start < @end_datetime
+    ORDER BY aggregation_start
+    """
+    params = [bigquery.ScalarQueryParameter("granularity", "STRING", granularity), *date_range_params(start_date, end_date)]
+    return query, bigquery.QueryJobConfig(query_parameters=params)
+
+def partition_bounds_query():
+    """First and last partition day of inference_results, from metadata (no table bytes scanned)."""
+    query = f"""
+    SELECT
+      PARSE_DATE('%Y%m%d', MIN(partition_id)) AS min_date,
+      PARSE_DATE('%Y%m%d', MAX(partition_id)) AS max_date
+    FROM `{project_id}.{dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+    WHERE table_name = 'inference_results'
+      AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+    """
+    return query, bigquery.QueryJobConfig()
+
+def kpi_trend_query(start_date, end_date, granularity="day"):
+    """Inspection count per period and result label; the KPI tiles are its column sums."""
+    query = f"""
+    SELECT
+      DATETIME_TRUNC(res_insert_datetime, {trend_granularities[granularity]}) AS `Date`,
+      {result_label_sql} AS `Result Label`,
+      COUNT(*) AS `Count`
+    FROM {results_table}
+    WHERE {partition_filter}
+    GROUP BY `Date`, `Result Label`
+    ORDER BY `Date`, `Result Label`
+    """
+    return query, bigquery.QueryJobConfig(query_parameters=date_range_params(start_date, end_date))
+
+def event_filter(start_date, end_date, labels=None, min_confidence=None, max_confidence=None):
+    """WHERE clause and parameters for the event list filters; the date range is always applied.
+
+    labels is a list of grid labels (None for all), confidences are inclusive bounds.
+    """
+    conditions, params = [partition_filter], date_range_params(start_date, end_date)
+
+    if labels is not None:
+        label_conditions = []
+        classes = [result_labels[label] for label in labels if label in result_labels]
+        if classes:
+            label_conditions.append("pred_class IN UNNEST(@pred_classes)")
+            params.append(bigquery.ArrayQueryParameter("pred_classes", "STRING", classes))
+        if other_label in labels:
+            label_conditions.append("(pred_class IS NULL OR pred_class NOT IN UNNEST(@known_classes))")
+            params.append(bigquery.ArrayQueryParameter("known_classes", "STRING", list(result_labels.values())))
+        conditions.append(f"({' OR '.join(label_conditions)})" if label_conditions else "FALSE")
+
+    if min_confidence is not None:
+        conditions.append("pred_confidence >= @min_confidence")
+        params.append(bigquery.ScalarQueryParameter("min_confidence", "FLOAT64", min_confidence))
+    if max_confidence is not None:
+        conditions.append("pred_confidence <= @max_confidence")
+        params.append(bigquery.ScalarQueryParameter("max_confidence", "FLOAT64", max_confidence))
+
+    return " AND ".join(conditions), params
+
+def event_page_query(start_date, end_date, labels=None, min_confidence=None, max_confidence=None,
+                     sort_by="res_insert_datetime", descending=False, after=None, limit=100):
+    """Up to limit event rows following the keyset cursor after = (sort key, res_id), in sort order.
+
+    Rows also carry their sort key as `sort_key`, for the cursor of the next page.
+    """
+    where, params = event_filter(start_date, end_date, labels, min_confidence, max_confidence)
+    sort_expr, sort_type = event_sort_keys[sort_by]
+    op, direction = ("<", "DESC") if descending else (">", "ASC")
+
+    if after is not None:
+        where += f" AND ({sort_expr} {op} @after_key OR ({sort_expr} = @after_key AND res_id {op} @after_id))"
+        params += [
+            bigquery.ScalarQueryParameter("after_key", sort_type, after[0]),
+            bigquery.ScalarQueryParameter("after_id", "STRING", after[1]),
+        ]
+
+    query = f"""
+    SELECT{event_columns},
+      {sort_expr} AS sort_key
+    FROM {results_table}
+    WHERE {where}
+    ORDER BY sort_key {direction}, res_id {direction}
+    LIMIT {int(limit)}
+    """
+    return query, bigquery.QueryJobConfig(query_parameters=params)
+
+def event_count_query(start_date, end_date, labels=None, min_confidence=None, max_confidence=None):
+    where, params = event_filter(start_date, end_date, labels, min_confidence, max_confidence)
+    query = f"""
+    SELECT COUNT(*) AS total_rows
+    FROM {results_table}
+    WHERE {where}
+    """
+    return query, bigquery.QueryJobConfig(query_parameters=params)
+
+def comments_query(result_ids):
+    """Comments on any of result_ids, newest first; comments is clustered on result_id."""
+    query = f"""
+    SELECT result_id, comment_text, comment_datetime
+    FROM {comments_table}
+    WHERE result_id IN UNNEST(@result_ids)
+    ORDER BY comment_datetime DESC
+    """
+    params = [bigquery.ArrayQueryParameter("result_ids", "STRING", list(result_ids))]
+    return query, bigquery.QueryJobConfig(query_parameters=params)
+
+def outlier_insights_query(start_date, end_date):
+    """Lowest confidence, highest inference time and most defects in a day, in one pass over the range.
+
+    Rows are reduced to one per day first, then the days to a single row, so the table is
+    read once instead of once per insight.
+    """
+    query = f"""
+    WITH daily AS (
+      SELECT
+        DATE(res_insert_datetime) AS day,
+        COUNTIF(pred_class = 'Defect') AS defect_count,
+        ARRAY_AGG(STRUCT(pred_confidence AS value, res_insert_datetime AS at)
+                  ORDER BY pred_confidence ASC NULLS LAST LIMIT 1)[OFFSET(0)] AS lowest_confidence,
+        ARRAY_AGG(STRUCT(pred_speed AS value, res_insert_datetime AS at)
+                  ORDER BY pred_speed DESC NULLS LAST LIMIT 1)[OFFSET(0)] AS highest_inference
+      FROM {results_table}
+      WHERE {partition_filter}
+      GROUP BY day
+    ),
+    picked AS (
+      SELECT
+        ARRAY_AGG(lowest_confidence ORDER BY lowest_confidence.value ASC NULLS LAST LIMIT 1)[SAFE_OFFSET(0)] AS lowest_confidence,
+        ARRAY_AGG(highest_inference ORDER BY highest_inference.value DESC NULLS LAST LIMIT 1)[SAFE_OFFSET(0)] AS highest_inference,
+        ARRAY_AGG(IF(defect_count > 0, STRUCT(day, defect_count), NULL) IGNORE NULLS
+                  ORDER BY defect_count DESC LIMIT 1)[SAFE_OFFSET(0)] AS most_defects
+      FROM daily
+    )
+
+    SELECT
+      lowest_confidence.value AS lowest_confidence_score,
+      lowest_confidence.at AS lowest_confidence_date,
+      highest_inference.value AS highest_inference_time,
+      highest_inference.at AS highest_inference_date,
+      most_defects.day AS most_defect_day,
+      most_defects.defect_count AS most_defect_count
+    FROM picked
+    """
+    return query, bigquery.QueryJobConfig(query_parameters=date_range_params(start_date, end_date))
+
+# Builders the bytes-scanned report runs for a date range
+dashboard_queries = {
+    "kpi_trend": kpi_trend_query,
+    "event_page": event_page_query,
+    "outlier_insights": outlier_insights_query,
+}
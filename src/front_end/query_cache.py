@@ -0,0 +1,173 @@
+"""Query result cache shared by every dashboard session.
+
+Entries are keyed on the query builder and its normalized parameters, so equal
+sidebar selections hit the same entry in every session. Each entry is stamped
+with its source table's watermark when fetched. The watermark is re-read at most
+every QUERY_CACHE_WATERMARK_CHECK_S seconds with a cheap query, and an entry is
+refetched once the watermark moves on.
+
+inference_results rows are stamped with res_insert_datetime before the listener's
+buffered (and possibly retried) write, so a row can land after a later-stamped one.
+Entries whose range ended at least WATERMARK_LAG_MINUTES before the watermark they
+were fetched at stay valid as new rows arrive, like the batch job's watermark lag.
+
+The cache is bounded by the pandas memory of its entries. Least recently used
+entries are evicted, and they are written to Parquet under QUERY_CACHE_SPILL_DIR
+if it is set, to be read back instead of rerunning the query.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+import pandas as pd
+import streamlit as st
+from bq_fetch import fetch_dataframe
+from queries import results_watermark_query, rollups_watermark_query
+
+cache_max_mb = int(os.environ.get("QUERY_CACHE_MAX_MB", "256"))
+spill_dir = os.environ.get("QUERY_CACHE_SPILL_DIR")  # Unset: evicted entries are dropped
+spill_max_mb = int(os.environ.get("QUERY_CACHE_SPILL_MAX_MB", "2048"))
+watermark_check_s = float(os.environ.get("QUERY_CACHE_WATERMARK_CHECK_S", "60"))
+# Rows stamped up to this long before the watermark may still be on their way
+watermark_lag = timedelta(minutes=int(os.environ.get("WATERMARK_LAG_MINUTES", "5")))
+
+# Watermark query of each cached source table
+watermark_queries = {
+    "inference_results": results_watermark_query,
+    "metric_rollups": rollups_watermark_query,
+}
+
+def normalize(value):
+    """JSON-safe form of a parameter value, equal for equal selections."""
+    if isinstance(value, dict):
+        return {str(key): normalize(value[key]) for key in sorted(value)}
+    if isinstance(value, (set, frozenset)):
+        return sorted((normalize(item) for item in value), key=json.dumps)
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "item"):  # numpy scalar
+        value = value.item()
+    if isinstance(value, float):
+        return round(value, 9)
+    return value
+
+def cache_key(name, params):
+    return json.dumps([name, normalize(params)], sort_keys=True)
+
+class QueryCache:
+    def __init__(self, max_bytes, spill_dir=None, spill_max_bytes=0, watermark_check_s=60, watermark_lag=timedelta(minutes=5)):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.watermark_check_s = watermark_check_s
+        self.watermark_lag = watermark_lag
+        self._entries = OrderedDict()  # key -> (df, watermark, range_end, nbytes), least recently used first
+        self._spilled = OrderedDict()  # key -> (path, watermark, range_end, nbytes)
+        self._bytes = 0
+        self._spilled_bytes = 0
+        self._watermarks = {}  # source -> (watermark, checked at)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def watermark(self, source):
+        """Current watermark of source, re-read when the last check is older than watermark_check_s."""
+        with self._lock:
+            cached = self._watermarks.get(source)
+        if cached and time.monotonic() - cached[1] < self.watermark_check_s:
+            return cached[0]
+        row = fetch_dataframe(*watermark_queries[source]()).iloc[0]
+        watermark = tuple(None if pd.isna(value) else value for value in row)
+        with self._lock:
+            self._watermarks[source] = (watermark, time.monotonic())
+        return watermark
+
+    def _is_valid(self, entry_watermark, range_end, watermark):
+        if entry_watermark == watermark:
+            return True
+        # Rows inserted after the entry's watermark fall outside a range that ended a lag before it
+        return range_end is not None and entry_watermark[0] is not None and range_end <= entry_watermark[0] - self.watermark_lag
+
+    def fetch(self, build, source, params, range_end=None):
+        """Result of the query build(**params) over source, from the cache while it is still valid.
+
+        range_end is the exclusive res_insert_datetime end of the rows the query reads, if bounded.
+        Callers get a copy and may modify it.
+        """
+        key = cache_key(build.__name__, params)
+        watermark = self.watermark(source)
+        df = self._lookup(key, watermark)
+        if df is None:
+            df = fetch_dataframe(*build(**params))
+            self._store(key, df, watermark, range_end)
+        return df.copy()
+
+    def _lookup(self, key, watermark):
+        with self._lock:
+            if key in self._entries:
+                df, entry_watermark, range_end, _ = self._entries[key]
+                if self._is_valid(entry_watermark, range_end, watermark):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return df
+                self._drop(key)
+            elif key in self._spilled:
+                path, entry_watermark, range_end, nbytes = self._spilled.pop(key)
+                self._spilled_bytes -= nbytes
+                if self._is_valid(entry_watermark, range_end, watermark):
+                    df = pd.read_parquet(path)
+                    os.remove(path)
+                    self._insert(key, df, entry_watermark, range_end)
+                    self.hits += 1
+                    return df
+                os.remove(path)
+            self.misses += 1
+            return None
+
+    def _store(self, key, df, watermark, range_end):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._insert(key, df, watermark, range_end)
+
+    def _insert(self, key, df, watermark, range_end):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        self._entries[key] = (df, watermark, range_end, nbytes)
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes and self._entries:
+            old_key = next(iter(self._entries))
+            old_df, old_watermark, old_range_end, _ = self._entries[old_key]
+            self._drop(old_key)
+            if self.spill_dir:
+                self._spill(old_key, old_df, old_watermark, old_range_end)
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)[3]
+
+    def _spill(self, key, df, watermark, range_end):
+        path = os.path.join(self.spill_dir, hashlib.sha256(key.encode()).hexdigest() + ".parquet")
+        df.to_parquet(path, index=False)
+        nbytes = os.path.getsize(path)
+        self._spilled[key] = (path, watermark, range_end, nbytes)
+        self._spilled_bytes += nbytes
+        while self._spilled_bytes > self.spill_max_bytes and self._spilled:
+            old_path, _, _, old_bytes = self._spilled.popitem(last=False)[1]
+            self._spilled_bytes -= old_bytes
+            os.remove(old_path)
+
+@st.cache_resource
+def get_query_cache():
+    """The process-wide cache, shared by every session."""
+    return QueryCache(
+        max_bytes=cache_max_mb * 2**20,
+        spill_dir=spill_dir,
+        spill_max_bytes=spill_max_mb * 2**20,
+        watermark_check_s=watermark_check_s,
+        watermark_lag=watermark_lag,
+    )
@@ -0,0 +1,155 @@
+"""Bytes scanned per event-list query, for the previous full-table queries and the
+partition-filtered builders in queries.py.
+
+With credentials, each query is dry-run on BigQuery, which reports the bytes it would
+process without running it or incurring cost:
+
+    python query_report.py --start 2025-03-01 --end 2025-03-07
+
+Without credentials, --stand-in estimates the same figure from a table model: bytes per
+referenced column x rows in the partitions read. The model prunes partitions on the
+@start_datetime/@end_datetime filter but not on clustering, so it is an upper bound for
+filtered queries:
+
+    python query_report.py --stand-in --rows-per-day 200000 --days 365 --start 2025-03-01 --end 2025-03-07
+"""
+import argparse
+import re
+from datetime import date, timedelta
+from queries import dashboard_queries
+
+# The queries event_list.py ran before the date range was pushed down, verbatim
+legacy_event_data = """
+    SELECT 
+      res_id AS `Result ID`, 
+      res_insert_datetime AS `Date`,
+      CASE pred_class
+        WHEN 'OK' THEN 'Defect Free'
+        WHEN 'Defect' THEN 'Fault Detected'
+        ELSE 'Inspection Required'
+      END AS `Result Label`,
+      pred_confidence AS `Confidence Score`,
+      res_image_path AS `image_url`
+    FROM `cast-defect-detection.cast_defect_detection.inference_results`
+    ORDER BY `Date`
+    """
+
+legacy_queries = {
+    "kpi_trend": legacy_event_data,  # Counted in pandas from the whole table
+    "event_page": legacy_event_data,  # The grid was fed the whole table
+    "outlier_insights": """
+    WITH base AS (
+      SELECT 
+        res_id,
+        res_insert_datetime,
+        pred_confidence,
+        pred_Speed,
+        pred_class
+      FROM `cast-defect-detection.cast_defect_detection.inference_results`
+    ),
+    defects_per_day AS (
+      SELECT DATE(res_insert_datetime) AS defect_date, COUNT(*) AS defect_count
+      FROM base
+      WHERE pred_class = 'Defect'
+      GROUP BY defect_date
+      ORDER BY defect_count DESC
+      LIMIT 1
+    ),
+    lowest_confidence AS (
+      SELECT res_id, pred_confidence, res_insert_datetime
+      FROM base
+      ORDER BY pred_confidence ASC
+      LIMIT 1
+    ),
+    highest_inference_time AS (
+      SELECT res_id, pred_Speed, res_insert_datetime
+      FROM base
+      ORDER BY pred_Speed DESC
+      LIMIT 1
+    )
+
+    SELECT 
+      (SELECT pred_confidence FROM lowest_confidence) AS lowest_confidence_score,
+      (SELECT res_insert_datetime FROM lowest_confidence) AS lowest_confidence_date,
+      (SELECT pred_Speed FROM highest_inference_time) AS highest_inference_time,
+      (SELECT res_insert_datetime FROM highest_inference_time) AS highest_inference_date,
+      (SELECT defect_date FROM defects_per_day) AS most_defect_day,
+      (SELECT defect_count FROM defects_per_day) AS most_defect_count
+    """,
+}
+
+# Average stored bytes per value: 8 for numbers/DATETIME, 2 + UTF-8 length for STRING
+column_bytes = {
+    "res_id": 38,
+    "res_image_path": 90,
+    "raw_image_path": 80,
+    "model_ver": 4,
+    "pred_class": 6,
+    "pred_confidence": 8,
+    "pred_speed": 8,
+    "res_insert_datetime": 8,
+}
+
+class DryRunJob:
+    def __init__(self, total_bytes_processed):
+        self.total_bytes_processed = total_bytes_processed
+
+class DryRunStandIn:
+    """Estimates total_bytes_processed for inference_results queries, like a dry run would."""
+
+    def __init__(self, rows_per_day, days, last_day=None):
+        self.rows_per_day = rows_per_day
+        self.last_day = last_day or date.today()
+        self.first_day = self.last_day - timedelta(days=days - 1)
+
+    def query(self, query, job_config=None):
+        columns = [col for col in column_bytes if re.search(rf"\b{col}\b", query, re.IGNORECASE)]
+        params = {p.name: p.value for p in (job_config.query_parameters if job_config else [])}
+        first, last = self.first_day, self.last_day
+        if "start_datetime" in params and "end_datetime" in params:
+            first = max(first, params["start_datetime"].date())
+            last = min(last, (params["end_datetime"] - timedelta(microseconds=1)).date())
+        days = max(0, (last - first).days + 1)
+        return DryRunJob(days * self.rows_per_day * sum(column_bytes[col] for col in columns))
+
+def dry_run_bytes(client, query, job_config=None):
+    from google.cloud import bigquery
+
+    config = bigquery.QueryJobConfig(
+        dry_run=True,
+        use_query_cache=False,
+        query_parameters=job_config.query_parameters if job_config else [],
+    )
+    return client.query(query, job_config=config).total_bytes_processed
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if n < 1024 or unit == "TB":
+            return f"{n:,.1f} {unit}"
+        n /= 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--start", type=date.fromisoformat, default=date.today() - timedelta(days=6), help="sidebar start date")
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today(), help="sidebar end date")
+    parser.add_argument("--stand-in", action="store_true", help="estimate locally instead of dry-running on BigQuery")
+    parser.add_argument("--rows-per-day", type=int, default=200000, help="stand-in rows per daily partition")
+    parser.add_argument("--days", type=int, default=365, help="stand-in days of data, ending --end")
+    args = parser.parse_args()
+
+    if args.stand_in:
+        client = DryRunStandIn(args.rows_per_day, args.days, args.end)
+    else:
+        from google.cloud import bigquery
+        client = bigquery.Client()
+
+    print(f"Range {args.start} to {args.end} ({'stand-in' if args.stand_in else 'BigQuery dry run'})")
+    print(f"{'query':<18} {'full table':>14} {'partition filter':>18} {'reduction':>10}")
+    for name, build in dashboard_queries.items():
+        before = dry_run_bytes(client, legacy_queries[name])
+        after = dry_run_bytes(client, *build(args.start, args.end))
+        reduction = before / after if after else float("inf")
+        print(f"{name:<18} {format_bytes(before):>14} {format_bytes(after):>18} {reduction:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Mergeable quantile sketch shared by the metrics job and the dashboards.
+
+The same file is deployed with both, as src/batch/metrics/sketch.py and
+src/front_end/sketch.py; batch/metrics/test_sketch.py fails if the copies differ.
+"""
+import json
+import math
+
+class QuantileSketch:
+    """Mergeable quantile sketch with a relative error bound (DDSketch-style log buckets).
+
+    Values are counted in buckets whose bounds grow by gamma = (1 + a) / (1 - a), so any
+    quantile is returned within relative_accuracy a of a value at that rank. Two sketches
+    with the same accuracy merge by adding bucket counts, which lets partial aggregates
+    for different time ranges be combined without the raw rows.
+    """
+
+    min_value = 1e-9  # Values at or below this (including 0) share one bucket
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}  # bucket index -> count
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value <= self.min_value:
+            self.zero_count += count
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+
+    def add_bucket(self, index, count):
+        """Adds count values to bucket index (None for the zero bucket), e.g. counts from bucket_sql()."""
+        if index is None:
+            self.zero_count += count
+        else:
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+
+    def bucket_sql(self, column):
+        """SQL expression for the bucket index add() would use for column; NULL for the zero bucket."""
+        return f"IF({column} <= {self.min_value}, NULL, CAST(CEIL(LN({column}) / {self._log_gamma!r}) AS INT64))"
+
+    def update(self, values):
+        for value in values:
+            self.add(float(value))
+        return self
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    @classmethod
+    def merge_all(cls, sketches, relative_accuracy=0.01):
+        """Merges sketches (QuantileSketch objects or to_json() strings; others are skipped) into a new sketch."""
+        merged = cls(relative_accuracy)
+        for sketch in sketches:
+            if isinstance(sketch, str):
+                sketch = cls.from_json(sketch)
+            if isinstance(sketch, cls):
+                merged.merge(sketch)
+        return merged
+
+    def quantile(self, q):
+        """Returns the approximate q-quantile (0 <= q <= 1), or None for an empty sketch."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def quantiles(self, qs):
+        """Returns the approximate quantile for each q in qs, e.g. (0.5, 0.9, 0.99)."""
+        return [self.quantile(q) for q in qs]
+
+    def to_json(self):
+        return json.dumps({
+            "a": self.relative_accuracy,
+            "z": self.zero_count,
+            "b": {str(index): self.bins[index] for index in sorted(self.bins)},
+        }, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data):
+        if not data:
+            return cls()
+        state = json.loads(data)
+        sketch = cls(state["a"])
+        sketch.zero_count = state["z"]
+        sketch.bins = {int(index): count for index, count in state["b"].items()}
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
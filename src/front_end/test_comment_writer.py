@@ -0,0 +1,111 @@
+"""CommentWriter batching, journal replay, retries and dead letters, on a fake BigQuery client.
+
+    pip install pytest -r requirements.txt
+    python -m pytest test_comment_writer.py
+"""
+import json
+import threading
+import time
+from datetime import datetime
+import pytest
+from comment_writer import CommentWriter
+
+class FakeBigQueryClient:
+    """insert_rows_json() that raises on the first transport_failures calls, then stores rows by insert id.
+
+    Comments longer than max_text are rejected, and the rest of their request is "stopped", as in BigQuery.
+    """
+
+    def __init__(self, transport_failures=0, max_text=100):
+        self.transport_failures = transport_failures
+        self.max_text = max_text
+        self.rows = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def insert_rows_json(self, table_id, rows, row_ids):
+        with self._lock:
+            self.calls += 1
+            if self.transport_failures:
+                self.transport_failures -= 1
+                raise ConnectionError("Error: connection reset")
+            invalid = {i for i, row in enumerate(rows) if len(row["comment_text"]) > self.max_text}
+            if invalid:
+                return [
+                    {"index": i, "errors": [{"reason": "invalid" if i in invalid else "stopped", "message": ""}]}
+                    for i in range(len(rows))
+                ]
+            self.rows.update(zip(row_ids, rows))
+            return []
+
+def wait_until_written(writer, timeout=5):
+    deadline = time.monotonic() + timeout
+    while writer.pending():
+        assert time.monotonic() < deadline, f"{writer.pending()} comments still pending"
+        time.sleep(0.01)
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "journal.jsonl"), str(tmp_path / "dead_letter.jsonl")
+
+def make_writer(client, paths, **kwargs):
+    return CommentWriter(client, "comments", *paths, max_wait_ms=20, backoff_s=0.01, **kwargs)
+
+def test_comments_share_a_batch(paths):
+    client = FakeBigQueryClient()
+    writer = make_writer(client, paths, max_batch_rows=10)
+    for i in range(10):
+        writer.submit(f"r{i}", f"comment {i}", datetime(2025, 3, 4, 12, 0, i))
+    wait_until_written(writer)
+    assert client.calls == 1
+    assert sorted(row["result_id"] for row in client.rows.values()) == [f"r{i}" for i in range(10)]
+    with open(paths[0]) as f:
+        assert f.read() == ""
+
+def test_unwritten_comments_are_replayed_from_the_journal(paths):
+    entries = [{"insert_id": f"id{i}", "row": {"result_id": "r1", "comment_text": f"c{i}", "comment_datetime": "2025-03-04 12:00:00.000000"}}
+               for i in range(3)]
+    with open(paths[0], "w") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+    client = FakeBigQueryClient()
+    writer = make_writer(client, paths)
+    wait_until_written(writer)
+    assert sorted(client.rows) == ["id0", "id1", "id2"]  # Written with their original insert ids
+
+def test_transport_errors_are_retried(paths):
+    client = FakeBigQueryClient(transport_failures=3)
+    writer = make_writer(client, paths)
+    insert_id = writer.submit("r1", "looks fine", datetime(2025, 3, 4, 12, 0))
+    wait_until_written(writer)
+    assert client.calls == 4
+    assert list(client.rows) == [insert_id]
+    assert writer.last_error is None
+    assert writer.rejected == 0
+
+def test_rejected_rows_go_to_dead_letters(paths):
+    client = FakeBigQueryClient(max_text=20)
+    writer = make_writer(client, paths, max_batch_rows=3)
+    writer.submit("r1", "ok", datetime(2025, 3, 4, 12, 0))
+    rejected_id = writer.submit("r2", "x" * 50, datetime(2025, 3, 4, 12, 1))
+    writer.submit("r3", "also ok", datetime(2025, 3, 4, 12, 2))
+    wait_until_written(writer)
+
+    assert sorted(row["result_id"] for row in client.rows.values()) == ["r1", "r3"]
+    assert writer.rejected == 1
+    assert writer.last_rejection
+    with open(paths[1]) as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert [(entry["insert_id"], entry["errors"][0]["reason"]) for entry in dead_letters] == [(rejected_id, "invalid")]
+
+    # Not replayed by the next process
+    restarted = make_writer(FakeBigQueryClient(), paths)
+    assert restarted.pending() == 0
+
+def test_pending_comments_until_written(paths):
+    client = FakeBigQueryClient(transport_failures=1000)
+    writer = make_writer(client, paths)
+    writer.submit("r1", "waiting", datetime(2025, 3, 4, 12, 0))
+    time.sleep(0.1)
+    assert writer.pending_comments(["r1", "r2"]) == [("r1", "waiting", datetime(2025, 3, 4, 12, 0))]
+    assert writer.last_error
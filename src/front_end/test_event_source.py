@@ -0,0 +1,109 @@
+"""Keyset pagination, prefetching and page eviction of EventSource, on an in-memory fake of BigQuery.
+
+    pip install pytest -r requirements.txt
+    python -m pytest test_event_source.py
+"""
+import math
+import re
+from datetime import date, datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+import event_source
+from event_source import EventSource
+
+filters = {"start_date": date(2025, 3, 2), "end_date": date(2025, 3, 4)}
+
+class FakeResults:
+    """Answers event_page_query and event_count_query from a DataFrame, ignoring the filters."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.page_queries = 0
+
+    def fetch_dataframe(self, query, job_config=None, bq_client=None):
+        if "COUNT(*) AS total_rows" in query:
+            return pd.DataFrame({"total_rows": [len(self.rows)]})
+
+        self.page_queries += 1
+        params = {p.name: p.value for p in job_config.query_parameters}
+        sort_key = self.rows["res_insert_datetime"] if "res_insert_datetime AS sort_key" in query else self.rows["pred_confidence"].fillna(-1)
+        descending = "DESC" in query
+        rows = self.rows.assign(sort_key=sort_key)
+        if "after_key" in params:
+            key, res_id = params["after_key"], params["after_id"]
+            after = (rows["sort_key"] < key) | ((rows["sort_key"] == key) & (rows["res_id"] < res_id)) if descending else \
+                    (rows["sort_key"] > key) | ((rows["sort_key"] == key) & (rows["res_id"] > res_id))
+            rows = rows[after]
+        limit = int(re.search(r"LIMIT (\d+)", query).group(1))
+        rows = rows.sort_values(["sort_key", "res_id"], ascending=not descending).head(limit)
+        return rows.rename(columns={"res_id": "Result ID", "res_insert_datetime": "Date"}).reset_index(drop=True)
+
+    def expected_ids(self, sort_by, descending):
+        key = self.rows["res_insert_datetime"] if sort_by == "res_insert_datetime" else self.rows["pred_confidence"].fillna(-1)
+        return self.rows.assign(key=key).sort_values(["key", "res_id"], ascending=not descending)["res_id"].tolist()
+
+def make_rows(n, start=datetime(2025, 3, 2), seed=0):
+    rng = np.random.default_rng(seed)
+    confidence = rng.choice([0.25, 0.5, 0.75, np.nan], n)  # Many ties, broken on res_id
+    return pd.DataFrame({
+        "res_id": [f"r{seed}-{i:05d}" for i in range(n)],
+        "res_insert_datetime": [start + timedelta(seconds=int(s)) for s in rng.integers(0, 2 * 86400, n)],
+        "pred_confidence": confidence,
+    })
+
+@pytest.fixture
+def results(monkeypatch):
+    fake = FakeResults(make_rows(437))
+    monkeypatch.setattr(event_source, "fetch_dataframe", fake.fetch_dataframe)
+    return fake
+
+def read_all(source):
+    return pd.concat([source.page(i) for i in range(source.page_count())])["Result ID"].tolist()
+
+@pytest.mark.parametrize("sort_by", ["res_insert_datetime", "pred_confidence"])
+@pytest.mark.parametrize("descending", [False, True])
+def test_pages_follow_sort_order(results, sort_by, descending):
+    source = EventSource(None, filters, sort_by, descending, page_size=50)
+    assert read_all(source) == results.expected_ids(sort_by, descending)
+    assert source.page(source.page_count()).empty  # Past the last page
+
+def test_reading_forward_fetches_each_window_once(results):
+    source = EventSource(None, filters, page_size=50, prefetch_pages=2)
+    read_all(source)
+    # One query per window of 1 + prefetch_pages pages, each started ahead of the reader
+    assert results.page_queries == math.ceil(source.page_count() / 3)
+
+def test_smallest_cache_never_evicts_requested_page(results):
+    source = EventSource(None, filters, page_size=50, prefetch_pages=2, max_cached_pages=3)
+    expected = results.expected_ids("res_insert_datetime", False)
+    for index in [0, 1, 5, 6, 0, 8, 2]:
+        assert source.page(index)["Result ID"].tolist() == expected[index * 50:(index + 1) * 50]
+        assert len(source._pages) <= 3
+
+def test_cache_must_hold_prefetch_window():
+    with pytest.raises(ValueError):
+        EventSource(None, filters, prefetch_pages=2, max_cached_pages=2)
+
+def test_no_rows(monkeypatch):
+    fake = FakeResults(make_rows(0))
+    monkeypatch.setattr(event_source, "fetch_dataframe", fake.fetch_dataframe)
+    source = EventSource(None, filters, page_size=50)
+    assert source.page(0).empty
+    assert source.page_count() == 1
+
+def test_refresh_picks_up_new_results(results):
+    source = EventSource(None, filters, page_size=50)
+    source.refresh((datetime(2025, 3, 4), 437))
+    read_all(source)
+    queries = results.page_queries
+
+    source.refresh((datetime(2025, 3, 4), 437))  # Same watermark: pages stay loaded
+    source.page(0)
+    assert results.page_queries == queries
+
+    results.rows = pd.concat([results.rows, make_rows(30, start=datetime(2025, 3, 4), seed=1)], ignore_index=True)
+    assert source.total_rows() == 437
+    source.refresh((datetime(2025, 3, 5), 467))
+    assert source.total_rows() == 467
+    assert read_all(source) == results.expected_ids("res_insert_datetime", False)
@@ -0,0 +1,51 @@
+"""Watermark invalidation of QueryCache entries, with the queries answered by a fake.
+
+    pip install pytest -r requirements.txt
+    python -m pytest test_query_cache.py
+"""
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+import query_cache
+from query_cache import QueryCache
+
+def range_query(start, end):
+    return f"range {start} {end}", None
+
+@pytest.fixture
+def source(monkeypatch):
+    """Latest res_insert_datetime of the fake table, and the number of range queries run."""
+    state = {"watermark": datetime(2025, 3, 4, 12, 0), "queries": 0}
+
+    def fetch_dataframe(query, job_config=None, bq_client=None):
+        if query.startswith("range"):
+            state["queries"] += 1
+            return pd.DataFrame({"rows": [state["queries"]]})
+        return pd.DataFrame({"watermark": [pd.Timestamp(state["watermark"])], "recent_rows": [0]})
+
+    monkeypatch.setattr(query_cache, "fetch_dataframe", fetch_dataframe)
+    monkeypatch.setitem(query_cache.watermark_queries, "inference_results", lambda: ("watermark", None))
+    return state
+
+def fetch(cache, end):
+    params = {"start": datetime(2025, 3, 4), "end": end}
+    return cache.fetch(range_query, "inference_results", params, range_end=end)
+
+@pytest.mark.parametrize("range_end_before, refetched", [
+    (timedelta(hours=1), False),  # Well before the watermark: no late row can land in it
+    (timedelta(seconds=15), True),  # A row stamped before range_end may still be buffered
+])
+def test_closed_range_outlives_watermark_after_lag(source, range_end_before, refetched):
+    cache = QueryCache(2**20, watermark_check_s=0, watermark_lag=timedelta(minutes=5))
+    end = source["watermark"] - range_end_before
+    fetch(cache, end)
+
+    source["watermark"] += timedelta(seconds=30)
+    fetch(cache, end)
+    assert source["queries"] == (2 if refetched else 1)
+
+def test_same_watermark_hits(source):
+    cache = QueryCache(2**20, watermark_check_s=0)
+    fetch(cache, source["watermark"])
+    fetch(cache, source["watermark"])
+    assert (source["queries"], cache.hits) == (1, 1)
@@ -0,0 +1,68 @@
+"""CPU inference backends for the YOLO classifier, selected with INFERENCE_BACKEND.
+
+    torch     the .pt weights run by PyTorch (default)
+    onnx      weights exported to ONNX and run by ONNX Runtime
+    openvino  weights exported to OpenVINO IR (needs the openvino package)
+
+Every backend is loaded through ultralytics, so predictions come back as the same
+Results objects whichever backend is used.
+"""
+import os
+import numpy as np
+import torch
+from ultralytics import YOLO
+
+inference_backend = os.environ.get("INFERENCE_BACKEND", "torch")
+
+# Intra-op threads of the process, shared by its model replicas; defaults to the CPUs available to the instance
+# (sched_getaffinity is Linux only, so elsewhere all CPUs of the machine)
+available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+inference_threads = int(os.environ.get("INFERENCE_THREADS", "0")) or available_cpus
+
+backends = ("torch", "onnx", "openvino")
+
+def export_model(weights_path, backend):
+    """Exports .pt weights for backend next to the original file, once, and returns the exported path."""
+    if backend == "torch" or not weights_path.endswith(".pt"):
+        return weights_path
+
+    stem = os.path.splitext(weights_path)[0]
+    exported = {"onnx": f"{stem}.onnx", "openvino": f"{stem}_openvino_model"}[backend]
+    if not os.path.exists(exported):
+        # dynamic=True keeps the batch dimension open for the micro-batcher
+        exported = YOLO(weights_path).export(format=backend, dynamic=True, verbose=False)
+        print(f"Exported {weights_path} to {exported}")
+    return exported
+
+def _tune_onnx_session(model, weights_path, threads):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    model.predictor.model.session = ort.InferenceSession(weights_path, options, providers=["CPUExecutionProvider"])
+
+def load_model(weights_path, backend=None, threads=None, replicas=1):
+    """Loads weights_path for backend (default INFERENCE_BACKEND), tuned for threads CPUs and warmed up.
+
+    threads defaults to this replica's share of inference_threads when replicas models
+    predict in parallel, so together they do not oversubscribe the CPUs.
+    """
+    backend = backend or inference_backend
+    threads = threads or max(inference_threads // replicas, 1)
+    if backend not in backends:
+        raise ValueError(f"Error: Unknown inference backend '{backend}', expected one of {backends}.")
+
+    # Process-wide: every replica sets the same per-replica share
+    torch.set_num_threads(threads)
+    path = export_model(weights_path, backend)
+    model = YOLO(path, task="classify")
+
+    # The first predict builds the predictor, so warm up before tuning the ONNX session
+    model.predict(np.zeros((64, 64, 3), dtype=np.uint8), verbose=False)
+    if path.endswith(".onnx"):
+        _tune_onnx_session(model, path, threads)
+
+    print(f"Loaded {path} with {backend} backend and {threads} threads")
+    return model
@@ -0,0 +1,52 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+class MicroBatcher:
+    """Collects images submitted by concurrent invocations and predicts them in one forward pass.
+
+    A batch is run as soon as max_batch_size images are waiting, or max_wait_ms after
+    the first image of the batch arrived, whichever comes first.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=16, max_wait_ms=50):
+        self.predict_batch = predict_batch  # list of images -> list of results, same order
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """Queues a decoded image and returns a Future resolving to its result."""
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.predict_batch([image for image, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"Expected {len(batch)} results, got {len(results)}")
+                for (_, future), res in zip(batch, results):
+                    future.set_result(res)
+            except Exception as e:
+                print(f"Error predicting batch of {len(batch)} images: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
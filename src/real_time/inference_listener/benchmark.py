@@ -0,0 +1,246 @@
+"""Local benchmarks for the inference listener.
+
+Runs against the local filesystem stand-in for GCS (see local_gcs.py), e.g.
+
+    mkdir -p local_gcs/metal_casting_model
+    cp ../../../notebooks/model_training/v0.pt local_gcs/metal_casting_model/
+    python benchmark.py model-cache --root local_gcs ../../../notebooks/model_training/*.jpeg
+    python benchmark.py batch --root local_gcs --burst 16 ../../../notebooks/model_training/*.jpeg
+
+The backends benchmark compares the per-image latency of the PyTorch, ONNX Runtime and
+OpenVINO backends on the sample images; test_backends.py checks their predictions agree:
+
+    python benchmark.py backends --root local_gcs ../../../notebooks/model_training/cast_*.jpeg
+
+The worker benchmark feeds the pull worker from the in-memory Pub/Sub stand-in and
+writes results to the SQLite sink, so the listener module must be configured for it:
+
+    LOCAL_GCS_ROOT=local_gcs RESULT_SINK=sqlite:/tmp/results.db \
+        python benchmark.py worker --messages 200 ../../../notebooks/model_training/*.jpeg
+
+The requests benchmark needs a fake GCS server instead, e.g. fsouza/fake-gcs-server:
+
+    docker run -d -p 4443:4443 fsouza/fake-gcs-server -scheme http
+    STORAGE_EMULATOR_HOST=http://localhost:4443 python benchmark.py requests ../../../notebooks/model_training/*.jpeg
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from ultralytics import YOLO
+from batcher import MicroBatcher
+from clients import client_stats, get_storage_client
+from local_gcs import LocalStorageClient
+from model_registry import clear_models, get_model
+
+bucket_name_model = "metal_casting_model"
+model_file_name = "v0.pt"
+
+def summarize(label, latencies):
+    """Prints mean/p50/p99 per-image latency in milliseconds."""
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(round(0.99 * (len(latencies) - 1))))]
+    print(f"{label:<12} n={len(latencies):<5} mean={statistics.mean(latencies) * 1000:8.1f} ms  "
+          f"p50={statistics.median(latencies) * 1000:8.1f} ms  p99={p99 * 1000:8.1f} ms")
+
+def bench_model_cache(args):
+    """Compares the old per-event download + YOLO load against the process-level model cache."""
+    storage_client = LocalStorageClient(args.root)
+    images = args.images * args.repeat
+
+    cold = []
+    for image in images:
+        start = time.perf_counter()
+        local_path = os.path.join(tempfile.gettempdir(), model_file_name)
+        storage_client.bucket(bucket_name_model).blob(model_file_name).download_to_filename(local_path)
+        YOLO(local_path).predict(image, verbose=False)
+        cold.append(time.perf_counter() - start)
+
+    clear_models()
+    warm = []
+    for image in images:
+        start = time.perf_counter()
+        get_model(storage_client, bucket_name_model, model_file_name).predict(image, verbose=False)
+        warm.append(time.perf_counter() - start)
+
+    summarize("cold", cold)
+    summarize("warm", warm)
+    # The first warm call pays the one-off load
+    summarize("warm steady", warm[1:] or warm)
+
+def run_burst(images, handle):
+    """Fires all images at once from concurrent threads, like a `gsutil -m cp` burst.
+
+    Returns the per-image latencies and the wall-clock time of the whole burst.
+    """
+    start = time.perf_counter()
+
+    def timed(image):
+        handle(image)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(images)) as pool:
+        latencies = list(pool.map(timed, images))
+    return latencies, time.perf_counter() - start
+
+def bench_batch(args):
+    """Compares one-at-a-time predict calls against the micro-batcher under a burst of images."""
+    storage_client = LocalStorageClient(args.root)
+    model = get_model(storage_client, bucket_name_model, model_file_name)
+    decoded = [cv2.imread(image) for image in args.images]
+    images = [decoded[i % len(decoded)] for i in range(args.burst)]
+    model.predict(images[:1], verbose=False)  # Warm up
+
+    # The model is not thread-safe, so the single-image path runs one predict at a time
+    lock = threading.Lock()
+
+    def predict_one(image):
+        with lock:
+            return model.predict([image], verbose=False)[0]
+
+    batcher = MicroBatcher(lambda batch: model.predict(batch, verbose=False), args.batch_size, args.wait_ms)
+
+    for label, handle in (("single", predict_one), ("batched", lambda image: batcher.submit(image).result())):
+        latencies, total = [], 0
+        for _ in range(args.rounds):
+            burst_latencies, burst_time = run_burst(images, handle)
+            latencies += burst_latencies
+            total += burst_time
+        summarize(label, latencies)
+        print(f"{'':<12} throughput={len(latencies) / total:8.1f} images/s")
+
+def bench_requests(args):
+    """Counts GCS requests per download for exists() + download against the single-request download."""
+    import main as listener
+
+    storage_client = get_storage_client()
+    bucket = storage_client.bucket(args.bucket)
+    if not bucket.exists():
+        storage_client.create_bucket(args.bucket)
+    names = []
+    for image in args.images:
+        name = "raw/" + os.path.basename(image)
+        bucket.blob(name).upload_from_filename(image)
+        names.append(name)
+
+    def requests_sent():
+        return client_stats()["storage"]["requests"]
+
+    def exists_then_download(name):
+        blob = bucket.blob(name)
+        if not blob.exists(storage_client):
+            raise FileNotFoundError(name)
+        return blob.download_as_bytes()
+
+    for label, download in (("exists+get", exists_then_download),
+                            ("get", lambda name: listener.download_blob_bytes(args.bucket, name))):
+        before = requests_sent()
+        latencies = []
+        for _ in range(args.repeat):
+            for name in names:
+                start = time.perf_counter()
+                download(name)
+                latencies.append(time.perf_counter() - start)
+        summarize(label, latencies)
+        print(f"{'':<12} requests/download={(requests_sent() - before) / len(latencies):.2f}")
+
+def bench_worker(args):
+    """Throughput and publish-to-ack latency of the pull worker on the in-memory Pub/Sub stand-in."""
+    import json
+    from local_pubsub import InMemorySubscriber
+    from worker import run_worker
+
+    bucket = get_storage_client().bucket(args.bucket)
+    names = []
+    for image in args.images:
+        name = "raw/" + os.path.basename(image)
+        bucket.blob(name).upload_from_filename(image)
+        names.append(name)
+
+    subscriber = InMemorySubscriber()
+    streaming_pull = run_worker(subscriber, "projects/local/subscriptions/bench", args.threads, args.max_messages)
+
+    # Warm up so the one-off model load is not part of the measurement
+    subscriber.publish(json.dumps({"bucket": args.bucket, "name": names[0]}).encode())
+    subscriber.wait_for_acks(1)
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        subscriber.publish(json.dumps({"bucket": args.bucket, "name": names[i % len(names)], "generation": str(i)}).encode())
+    if not subscriber.wait_for_acks(args.messages + 1, timeout=args.timeout):
+        print(f"Timed out with {len(subscriber.acked) - 1} of {args.messages} messages acked")
+    total = time.perf_counter() - start
+    streaming_pull.cancel()
+
+    summarize("worker", [acked_at - message.published_at for message, acked_at in subscriber.acked[1:]])
+    print(f"{'':<12} throughput={(len(subscriber.acked) - 1) / total:8.1f} images/s")
+
+def bench_backends(args):
+    """Compares the per-image latency of each backend."""
+    from backends import load_model
+
+    local_path = os.path.join(tempfile.gettempdir(), model_file_name)
+    LocalStorageClient(args.root).bucket(bucket_name_model).blob(model_file_name).download_to_filename(local_path)
+    images = [cv2.imread(image) for image in args.images]
+
+    for backend in args.backends:
+        model = load_model(local_path, backend, args.threads)
+        latencies = []
+        for _ in range(args.repeat):
+            for image in images:
+                start = time.perf_counter()
+                model.predict(image, verbose=False)
+                latencies.append(time.perf_counter() - start)
+        summarize(backend, latencies)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    model_cache = subparsers.add_parser("model-cache", help="cold vs warm per-image latency")
+    model_cache.add_argument("--root", default="local_gcs", help="local GCS stand-in root directory")
+    model_cache.add_argument("--repeat", type=int, default=5, help="times to run over the image list")
+    model_cache.add_argument("images", nargs="+", help="local image files to classify")
+    model_cache.set_defaults(func=bench_model_cache)
+
+    batch = subparsers.add_parser("batch", help="throughput and latency of micro-batched inference")
+    batch.add_argument("--root", default="local_gcs", help="local GCS stand-in root directory")
+    batch.add_argument("--burst", type=int, default=16, help="images arriving at once")
+    batch.add_argument("--rounds", type=int, default=10, help="number of bursts")
+    batch.add_argument("--batch-size", type=int, default=16, help="max images per forward pass")
+    batch.add_argument("--wait-ms", type=float, default=50, help="max wait for a batch to fill")
+    batch.add_argument("images", nargs="+", help="local image files to classify")
+    batch.set_defaults(func=bench_batch)
+
+    backends = subparsers.add_parser("backends", help="latency of the inference backends")
+    backends.add_argument("--root", default="local_gcs", help="local GCS stand-in root directory")
+    backends.add_argument("--backends", nargs="+", default=["torch", "onnx"], help="backends to compare")
+    backends.add_argument("--threads", type=int, default=None, help="inference threads (default INFERENCE_THREADS)")
+    backends.add_argument("--repeat", type=int, default=50, help="times to run over the image list")
+    backends.add_argument("images", nargs="+", help="local image files to classify")
+    backends.set_defaults(func=bench_backends)
+
+    worker = subparsers.add_parser("worker", help="throughput of the pull worker on in-memory Pub/Sub")
+    worker.add_argument("--bucket", default="metal_casting_images", help="image bucket under LOCAL_GCS_ROOT")
+    worker.add_argument("--messages", type=int, default=200, help="messages to publish")
+    worker.add_argument("--threads", type=int, default=2, help="inference threads")
+    worker.add_argument("--max-messages", type=int, default=32, help="max outstanding messages")
+    worker.add_argument("--timeout", type=float, default=600, help="seconds to wait for all acks")
+    worker.add_argument("images", nargs="+", help="local image files to upload and classify")
+    worker.set_defaults(func=bench_worker)
+
+    gcs_requests = subparsers.add_parser("requests", help="GCS requests per download against a fake GCS server")
+    gcs_requests.add_argument("--bucket", default="metal_casting_images", help="bucket to create on the fake server")
+    gcs_requests.add_argument("--repeat", type=int, default=20, help="times to download each image")
+    gcs_requests.add_argument("images", nargs="+", help="local image files to upload and download")
+    gcs_requests.set_defaults(func=bench_requests)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
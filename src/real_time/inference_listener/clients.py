@@ -0,0 +1,94 @@
+"""Shared GCS and BigQuery clients, built lazily once per process and reused across invocations.
+
+Each client gets its own authorized HTTP session with a pooled adapter, so auth tokens,
+HTTP sessions and TLS connections survive between Cloud Function invocations.
+"""
+import os
+import threading
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from local_gcs import LocalStorageClient
+
+project_id = "cast-defect-detection"
+
+# Max pooled keep-alive connections per host, sized for concurrent invocations
+http_pool_maxsize = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+
+# Use a local directory in place of GCS, e.g. LOCAL_GCS_ROOT=./local_gcs
+local_gcs_root = os.environ.get("LOCAL_GCS_ROOT")
+
+_clients = {}
+_adapters = {}
+_constructions = {}
+_lock = threading.Lock()
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that counts the requests it sends, to measure connection reuse."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests_sent = 0
+
+    def send(self, request, **kwargs):
+        self.requests_sent += 1
+        return super().send(request, **kwargs)
+
+    def connections_opened(self):
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+def _build_http(name, credentials):
+    session = AuthorizedSession(credentials)
+    adapter = CountingHTTPAdapter(pool_connections=4, pool_maxsize=http_pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    _adapters[name] = adapter
+    return session
+
+def _get_client(name, build):
+    with _lock:
+        if name not in _clients:
+            _clients[name] = build()
+            _constructions[name] = _constructions.get(name, 0) + 1
+            print(f"Created {name} client")
+        return _clients[name]
+
+def _build_storage_client():
+    if local_gcs_root:
+        return LocalStorageClient(local_gcs_root)
+    if os.environ.get("STORAGE_EMULATOR_HOST"):
+        credentials = AnonymousCredentials()
+        return storage.Client(project="test", credentials=credentials, _http=_build_http("storage", credentials))
+    credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+    return storage.Client(project=project_id, credentials=credentials, _http=_build_http("storage", credentials))
+
+def _build_bigquery_client():
+    credentials, _ = google.auth.default(scopes=bigquery.Client.SCOPE)
+    return bigquery.Client(project=project_id, credentials=credentials, _http=_build_http("bigquery", credentials))
+
+def get_storage_client():
+    """Returns the shared GCS client, or the local filesystem stand-in when LOCAL_GCS_ROOT is set."""
+    return _get_client("storage", _build_storage_client)
+
+def get_bigquery_client():
+    """Returns the shared BigQuery client."""
+    return _get_client("bigquery", _build_bigquery_client)
+
+def client_stats():
+    """Returns client constructions, HTTP requests sent and connections opened per client."""
+    stats = {}
+    for name, constructions in _constructions.items():
+        adapter = _adapters.get(name)
+        requests_sent = adapter.requests_sent if adapter else 0
+        connections = adapter.connections_opened() if adapter else 0
+        stats[name] = {
+            "constructions": constructions,
+            "requests": requests_sent,
+            "connections": connections,
+            "reused": max(requests_sent - connections, 0),
+        }
+    return stats
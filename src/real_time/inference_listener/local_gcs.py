@@ -0,0 +1,89 @@
+"""Local filesystem stand-in for the parts of google.cloud.storage used by the listener.
+
+Each bucket is a directory under a root folder, so `<root>/metal_casting_model/v0.pt`
+plays the role of `gs://metal_casting_model/v0.pt`. Set LOCAL_GCS_ROOT to use it.
+"""
+import io
+import os
+import shutil
+from google.api_core.exceptions import NotFound
+
+
+class LocalStorageClient:
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self, bucket_name)
+
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        """Returns the blob with its metadata loaded, or None if it does not exist."""
+        blob = LocalBlob(self, blob_name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, *name.split("/"))
+        self.generation = None
+        self.etag = None
+        self.size = None
+
+    def exists(self, client=None):
+        return os.path.isfile(self.path)
+
+    def reload(self, client=None):
+        # mtime stands in for the GCS generation number
+        stat = os.stat(self.path)
+        self.generation = stat.st_mtime_ns
+        self.etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        self.size = stat.st_size
+
+    def _check_exists(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+    def download_to_filename(self, filename, client=None):
+        self._check_exists()
+        shutil.copyfile(self.path, filename)
+
+    def download_as_bytes(self, client=None, start=None, end=None):
+        # start and end are inclusive byte offsets, as in google.cloud.storage
+        self._check_exists()
+        with open(self.path, "rb") as f:
+            f.seek(start or 0)
+            if end is None:
+                return f.read()
+            return f.read(end - (start or 0) + 1)
+
+    def open(self, mode="rb", chunk_size=None):
+        if mode != "rb":
+            raise ValueError("The local stand-in only supports mode='rb'")
+        self._check_exists()
+        return io.open(self.path, "rb")
+
+    def upload_from_string(self, data, content_type=None, client=None):
+        if isinstance(data, str):
+            data = data.encode()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def upload_from_filename(self, filename, client=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
@@ -0,0 +1,95 @@
+"""In-memory stand-in for the parts of pubsub_v1.SubscriberClient used by worker.py.
+
+Messages published with InMemorySubscriber.publish are delivered to the subscribe()
+callback on a thread pool, honouring flow_control.max_messages outstanding messages.
+Nacked messages are redelivered, like a subscription without a dead-letter topic.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class InMemoryMessage:
+    def __init__(self, subscriber, message_id, data, attributes):
+        self._subscriber = subscriber
+        self.message_id = message_id
+        self.data = data
+        self.attributes = attributes
+        self.published_at = time.monotonic()
+        self.delivery_attempt = 0
+
+    def ack(self):
+        self._subscriber._settle(self, redeliver=False)
+
+    def nack(self):
+        self._subscriber._settle(self, redeliver=True)
+
+class InMemoryStreamingPullFuture:
+    def __init__(self, stop):
+        self._stop = stop
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._stop()
+        self._cancelled.set()
+
+    def result(self, timeout=None):
+        self._cancelled.wait(timeout)
+
+class InMemorySubscriber:
+    def __init__(self, callback_threads=10):
+        self.callback_threads = callback_threads
+        self.acked = []  # (message, acked_at)
+        self._pending = queue.Queue()
+        self._next_id = 0
+        self._cond = threading.Condition()
+        self._slots = None
+
+    def subscription_path(self, project, subscription):
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def publish(self, data, **attributes):
+        """Queues a message for delivery and returns its message id."""
+        with self._cond:
+            self._next_id += 1
+            message = InMemoryMessage(self, str(self._next_id), data, attributes)
+        self._pending.put(message)
+        return message.message_id
+
+    def subscribe(self, subscription, callback, flow_control=None):
+        max_messages = getattr(flow_control, "max_messages", 1000)
+        self._slots = threading.Semaphore(max_messages)
+        pool = ThreadPoolExecutor(max_workers=self.callback_threads, thread_name_prefix="pubsub-callback")
+        stopped = threading.Event()
+
+        def dispatch():
+            while not stopped.is_set():
+                self._slots.acquire()
+                message = self._pending.get()
+                if message is None:
+                    break
+                message.delivery_attempt += 1
+                pool.submit(callback, message)
+            pool.shutdown(wait=False)
+
+        def stop():
+            stopped.set()
+            self._pending.put(None)
+            self._slots.release()
+
+        threading.Thread(target=dispatch, name="pubsub-dispatch", daemon=True).start()
+        return InMemoryStreamingPullFuture(stop)
+
+    def _settle(self, message, redeliver):
+        if redeliver:
+            self._pending.put(message)
+        else:
+            with self._cond:
+                self.acked.append((message, time.monotonic()))
+                self._cond.notify_all()
+        self._slots.release()
+
+    def wait_for_acks(self, count, timeout=None):
+        """Blocks until count messages have been acked; returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self.acked) >= count, timeout)
@@ -1,13 +1,20 @@
-from google.cloud import storage
-from google.cloud import bigquery
 import base64
 import json
+import mimetypes
 import os
+import threading
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from cloudevents.http import CloudEvent
+from google.api_core.exceptions import NotFound
 import functions_framework
-from ultralytics import YOLO
 from datetime import datetime
+import cv2
+import numpy as np
+from batcher import MicroBatcher
+from clients import client_stats, get_bigquery_client, get_storage_client
+from model_registry import get_model
+from result_sink import BigQueryResultSink, BufferedResultWriter, SQLiteResultSink
 
 # Set your project and dataset
 project_id = "cast-defect-detection"
@@ -20,76 +27,225 @@ bq_table_id = f"{project_id}.{dataset_id}.{table_id}"
 # GCS buckets for image and model
 bucket_name_image = "metal_casting_images"
 bucket_name_model = "metal_casting_model"
-model_file_name = "v0.pt"
-
-# Insert new inference result to bq
-def update_bq_record(res_image_path, raw_image_path, model_ver, pred_class, pred_confidence, pred_speed, res_insert_datetime):
-    """Inserts a new inference result with a unique UUID as res_id."""
-    # # Step 1: Get the highest res_id
-    # get_max_res_id_query = f"SELECT MAX(res_id) AS max_res_id FROM `{bq_table_id}`"
-    # try:
-    #     client = bigquery.Client()
-    #     query_job = client.query(get_max_res_id_query)
-    #     result = list(query_job.result())
-    #     new_res_id = result[0]["max_res_id"] + 1 if result and result[0][0] is not None else 0
-    # except Exception as e:
-    #     print(f"Error fetching max res_id: {e}")
-    #     new_res_id = 0  # Default to 0 if table is empty or not found
-    
-    # Generate a unique res_id using UUID
-    new_res_id = str(uuid.uuid4())  # Convert UUID to string
-
-    # Step 2: Insert new row with the new incremented res_id
-    insert_query = f"""
-    INSERT INTO `{bq_table_id}` (res_id, res_image_path, raw_image_path, model_ver, pred_class, 
-                              pred_confidence, pred_speed, res_insert_datetime)
-    VALUES ('{new_res_id}', '{res_image_path}', '{raw_image_path}', '{model_ver}', 
-            '{pred_class}', {pred_confidence}, {pred_speed}, '{res_insert_datetime}');
-    """
 
-    client = bigquery.Client()    
-    query_job = client.query(insert_query)
-    query_job.result()  # Wait for completion
+# Model version to serve: "v0" loads v0.pt, quantized versions such as "v0-int8" load <version>.onnx
+model_version = os.environ.get("MODEL_VERSION", "v0")
+model_file_name = f"{model_version}.onnx" if model_version.endswith("-int8") else f"{model_version}.pt"
+
+# Longest side and WebP quality of the thumbnail written next to each result image
+thumbnail_size = int(os.environ.get("THUMBNAIL_SIZE", "400"))
+thumbnail_quality = int(os.environ.get("THUMBNAIL_QUALITY", "80"))
+
+# Result rows are buffered and streamed to bq in bulk, or to SQLite when RESULT_SINK=sqlite:<path>
+result_sink = os.environ.get("RESULT_SINK", "bigquery")
+_result_writer = None
+_result_writer_lock = threading.Lock()
+
+def get_result_writer():
+    """Returns the process-wide buffered writer for inference results, creating it on first use."""
+    global _result_writer
+    with _result_writer_lock:
+        if _result_writer is None:
+            if result_sink.startswith("sqlite:"):
+                sink = SQLiteResultSink(result_sink[len("sqlite:"):])
+            else:
+                sink = BigQueryResultSink(get_bigquery_client(), bq_table_id)
+            _result_writer = BufferedResultWriter(
+                sink,
+                max_batch_rows=int(os.environ.get("RESULT_BATCH_ROWS", "500")),
+                max_wait_ms=float(os.environ.get("RESULT_BATCH_WAIT_MS", "200")),
+            )
+        return _result_writer
+
+# Queue new inference result for bq
+def queue_bq_record(res_image_path, raw_image_path, model_ver, pred_class, pred_confidence, pred_speed, res_insert_datetime, res_id=None):
+    """Queues a new inference result on the buffered result writer and returns (res_id, Future).
 
-    print(f"Inserted new record with res_id: {new_res_id}")
+    Pass a res_id derived from the source event so a redelivered event overwrites
+    (or is de-duplicated against) the earlier row; otherwise a random UUID is used.
+    """
+    new_res_id = res_id or str(uuid.uuid4())
 
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    """Uploads a file to a Cloud Storage bucket after verifying it exists."""
-    if not os.path.exists(source_file_name):
-        raise FileNotFoundError(f"Error: Source file '{source_file_name}' not found.")
+    row = {
+        "res_id": new_res_id,
+        "res_image_path": res_image_path,
+        "raw_image_path": raw_image_path,
+        "model_ver": model_ver,
+        "pred_class": pred_class,
+        "pred_confidence": pred_confidence,
+        "pred_speed": pred_speed,
+        "res_insert_datetime": res_insert_datetime,
+    }
+    return new_res_id, get_result_writer().write(row)
 
+def upload_blob_from_bytes(bucket_name, data, destination_blob_name, content_type=None):
+    """Uploads an in-memory buffer to a Cloud Storage bucket without touching local disk."""
     try:
-        storage_client = storage.Client()
+        storage_client = get_storage_client()
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file_name)
+        blob.upload_from_string(data, content_type=content_type)
         public_url = f"https://storage.googleapis.com/{bucket_name}/{destination_blob_name}"
         print(f"Uploaded storage object. Public url is {public_url}")
-        return public_url  # Return the gs:// path
+        return public_url
 
     except Exception as e:
         print(f"Error uploading file: {e}")
         return None  # Return None if an error occurs
 
-def download_blob(bucket_name, source_blob_name, destination_file_name):
-    """Downloads a file from a Cloud Storage bucket after verifying the blob exists."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-
-    if not blob.exists(storage_client):
+def download_blob_bytes(bucket_name, source_blob_name, start=None, end=None):
+    """Downloads a Cloud Storage object (or the inclusive byte range start..end) into memory in a single request."""
+    storage_client = get_storage_client()
+    blob = storage_client.bucket(bucket_name).blob(source_blob_name)
+    try:
+        data = blob.download_as_bytes(start=start, end=end)
+    except NotFound:
         raise FileNotFoundError(f"Error: Blob '{source_blob_name}' not found in bucket '{bucket_name}'.")
+    print(f"Downloaded storage object from gs://{bucket_name}/{source_blob_name} ({len(data)} bytes).")
+    return data
 
-    try:
-        blob.download_to_filename(destination_file_name)
-        gs_path = f"gs://{bucket_name}/{source_blob_name}"
-        print(f"Downloaded storage object from {gs_path} to local file {destination_file_name}.")
-        return gs_path  # Return the gs:// path
+def open_blob_stream(bucket_name, source_blob_name, chunk_size=1024 * 1024):
+    """Opens a Cloud Storage object as a file-like reader that fetches chunk_size bytes per request.
+
+    Nothing is fetched until the first read, which raises NotFound for a missing blob.
+    """
+    storage_client = get_storage_client()
+    blob = storage_client.bucket(bucket_name).blob(source_blob_name)
+    return blob.open("rb", chunk_size=chunk_size)
+
+def decode_image(data):
+    """Decodes encoded image bytes to a BGR array, as cv2.imread would."""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Error: Could not decode image data.")
+    return image
+
+def encode_image(image, file_name):
+    """Encodes a BGR array in the format implied by file_name and returns (bytes, content type)."""
+    ext = os.path.splitext(file_name)[1] or ".jpg"
+    ok, buffer = cv2.imencode(ext, image)
+    if not ok:
+        raise ValueError(f"Error: Could not encode image as '{ext}'.")
+    return buffer.tobytes(), mimetypes.guess_type(file_name)[0] or "image/jpeg"
+
+def encode_thumbnail(image):
+    """Downscales a BGR array to at most thumbnail_size on its longer side and encodes it as WebP."""
+    height, width = image.shape[:2]
+    scale = thumbnail_size / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode(".webp", image, [cv2.IMWRITE_WEBP_QUALITY, thumbnail_quality])
+    if not ok:
+        raise ValueError("Error: Could not encode thumbnail as '.webp'.")
+    return buffer.tobytes()
+
+def thumbnail_blob_name(blob_name):
+    """Name of the thumbnail stored next to a result image."""
+    return f"{blob_name}.thumb.webp"
+
+def predict_images(images, replica=None, replicas=1):
+    """Runs one forward pass over a list of decoded images with the cached model (or the given one of replicas)."""
+    model = get_model(get_storage_client(), bucket_name_model, model_file_name, replica, replicas)
+    return model.predict(images, show_conf=True, verbose=False)
+
+def upload_result_image(res, image_file_name, destination_blob_name):
+    """Encodes the annotated result image and its thumbnail in memory and uploads both.
+
+    Raises if the result image upload fails. A failed thumbnail upload is only logged,
+    since the front end falls back to the full image.
+    """
+    plotted = res.plot()
+    result_data, content_type = encode_image(plotted, image_file_name)
+    res_image_path = upload_blob_from_bytes(bucket_name_image, result_data, destination_blob_name, content_type)
+    if res_image_path is None:
+        raise RuntimeError(f"Error: Upload of result image '{destination_blob_name}' failed.")
+
+    thumbnail_name = thumbnail_blob_name(destination_blob_name)
+    if upload_blob_from_bytes(bucket_name_image, encode_thumbnail(plotted), thumbnail_name, "image/webp") is None:
+        print(f"Error: Upload of thumbnail '{thumbnail_name}' failed.")
+    return res_image_path
+
+def gather_futures(futures, result=None):
+    """Returns a Future that resolves to result once all futures are done, or to the first error."""
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            gathered.set_exception(errors[0])
+        else:
+            gathered.set_result(result)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return gathered
+
+def publish_result(res, source_bucket, source_name, generation=""):
+    """Uploads the annotated image and writes the BQ row for one prediction without blocking.
+
+    The upload runs on publish_pool and the row goes to the buffered result writer, so
+    both writes overlap with each other and with whatever the caller does next. Returns
+    a Future that resolves to the res_id, or raises the first error for this image.
+    """
+    image_file_name = source_name.split("/")[-1]
+    raw_image_path = f"gs://{source_bucket}/{source_name}"
+    destination_blob_name = 'result/' + image_file_name
+    res_image_path = f"https://storage.googleapis.com/{bucket_name_image}/{destination_blob_name}"
+
+    upload = publish_pool.submit(upload_result_image, res, image_file_name, destination_blob_name)
+
+    #Retrieve result class and confidence score
+    pred_class_index = res.probs.top1  # Get the index of the top prediction
+    pred_class_name = res.names[pred_class_index]  # Get the top prediction class
+    pred_confidence = res.probs.data[pred_class_index].item()  # Get confidence score
+    print(json.dumps({"class": pred_class_name, "confidence": pred_confidence}))
+
+    #Write result to BQ table, keyed on the source object so redeliveries reuse the same res_id
+    res_id, written = queue_bq_record(
+        res_id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{raw_image_path}#{generation}")),
+        res_image_path=res_image_path,
+        raw_image_path=raw_image_path,
+        model_ver=model_version,
+        pred_class=pred_class_name,
+        pred_confidence=pred_confidence,
+        pred_speed=round(sum(res.speed.values())/1000, 3),
+        res_insert_datetime=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+
+    return gather_futures([upload, written], res_id)
+
+# Result image uploads run here, alongside the buffered BQ writes
+publish_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("PUBLISH_THREADS", "8")), thread_name_prefix="publish")
+
+# Print client construction and connection reuse counters after each event
+log_client_stats = os.environ.get("LOG_CLIENT_STATS") == "1"
+
+# Micro-batching across concurrent invocations (needs --concurrency > 1); batch size 1 disables it
+inference_batch_size = int(os.environ.get("INFERENCE_BATCH_SIZE", "1"))
+inference_batch_wait_ms = float(os.environ.get("INFERENCE_BATCH_WAIT_MS", "50"))
+batcher = MicroBatcher(predict_images, inference_batch_size, inference_batch_wait_ms) if inference_batch_size > 1 else None
+
+def predict_image(image):
+    """Predicts one decoded image, through the micro-batcher when it is enabled."""
+    if batcher:
+        return batcher.submit(image).result()
+    return predict_images([image])[0]
+
+def process_image(message, predict=predict_image):
+    """Downloads, decodes and predicts the image named in a GCS notification.
+
+    Returns the publish_result Future, so callers decide whether to wait for the writes.
+    """
+    image = decode_image(download_blob_bytes(message["bucket"], message["name"]))
+    res = predict(image)
+    return publish_result(res, message["bucket"], message["name"], message.get("generation", ""))
 
-    except Exception as e:
-        print(f"Error downloading file: {e}")
-        return None  # Return None if an error occurs
-    
 # Triggered from a message on a Cloud Pub/Sub topic.
 @functions_framework.cloud_event
 def subscribe(cloud_event: CloudEvent) -> None:
@@ -97,39 +253,8 @@ def subscribe(cloud_event: CloudEvent) -> None:
     decoded_message = base64.b64decode(cloud_event.data["message"]["data"]).decode()
     message = json.loads(decoded_message)
 
-    # Download image
-    download_file_name = message["name"].split("/")[-1]
-    raw_image_path = download_blob(message["bucket"], message["name"], download_file_name)
-
-    # Download and load model
-    download_blob(bucket_name_model, model_file_name, model_file_name)
-    model = YOLO(model_file_name)
-
-    # Inference image
-    results = model.predict(download_file_name, save = True, show_conf = True)
-
-    # Print, upload and store inference result
-    if results:
-        for res in results:
-            #Upload result image to GCS
-            result_filename = res.path.split("/")[-1]
-            res.save(filename=result_filename)
-            destination_blob_name = 'result/' + result_filename
-            res_image_path = upload_blob(bucket_name_image, result_filename, destination_blob_name)
-
-            #Retrieve result class and confidence score
-            pred_class_index = res.probs.top1  # Get the index of the top prediction
-            pred_class_name = res.names[pred_class_index]  # Get the top prediction class
-            pred_confidence = res.probs.data[pred_class_index].item()  # Get confidence score
-            print(json.dumps({"class": pred_class_name, "confidence": pred_confidence}))
-
-            #Write result to BQ table
-            update_bq_record(
-                res_image_path=res_image_path,
-                raw_image_path=raw_image_path,
-                model_ver=model_file_name.split(".")[0],
-                pred_class=pred_class_name,
-                pred_confidence=pred_confidence,
-                pred_speed=round(sum(res.speed.values())/1000, 3),
-                res_insert_datetime=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            )
\ No newline at end of file
+    # Download, inference, then wait for the result image upload and BQ row write
+    process_image(message).result()
+
+    if log_client_stats:
+        print(json.dumps({"client_stats": client_stats()}))
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import threading
+import time
+from backends import load_model
+
+# Minimum seconds between generation checks of a cached model blob (0 = check on every call)
+model_check_interval = float(os.environ.get("MODEL_CHECK_INTERVAL", "60"))
+
+# (bucket_name, blob_name, replica) -> {"model", "generation", "etag", "local_path", "checked_at"}
+_models = {}
+# (bucket_name, blob_name, replica) -> lock held while checking and reloading that model
+_key_locks = {}
+_lock = threading.Lock()  # Guards _models and _key_locks only
+
+def _cached(key, now):
+    """The cached model of key if its blob was checked within model_check_interval, else None."""
+    with _lock:
+        entry = _models.get(key)
+        if entry and now - entry["checked_at"] < model_check_interval:
+            return entry["model"]
+    return None
+
+def get_model(storage_client, bucket_name, blob_name, replica=None, replicas=1):
+    """Returns the model stored at gs://bucket_name/blob_name, loading it once per process.
+
+    The blob metadata (generation/etag) is checked at most every model_check_interval
+    seconds and the weights are downloaded again only when the blob has changed.
+    Threads that predict in parallel should each pass their own replica id, since a
+    YOLO model must not be used by several threads at once, and the number of replicas,
+    which split the inference threads between them.
+
+    The check, download and load run under a lock of their own per model, so other
+    models and replicas are served and loaded meanwhile.
+    """
+    key = (bucket_name, blob_name, replica)
+    model = _cached(key, time.monotonic())
+    if model is not None:
+        return model
+
+    with _lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        now = time.monotonic()
+        model = _cached(key, now)  # Checked by another thread while this one waited
+        if model is not None:
+            return model
+        with _lock:
+            entry = _models.get(key)
+
+        try:
+            blob = storage_client.bucket(bucket_name).get_blob(blob_name)  # Metadata request only
+        except Exception as e:
+            if entry:
+                print(f"Error checking model blob, keeping cached model: {e}")
+                with _lock:
+                    entry["checked_at"] = now
+                return entry["model"]
+            raise
+
+        if blob is None:
+            raise FileNotFoundError(f"Error: Blob '{blob_name}' not found in bucket '{bucket_name}'.")
+
+        if entry and (entry["generation"], entry["etag"]) == (blob.generation, blob.etag):
+            with _lock:
+                entry["checked_at"] = now
+            return entry["model"]
+
+        local_path = os.path.join(tempfile.gettempdir(), f"{blob.generation}_{os.path.basename(blob_name)}")
+        if not (os.path.exists(local_path) and os.path.getsize(local_path) == blob.size):
+            # Not yet fetched by another replica; renamed into place so a concurrent one never reads it half-written
+            tmp_path = f"{local_path}.{threading.get_ident()}.tmp"
+            blob.download_to_filename(tmp_path)
+            os.replace(tmp_path, local_path)
+        model = load_model(local_path, replicas=replicas)
+        print(f"Loaded model gs://{bucket_name}/{blob_name} generation {blob.generation} (replica {replica})")
+
+        with _lock:
+            _models[key] = {
+                "model": model,
+                "generation": blob.generation,
+                "etag": blob.etag,
+                "local_path": local_path,
+                "checked_at": now,
+            }
+            in_use = {other["local_path"] for other in _models.values()}
+
+        if entry and entry["local_path"] not in in_use and os.path.exists(entry["local_path"]):
+            os.remove(entry["local_path"])
+
+        return model
+
+def clear_models():
+    """Drops every cached model, forcing the next get_model call to reload."""
+    with _lock:
+        _models.clear()
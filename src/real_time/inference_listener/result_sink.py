@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+result_columns = [
+    "res_id", "res_image_path", "raw_image_path", "model_ver",
+    "pred_class", "pred_confidence", "pred_speed", "res_insert_datetime",
+]
+
+class BigQueryResultSink:
+    """Streams rows into BigQuery with insert_rows_json, using res_id as the insert id."""
+
+    def __init__(self, bq_client, table_id):
+        self.bq_client = bq_client
+        self.table_id = table_id
+
+    def write_rows(self, rows):
+        # Retried batches reuse the same insert ids, so BigQuery can drop the duplicates
+        errors = self.bq_client.insert_rows_json(self.table_id, rows, row_ids=[row["res_id"] for row in rows])
+        if errors:
+            raise RuntimeError(f"Error inserting rows into {self.table_id}: {errors}")
+
+class SQLiteResultSink:
+    """Fake sink for local runs, storing rows in SQLite and upserting on res_id."""
+
+    def __init__(self, path=":memory:"):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS inference_results ({', '.join(result_columns)}, PRIMARY KEY (res_id))"
+        )
+
+    def write_rows(self, rows):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO inference_results ({', '.join(result_columns)}) "
+                f"VALUES ({', '.join('?' for _ in result_columns)})",
+                [tuple(row[col] for col in result_columns) for row in rows],
+            )
+
+    def rows(self):
+        with self._lock:
+            cursor = self.conn.execute(f"SELECT {', '.join(result_columns)} FROM inference_results")
+            return [dict(zip(result_columns, row)) for row in cursor]
+
+class BufferedResultWriter:
+    """Accumulates result rows and writes them to a sink in bulk.
+
+    A batch is flushed once max_batch_rows rows are waiting or max_wait_ms after its
+    first row arrived. write() blocks while max_buffered_rows rows are pending, which
+    bounds memory, and returns a Future that resolves once the row is persisted.
+    Failed flushes are retried with exponential backoff; since a retry may follow a
+    partial write, sinks must treat res_id as the idempotency key.
+    """
+
+    def __init__(self, sink, max_batch_rows=500, max_wait_ms=200, max_buffered_rows=5000,
+                 max_retries=5, backoff_s=0.5):
+        self.sink = sink
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.max_buffered_rows = max_buffered_rows
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self._buffer = []  # (row, future, enqueued_at)
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, row):
+        """Queues a row and returns a Future resolving once it has been written."""
+        future = Future()
+        with self._cond:
+            while len(self._buffer) + self._in_flight >= self.max_buffered_rows:
+                self._cond.wait()
+            self._buffer.append((row, future, time.monotonic()))
+            self._cond.notify_all()
+        return future
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._buffer:
+                    if len(self._buffer) >= self.max_batch_rows:
+                        break
+                    remaining = self._buffer[0][2] + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            batch = self._buffer[:self.max_batch_rows]
+            del self._buffer[:self.max_batch_rows]
+            self._in_flight += len(batch)
+            return batch
+
+    def _write_with_retry(self, rows):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sink.write_rows(rows)
+                return None
+            except Exception as e:
+                if attempt == self.max_retries:
+                    return e
+                delay = self.backoff_s * 2 ** attempt
+                print(f"Error writing {len(rows)} rows (attempt {attempt + 1}), retrying in {delay}s: {e}")
+                time.sleep(delay)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            error = self._write_with_retry([row for row, _, _ in batch])
+            for _, future, _ in batch:
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+            if not error:
+                print(f"Wrote {len(batch)} rows to result sink")
+            with self._cond:
+                self._in_flight -= len(batch)
+                self._cond.notify_all()
@@ -10,4 +10,6 @@ gcloud functions deploy inference_listener-2 \
     --trigger-topic=incoming-image-topic \
     --clear-max-instances \
     --cpu=2 \
-    --memory=8Gi
\ No newline at end of file
+    --memory=8Gi \
+    --concurrency=16 \
+    --set-env-vars=INFERENCE_BATCH_SIZE=16,INFERENCE_BATCH_WAIT_MS=50,INFERENCE_BACKEND=torch,INFERENCE_THREADS=2
\ No newline at end of file
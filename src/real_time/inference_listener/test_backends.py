@@ -0,0 +1,56 @@
+"""Parity of the ONNX Runtime and OpenVINO backends with PyTorch, on the sample images.
+
+    pip install pytest -r requirements.txt
+    python -m pytest test_backends.py
+"""
+import glob
+import os
+import shutil
+import pytest
+
+pytest.importorskip("ultralytics")
+cv2 = pytest.importorskip("cv2")
+import backends
+from backends import load_model
+
+samples_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "notebooks", "model_training")
+
+@pytest.fixture(scope="module")
+def weights_path(tmp_path_factory):
+    # Exported models are written next to the weights, so work on a copy
+    path = tmp_path_factory.mktemp("model") / "v0.pt"
+    shutil.copyfile(os.path.join(samples_dir, "v0.pt"), path)
+    return str(path)
+
+@pytest.fixture(scope="module")
+def images():
+    return [cv2.imread(path) for path in sorted(glob.glob(os.path.join(samples_dir, "cast_*.jpeg")))]
+
+def predictions(model, images):
+    results = [model.predict(image, verbose=False)[0] for image in images]
+    return [(res.probs.top1, res.probs.data[res.probs.top1].item()) for res in results]
+
+@pytest.fixture(scope="module")
+def reference(weights_path, images):
+    return predictions(load_model(weights_path, "torch"), images)
+
+@pytest.mark.parametrize("backend", ["onnx", "openvino"])
+def test_backend_matches_torch(backend, weights_path, images, reference):
+    pytest.importorskip("onnxruntime" if backend == "onnx" else "openvino")
+    actual = predictions(load_model(weights_path, backend), images)
+    for (top1, conf), (ref_top1, ref_conf) in zip(actual, reference):
+        assert top1 == ref_top1
+        assert conf == pytest.approx(ref_conf, abs=0.01)
+
+def test_replicas_split_threads(weights_path, monkeypatch):
+    pytest.importorskip("onnxruntime")
+    import torch
+
+    monkeypatch.setattr(backends, "inference_threads", 8)
+    model = load_model(weights_path, "onnx", replicas=4)
+    assert torch.get_num_threads() == 2
+    assert model.predictor.model.session.get_session_options().intra_op_num_threads == 2
+
+def test_unknown_backend(weights_path):
+    with pytest.raises(ValueError):
+        load_model(weights_path, "tensorrt")
@@ -0,0 +1,49 @@
+"""Whole, ranged and streamed Cloud Storage reads of the listener, on the local GCS stand-in.
+
+    pip install pytest -r requirements.txt
+    python -m pytest test_blob_reads.py
+"""
+import os
+import pytest
+from google.api_core.exceptions import NotFound
+
+pytest.importorskip("cv2")
+pytest.importorskip("ultralytics")
+import main as listener
+from local_gcs import LocalStorageClient
+
+bucket_name = "metal_casting_images"
+blob_name = "incoming/large.jpeg"
+object_size = 1024 * 1024
+
+@pytest.fixture
+def image_bytes(tmp_path, monkeypatch):
+    """A 1 MiB object in the stand-in bucket, read through the listener's storage client."""
+    data = bytes(range(256)) * (object_size // 256)
+    path = tmp_path / bucket_name / "incoming"
+    os.makedirs(path)
+    (path / "large.jpeg").write_bytes(data)
+    monkeypatch.setattr(listener, "get_storage_client", lambda: LocalStorageClient(str(tmp_path)))
+    return data
+
+def test_download_whole_object(image_bytes):
+    assert listener.download_blob_bytes(bucket_name, blob_name) == image_bytes
+
+@pytest.mark.parametrize("start, end", [(0, 0), (0, 1023), (1000, 4095), (object_size - 10, None)])
+def test_download_byte_range(image_bytes, start, end):
+    expected = image_bytes[start:] if end is None else image_bytes[start:end + 1]  # end is inclusive
+    assert listener.download_blob_bytes(bucket_name, blob_name, start=start, end=end) == expected
+
+def test_stream_reads_object_in_chunks(image_bytes):
+    chunks = []
+    with listener.open_blob_stream(bucket_name, blob_name, chunk_size=256 * 1024) as stream:
+        while chunk := stream.read(100_000):
+            chunks.append(chunk)
+    assert b"".join(chunks) == image_bytes
+    assert len(chunks) == 11
+
+def test_missing_object(image_bytes):
+    with pytest.raises(FileNotFoundError):
+        listener.download_blob_bytes(bucket_name, "incoming/missing.jpeg", start=0, end=99)
+    with pytest.raises(NotFound):
+        listener.open_blob_stream(bucket_name, "incoming/missing.jpeg").read()
@@ -0,0 +1,101 @@
+"""BufferedResultWriter flushing, back-pressure and retries, writing to the SQLite sink.
+
+    pip install pytest
+    python -m pytest test_result_sink.py
+"""
+import threading
+import time
+import pytest
+from result_sink import BufferedResultWriter, SQLiteResultSink, result_columns
+
+def make_row(res_id, pred_class="OK"):
+    row = {col: None for col in result_columns}
+    row.update(res_id=res_id, pred_class=pred_class, pred_confidence=0.9, res_insert_datetime="2025-03-04 12:00:00")
+    return row
+
+class RecordingSink(SQLiteResultSink):
+    """SQLite sink that records batch sizes and holds writes until release is set.
+
+    The first failures writes raise, after storing the rows if partial is set.
+    """
+
+    def __init__(self, failures=0, partial=False):
+        super().__init__()
+        self.batches = []
+        self.attempts = 0
+        self.failures = failures
+        self.partial = partial
+        self.release = threading.Event()
+        self.release.set()
+
+    def write_rows(self, rows):
+        self.release.wait()
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            if self.partial:
+                super().write_rows(rows)
+            raise ConnectionError("Error: connection reset")
+        super().write_rows(rows)
+        self.batches.append(len(rows))
+
+def test_flushes_full_batches_then_the_rest_after_max_wait():
+    sink = RecordingSink()
+    writer = BufferedResultWriter(sink, max_batch_rows=10, max_wait_ms=300)
+    futures = [writer.write(make_row(f"r{i}")) for i in range(25)]
+
+    for future in futures[:20]:
+        future.result(timeout=1)
+    assert not futures[-1].done()  # 5 rows wait for max_wait_ms
+    futures[-1].result(timeout=2)
+    assert sink.batches == [10, 10, 5]
+    assert len(sink.rows()) == 25
+
+def test_partial_batch_waits_for_max_wait():
+    sink = RecordingSink()
+    writer = BufferedResultWriter(sink, max_batch_rows=100, max_wait_ms=100)
+    start = time.monotonic()
+    futures = [writer.write(make_row(f"r{i}")) for i in range(3)]
+    for future in futures:
+        future.result(timeout=2)
+    assert time.monotonic() - start >= 0.09
+    assert sink.batches == [3]
+
+def test_write_blocks_while_buffer_is_full():
+    sink = RecordingSink()
+    sink.release.clear()  # The first batch hangs in the sink
+    writer = BufferedResultWriter(sink, max_batch_rows=5, max_wait_ms=10, max_buffered_rows=5)
+    for i in range(5):
+        writer.write(make_row(f"r{i}"))
+
+    blocked = threading.Thread(target=writer.write, args=(make_row("r5"),))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    sink.release.set()
+    blocked.join(2)
+    assert not blocked.is_alive()
+
+def test_failed_batch_is_retried_without_duplicates():
+    sink = RecordingSink(failures=2, partial=True)  # Rows written before the error, as a timed-out insert may be
+    writer = BufferedResultWriter(sink, max_batch_rows=4, max_wait_ms=10, backoff_s=0.01)
+    futures = [writer.write(make_row(f"r{i}")) for i in range(4)]
+    for future in futures:
+        future.result(timeout=2)
+    assert sink.attempts == 3
+    assert sorted(row["res_id"] for row in sink.rows()) == ["r0", "r1", "r2", "r3"]
+
+def test_batch_fails_after_max_retries():
+    sink = RecordingSink(failures=10)
+    writer = BufferedResultWriter(sink, max_batch_rows=1, max_wait_ms=10, max_retries=2, backoff_s=0.01)
+    with pytest.raises(ConnectionError):
+        writer.write(make_row("r0")).result(timeout=2)
+    assert sink.attempts == 3
+    assert sink.rows() == []
+
+def test_redelivered_result_replaces_its_row():
+    sink = RecordingSink()
+    writer = BufferedResultWriter(sink, max_batch_rows=1, max_wait_ms=10)
+    writer.write(make_row("r0", "OK")).result(timeout=2)
+    writer.write(make_row("r0", "Defect")).result(timeout=2)
+    assert [(row["res_id"], row["pred_class"]) for row in sink.rows()] == [("r0", "Defect")]
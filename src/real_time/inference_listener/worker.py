@@ -0,0 +1,81 @@
+"""Long-running pull subscriber for incoming-image-subscription, as an alternative to the push Cloud Function.
+
+The model stays resident for the life of the process. Pulled messages go through a
+bounded in-process queue to N inference threads, and each message is acked only once
+its result image and BQ row have been written (nacked otherwise, so it is redelivered).
+
+    python worker.py --threads 2 --max-messages 32
+
+Set PUBSUB_EMULATOR_HOST to run against the Pub/Sub emulator.
+"""
+import argparse
+import json
+import queue
+import threading
+from google.cloud import pubsub_v1
+import main as listener
+
+def run_worker(subscriber, subscription_path, threads=2, max_messages=32, queue_size=16):
+    """Starts pulling from subscription_path and returns the streaming pull future; cancel it to stop."""
+    work = queue.Queue(maxsize=queue_size)
+
+    def on_message(message):
+        work.put(message)  # Blocks the Pub/Sub callback thread when inference falls behind
+
+    def settle(message, published):
+        try:
+            res_id = published.result()
+            message.ack()
+            print(f"Acked message {message.message_id} with res_id: {res_id}")
+        except Exception as e:
+            print(f"Error persisting results for message {message.message_id}, nacking: {e}")
+            message.nack()
+
+    def inference_loop(index):
+        if listener.batcher:
+            predict = listener.predict_image
+        else:
+            # Each thread predicts with its own model replica
+            predict = lambda image: listener.predict_images([image], replica=index, replicas=threads)[0]
+
+        while True:
+            message = work.get()
+            try:
+                notification = json.loads(message.data.decode())
+                published = listener.process_image(notification, predict)
+            except Exception as e:
+                print(f"Error processing message {message.message_id}, nacking: {e}")
+                message.nack()
+                continue
+            # Writes finish in the background while this thread moves on to the next image
+            published.add_done_callback(lambda f, message=message: settle(message, f))
+
+    for index in range(threads):
+        threading.Thread(target=inference_loop, args=(index,), name=f"inference-{index}", daemon=True).start()
+
+    flow_control = pubsub_v1.types.FlowControl(max_messages=max_messages)
+    print(f"Listening on {subscription_path} with {threads} inference threads")
+    return subscriber.subscribe(subscription_path, callback=on_message, flow_control=flow_control)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--project", default=listener.project_id)
+    parser.add_argument("--subscription", default="incoming-image-subscription")
+    parser.add_argument("--threads", type=int, default=2, help="inference threads")
+    parser.add_argument("--max-messages", type=int, default=32, help="max outstanding (unacked) messages")
+    parser.add_argument("--queue-size", type=int, default=16, help="max messages waiting for an inference thread")
+    args = parser.parse_args()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(args.project, args.subscription)
+    streaming_pull = run_worker(subscriber, subscription_path, args.threads, args.max_messages, args.queue_size)
+
+    with subscriber:
+        try:
+            streaming_pull.result()
+        except KeyboardInterrupt:
+            streaming_pull.cancel()
+            streaming_pull.result()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+from google.cloud import bigquery
+import sys
+
+client = bigquery.Client()
+
+# Set your project and dataset
+project_id = "cast-defect-detection"
+dataset_id = "cast_defect_detection"
+table_id = "inference_results"
+
+# Fully qualified table ID
+table_id = f"{project_id}.{dataset_id}.{table_id}"
+
+clustering_fields = ["pred_class", "model_ver"]
+
+# Adds clustering to an existing inference_results table. Only rows written after the
+# change are clustered; pass --rewrite to also rewrite the existing rows in clustered
+# order (stop the inference listener first, rows streamed during the rewrite are lost)
+rewrite = "--rewrite" in sys.argv[1:]
+
+table = client.get_table(table_id)
+if table.clustering_fields == clustering_fields and not rewrite:
+    print(f"Table {table_id} is already clustered on {clustering_fields}.")
+    sys.exit(0)
+
+if rewrite:
+    rewrite_query = f"""
+        CREATE OR REPLACE TABLE `{table_id}`
+        PARTITION BY DATE(res_insert_datetime)
+        CLUSTER BY {', '.join(clustering_fields)}
+        AS SELECT * FROM `{table_id}`
+    """
+    client.query(rewrite_query).result()
+    print(f"Rewrote {table_id}, partitioned on res_insert_datetime and clustered on {clustering_fields}.")
+else:
+    table.clustering_fields = clustering_fields
+    table = client.update_table(table, ["clustering_fields"])
+    print(f"Updated {table_id} to cluster new rows on {table.clustering_fields}.")
@@ -28,12 +28,21 @@ schema = [
     bigquery.SchemaField("comment_datetime", "DATETIME")
 ]
 
+# Comments are looked up by result, a page of results at a time
+clustering_fields = ["result_id"]
+
 # Check if table exists
 try:
-    client.get_table(table_id)
+    table = client.get_table(table_id)
     print(f"Table {table_id} already exists in dataset {dataset_id}.")
+    if table.clustering_fields != clustering_fields:
+        # BigQuery reclusters the existing rows in the background
+        table.clustering_fields = clustering_fields
+        table = client.update_table(table, ["clustering_fields"])
+        print(f"Updated {table_id} to cluster on {table.clustering_fields}.")
 except Exception:
     # Create table if it doesn't exist
     table = bigquery.Table(table_id, schema=schema)
+    table.clustering_fields = clustering_fields
     table = client.create_table(table)
-    print(f"Created table {table.project}.{table.dataset_id}.{table.table_id}")
\ No newline at end of file
+    print(f"Created table {table.project}.{table.dataset_id}.{table.table_id}, clustered on {table.clustering_fields}.")
\ No newline at end of file
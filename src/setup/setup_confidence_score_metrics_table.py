@@ -30,7 +30,8 @@ schema = [
     bigquery.SchemaField("confidence_score_max", "FLOAT"),
     bigquery.SchemaField("insert_datetime", "DATETIME"),
     bigquery.SchemaField("aggregation_start", "DATETIME"),
-    bigquery.SchemaField("aggregation_end", "DATETIME")
+    bigquery.SchemaField("aggregation_end", "DATETIME"),
+    bigquery.SchemaField("confidence_score_sketch", "STRING")  # QuantileSketch JSON
 ]
 
 # Check if table exists
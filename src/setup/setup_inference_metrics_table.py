@@ -30,7 +30,8 @@ schema = [
     bigquery.SchemaField("inference_time_max", "FLOAT"),
     bigquery.SchemaField("insert_datetime", "DATETIME"),
     bigquery.SchemaField("aggregation_start", "DATETIME"),
-    bigquery.SchemaField("aggregation_end", "DATETIME")
+    bigquery.SchemaField("aggregation_end", "DATETIME"),
+    bigquery.SchemaField("inference_time_sketch", "STRING")  # QuantileSketch JSON
 ]
 
 # Check if table exists
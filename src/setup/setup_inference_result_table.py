@@ -47,9 +47,12 @@ except Exception:
         field="res_insert_datetime"  # Partitioning column
     )
 
+    # Cluster within each day on the columns the dashboards filter by
+    table.clustering_fields = ["pred_class", "model_ver"]
+
     table = client.create_table(table)
 
     print(
         f"Created table {table.project}.{table.dataset_id}.{table.table_id}, "
-        f"partitioned on column {table.time_partitioning.field}."
+        f"partitioned on column {table.time_partitioning.field}, clustered on {table.clustering_fields}."
     )
\ No newline at end of file
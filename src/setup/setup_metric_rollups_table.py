@@ -0,0 +1,69 @@
+from google.cloud import bigquery
+
+client = bigquery.Client()
+
+# Set your project and dataset
+project_id = "cast-defect-detection"
+dataset_id = "cast_defect_detection"
+table_id = "metric_rollups"
+
+# Fully qualified table ID
+table_id = f"{project_id}.{dataset_id}.{table_id}"
+
+# Check if dataset exists, if not, create it
+dataset_ref = client.dataset(dataset_id)
+try:
+    client.get_dataset(dataset_ref)  # Check if dataset exists
+    print(f"Dataset {dataset_id} already exists.")
+except Exception:
+    dataset = bigquery.Dataset(f"{project_id}.{dataset_id}")
+    dataset.location = "US"  # Set your preferred location
+    client.create_dataset(dataset, exists_ok=True)
+    print(f"Dataset {dataset_id} created.")
+
+# Define the schema with DATETIME type
+# One row of mergeable partial aggregates per hour, day, week and month, plus the
+# mean and median derived from them for the dashboard
+schema = [
+    bigquery.SchemaField("granularity", "STRING"),
+    bigquery.SchemaField("aggregation_start", "DATETIME"),
+    bigquery.SchemaField("aggregation_end", "DATETIME"),
+    bigquery.SchemaField("row_count", "INTEGER"),
+    bigquery.SchemaField("pass_count", "INTEGER"),
+    bigquery.SchemaField("fail_count", "INTEGER"),
+    bigquery.SchemaField("speed_sum", "FLOAT"),
+    bigquery.SchemaField("speed_min", "FLOAT"),
+    bigquery.SchemaField("speed_max", "FLOAT"),
+    bigquery.SchemaField("speed_mean", "FLOAT"),
+    bigquery.SchemaField("speed_med", "FLOAT"),
+    bigquery.SchemaField("speed_sketch", "STRING"),
+    bigquery.SchemaField("conf_sum", "FLOAT"),
+    bigquery.SchemaField("conf_min", "FLOAT"),
+    bigquery.SchemaField("conf_max", "FLOAT"),
+    bigquery.SchemaField("conf_mean", "FLOAT"),
+    bigquery.SchemaField("conf_med", "FLOAT"),
+    bigquery.SchemaField("conf_sketch", "STRING"),
+    bigquery.SchemaField("update_datetime", "DATETIME")
+]
+
+# Check if table exists
+try:
+    client.get_table(table_id)
+    print(f"Table {table_id} already exists in dataset {dataset_id}.")
+except Exception:
+    # Create table if it doesn't exist
+    table = bigquery.Table(table_id, schema=schema)
+
+    # Monthly partitions on `aggregation_start`, clustered so each granularity is read on its own
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.MONTH,
+        field="aggregation_start"
+    )
+    table.clustering_fields = ["granularity"]
+
+    table = client.create_table(table)
+
+    print(
+        f"Created table {table.project}.{table.dataset_id}.{table.table_id}, "
+        f"partitioned on column {table.time_partitioning.field}."
+    )
\ No newline at end of file
@@ -53,4 +53,80 @@ CREATE OR REPLACE TABLE `cast-defect-detection.cast_defect_detection.comments` (
   result_id STRING,
   comment_text STRING,
   comment_datetime DATETIME
+)
+CLUSTER BY result_id;
+
+
+-- Weekly partial aggregates for incremental metrics (watermark = exclusive upper bound consumed)
+CREATE TABLE IF NOT EXISTS `cast-defect-detection.cast_defect_detection.metrics_state` (
+  aggregation_start DATETIME,
+  aggregation_end DATETIME,
+  watermark DATETIME,
+  row_count INT64,
+  pass_count INT64,
+  fail_count INT64,
+  speed_sum FLOAT64,
+  speed_min FLOAT64,
+  speed_max FLOAT64,
+  speed_sketch STRING,
+  conf_sum FLOAT64,
+  conf_min FLOAT64,
+  conf_max FLOAT64,
+  conf_sketch STRING,
+  update_datetime DATETIME
 );
+
+
+-- Hourly, daily, weekly and monthly rollups built from mergeable partial aggregates
+CREATE TABLE IF NOT EXISTS `cast-defect-detection.cast_defect_detection.metric_rollups` (
+  granularity STRING,
+  aggregation_start DATETIME,
+  aggregation_end DATETIME,
+  row_count INT64,
+  pass_count INT64,
+  fail_count INT64,
+  speed_sum FLOAT64,
+  speed_min FLOAT64,
+  speed_max FLOAT64,
+  speed_mean FLOAT64,
+  speed_med FLOAT64,
+  speed_sketch STRING,
+  conf_sum FLOAT64,
+  conf_min FLOAT64,
+  conf_max FLOAT64,
+  conf_mean FLOAT64,
+  conf_med FLOAT64,
+  conf_sketch STRING,
+  update_datetime DATETIME
+)
+PARTITION BY DATETIME_TRUNC(aggregation_start, MONTH)
+CLUSTER BY granularity;
+
+
+-- Quantile sketches (QuantileSketch JSON) stored with each weekly row, mergeable across weeks
+ALTER TABLE `cast-defect-detection.cast_defect_detection.inference_metrics`
+ADD COLUMN IF NOT EXISTS inference_time_sketch STRING;
+
+ALTER TABLE `cast-defect-detection.cast_defect_detection.confidencescore_metrics`
+ADD COLUMN IF NOT EXISTS confidence_score_sketch STRING;
+
+
+-- Inference results: day partitions on res_insert_datetime, clustered on the dashboard filter columns
+CREATE TABLE IF NOT EXISTS `cast-defect-detection.cast_defect_detection.inference_results` (
+  res_id STRING,
+  res_image_path STRING,
+  raw_image_path STRING,
+  model_ver STRING,
+  pred_class STRING,
+  pred_confidence FLOAT64,
+  pred_speed FLOAT64,
+  res_insert_datetime DATETIME
+)
+PARTITION BY DATE(res_insert_datetime)
+CLUSTER BY pred_class, model_ver;
+
+-- Existing table: rewrite in clustered order (see src/setup/migrate_inference_result_clustering.py)
+-- CREATE OR REPLACE TABLE `cast-defect-detection.cast_defect_detection.inference_results`
+-- PARTITION BY DATE(res_insert_datetime)
+-- CLUSTER BY pred_class, model_ver
+-- AS SELECT * FROM `cast-defect-detection.cast_defect_detection.inference_results`;